@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import sys
+import json
 import time
 import os
 from urlparse import urlparse
@@ -27,6 +28,8 @@ from cloudify.utils import exception_to_error_cause
 from .constants import (
     EXECUTIONS_TIMEOUT,
     POLLING_INTERVAL,
+    POLLING_INITIAL_INTERVAL,
+    POLLING_BACKOFF_FACTOR,
     EXTERNAL_RESOURCE,
     SECRETS_CREATE,
     SECRETS_DELETE,
@@ -137,6 +140,13 @@ class DeploymentProxyBase(object):
 
         # Polling-related properties
         self.interval = operation_inputs.get('interval', POLLING_INTERVAL)
+        self.initial_interval = operation_inputs.get(
+            'initial_interval', POLLING_INITIAL_INTERVAL)
+        self.backoff_factor = operation_inputs.get(
+            'backoff_factor', POLLING_BACKOFF_FACTOR)
+        # poll executions statuses by one request for all operations in
+        # agent with same client
+        self.shared_polling = operation_inputs.get('shared_polling', False)
         self.state = operation_inputs.get('state', 'terminated')
         self.timeout = operation_inputs.get('timeout', EXECUTIONS_TIMEOUT)
 
@@ -144,6 +154,19 @@ class DeploymentProxyBase(object):
         # successfully
         self.execution_id = None
 
+    def _polling_args(self):
+        return dict(interval=self.interval,
+                    initial_interval=self.initial_interval,
+                    backoff_factor=self.backoff_factor)
+
+    def _shared_client_key(self):
+        if not self.shared_polling:
+            return None
+        if self.client_config:
+            return json.dumps(self.client_config, sort_keys=True)
+        # manager client is authorized only for current execution
+        return ctx.execution_id
+
     def dp_get_client_response(self,
                                _client,
                                _client_attr,
@@ -390,7 +413,8 @@ class DeploymentProxyBase(object):
                 dep_system_workflows_finished,
                 timeout=self.timeout,
                 pollster_args=pollster_args,
-                expected_result=True)
+                expected_result=True,
+                **self._polling_args())
 
             ctx.logger.info("Delete deployment {0}".format(self.deployment_id))
             self.dp_get_client_response('deployments', DEP_DELETE, client_args)
@@ -405,7 +429,8 @@ class DeploymentProxyBase(object):
                 any_dep_by_id,
                 timeout=self.timeout,
                 pollster_args=pollster_args,
-                expected_result=False)
+                expected_result=False,
+                **self._polling_args())
 
         ctx.logger.info("Little wait internal cleanup services.")
         time.sleep(POLLING_INTERVAL)
@@ -416,7 +441,8 @@ class DeploymentProxyBase(object):
             dep_system_workflows_finished,
             timeout=self.timeout,
             pollster_args=pollster_args,
-            expected_result=True)
+            expected_result=True,
+            **self._polling_args())
 
         if not self.blueprint.get(EXTERNAL_RESOURCE):
             ctx.logger.info("Delete blueprint {0}."
@@ -445,7 +471,8 @@ class DeploymentProxyBase(object):
         if not poll_with_timeout(dep_system_workflows_finished,
                                  timeout=self.timeout,
                                  pollster_args=pollster_args,
-                                 expected_result=True):
+                                 expected_result=True,
+                                 **self._polling_args()):
             return ctx.operation.retry(
                 'The deployment is not ready for execution.')
 
@@ -545,4 +572,7 @@ class DeploymentProxyBase(object):
             self.workflow_state,
             self.workflow_id,
             self.execution_id,
-            _log_redirect=self.deployment_logs.get('redirect', True))
+            _log_redirect=self.deployment_logs.get('redirect', True),
+            _initial_interval=self.initial_interval,
+            _backoff_factor=self.backoff_factor,
+            _shared_client_key=self._shared_client_key())
@@ -15,6 +15,15 @@
 DEPLOYMENTS_TIMEOUT = 120
 EXECUTIONS_TIMEOUT = 1800
 POLLING_INTERVAL = 10
+# first polling interval, next intervals grow by backoff factor up to
+# POLLING_INTERVAL with +/- jitter part of interval
+POLLING_INITIAL_INTERVAL = 1
+POLLING_BACKOFF_FACTOR = 2
+POLLING_JITTER = 0.1
+# shared executions poller: execution ids per list request and count of
+# failed ticks in row before waiters get error
+POLLING_IDS_PER_REQUEST = 50
+POLLING_ERRORS_LIMIT = 3
 EXTERNAL_RESOURCE = 'external_resource'
 
 PLUGIN_UPLOAD = 'upload'
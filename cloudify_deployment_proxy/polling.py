@@ -12,13 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from contextlib import contextmanager
 from os import getenv
+import json
+import random
+import threading
 import time
 
 from cloudify import ctx
 from cloudify.exceptions import NonRecoverableError
 from cloudify_rest_client.exceptions import CloudifyClientError
-from .constants import POLLING_INTERVAL
+from .constants import (
+    POLLING_INTERVAL,
+    POLLING_INITIAL_INTERVAL,
+    POLLING_BACKOFF_FACTOR,
+    POLLING_JITTER,
+    POLLING_IDS_PER_REQUEST,
+    POLLING_ERRORS_LIMIT
+)
 
 
 def any_bp_by_id(_client, _bp_id):
@@ -47,38 +58,69 @@ def all_resource_by_id(_client, _resource_id, _resource_type):
     return all(output)
 
 
+def _response_size(_response):
+    # approximate size of response body, only for debug
+    return len(json.dumps(list(_response), default=repr))
+
+
 def resource_by_id(_client, _id, _type):
     _resources_client = getattr(_client, _type)
     try:
-        _resources = _resources_client.list(_include=['id'])
+        # filter by id on manager side, so we never download full list
+        _resources = _resources_client.list(_include=['id'], id=_id)
     except CloudifyClientError as ex:
         raise NonRecoverableError(
             '{0} list failed {1}.'.format(_type, str(ex)))
     else:
+        ctx.logger.debug(
+            'Check {0} {1}: {2} item(s), ~{3} bytes received.'.format(
+                _type, _id, len(_resources), _response_size(_resources)))
         return [str(_r['id']) == _id for _r in _resources]
 
 
+def polling_intervals(initial_interval=POLLING_INITIAL_INTERVAL,
+                      max_interval=POLLING_INTERVAL,
+                      backoff_factor=POLLING_BACKOFF_FACTOR,
+                      jitter=POLLING_JITTER):
+    # exponential backoff with jitter, capped by max_interval
+    interval = min(initial_interval, max_interval)
+    while True:
+        yield min(interval * random.uniform(1 - jitter, 1 + jitter),
+                  max_interval)
+        interval = min(interval * backoff_factor, max_interval)
+
+
 def poll_with_timeout(pollster,
                       timeout,
                       interval=POLLING_INTERVAL,
                       pollster_args=None,
-                      expected_result=True):
+                      expected_result=True,
+                      initial_interval=POLLING_INITIAL_INTERVAL,
+                      backoff_factor=POLLING_BACKOFF_FACTOR,
+                      jitter=POLLING_JITTER):
 
     pollster_args = pollster_args or dict()
     # Check if timeout value is -1 that allows infinite timeout
     # If timeout value is not -1 then it is a finite timeout
     timeout = float('infinity') if timeout == -1 else timeout
-    current_time = time.time()
+    deadline = time.time() + timeout
+    intervals = polling_intervals(initial_interval, interval,
+                                  backoff_factor, jitter)
 
     ctx.logger.debug('Timeout value is {}'.format(timeout))
 
-    while time.time() <= current_time + timeout:
-        if pollster(**pollster_args) != expected_result:
-            ctx.logger.debug('Polling...')
-            time.sleep(interval)
-        else:
+    while True:
+        if pollster(**pollster_args) == expected_result:
             ctx.logger.debug('Polling succeeded!')
             return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        # don't sleep after deadline, check last time right on deadline
+        sleep_time = min(next(intervals), remaining)
+        ctx.logger.debug('Polling... next check in {0:.1f}s'
+                         .format(sleep_time))
+        time.sleep(sleep_time)
 
     ctx.logger.error('Polling timed out!')
     return False
@@ -226,6 +268,162 @@ def dep_workflow_in_state_pollster(_client,
     return False
 
 
+class ExecutionsPoller(object):
+    """Get status of all waited executions by one list request per tick.
+
+    Shared by all operations in process with same client key.
+    """
+
+    _pollers = {}
+    _pollers_lock = threading.Lock()
+
+    def __init__(self, client, interval=POLLING_INTERVAL, key=None):
+        self.client = client
+        self.key = key
+        self.interval = interval
+        self._condition = threading.Condition()
+        # execution id -> count of waiters
+        self._waiters = {}
+        # execution id -> last known status
+        self._statuses = {}
+        self._error = None
+        self._failures = 0
+        self._thread = None
+
+    @classmethod
+    def get(cls, key, client, interval=POLLING_INTERVAL):
+        with cls._pollers_lock:
+            if key not in cls._pollers:
+                cls._pollers[key] = cls(client, interval, key)
+            return cls._pollers[key]
+
+    @contextmanager
+    def watch(self, execution_id):
+        with self._condition:
+            self._waiters[execution_id] = \
+                self._waiters.get(execution_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._waiters[execution_id] -= 1
+                if not self._waiters[execution_id]:
+                    del self._waiters[execution_id]
+                    self._statuses.pop(execution_id, None)
+
+    def _tick(self):
+        with self._condition:
+            execution_ids = sorted(self._waiters)
+        if not execution_ids:
+            return
+        _execs = []
+        try:
+            # keep query string short
+            for offset in range(0, len(execution_ids),
+                                POLLING_IDS_PER_REQUEST):
+                selected_ids = \
+                    execution_ids[offset:offset + POLLING_IDS_PER_REQUEST]
+                _execs += self.client.executions.list(
+                    id=selected_ids,
+                    include_system_workflows=True,
+                    _include=['id', 'status'],
+                    _size=len(selected_ids))
+        except Exception as ex:
+            # rest client does not wrap connection errors, so any error is
+            # counted as failed tick
+            with self._condition:
+                # retry on next tick, fail waiters only if manager is
+                # unavailable for several ticks
+                # (no ctx logger here, context is not set in poller thread)
+                self._failures += 1
+                if self._failures >= POLLING_ERRORS_LIMIT:
+                    self._error = ex
+                    self._condition.notify_all()
+            return
+        with self._condition:
+            self._error = None
+            self._failures = 0
+            for _exec in _execs:
+                if _exec.get('id') in self._waiters:
+                    self._statuses[_exec.get('id')] = _exec.get('status')
+            self._condition.notify_all()
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    if not self._waiters:
+                        return
+                self._tick()
+                time.sleep(self.interval)
+        except Exception as ex:
+            with self._condition:
+                self._error = ex
+        finally:
+            with self._condition:
+                self._thread = None
+                # forget poller, next waiter will create new one
+                with self._pollers_lock:
+                    if self._pollers.get(self.key) is self:
+                        del self._pollers[self.key]
+                # don't leave current waiters until timeout
+                self._condition.notify_all()
+
+    def wait(self, execution_id, known_status=None, timeout=None):
+        """Return status of execution after change or on timeout."""
+        with self._condition:
+            # stopped by error poller is not restarted
+            if not self._thread and not self._error:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            deadline = time.time() + (
+                self.interval if timeout is None else timeout)
+            while (
+                self._statuses.get(execution_id) == known_status and
+                not self._error
+            ):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            if self._error:
+                raise NonRecoverableError(
+                    'Executions list failed {0}.'.format(str(self._error)))
+            return self._statuses.get(execution_id)
+
+
+def poll_workflow_shared(_timeout,
+                         _interval,
+                         _client,
+                         _client_key,
+                         _state,
+                         _execution_id,
+                         _log_redirect=False):
+
+    poller = ExecutionsPoller.get(_client_key, _client, _interval)
+    timeout = float('infinity') if _timeout == -1 else _timeout
+    deadline = time.time() + timeout
+    status = None
+    with poller.watch(_execution_id):
+        while True:
+            status = poller.wait(
+                _execution_id, status,
+                min(_interval, max(deadline - time.time(), 0)))
+            if _log_redirect:
+                dep_logs_redirect(_client, _execution_id)
+            if status == _state:
+                ctx.logger.debug(
+                    'The status for execution id {0} is {1}'.format(
+                        _execution_id, _state))
+                return True
+            elif status == 'failed':
+                raise NonRecoverableError(
+                    'Execution {0} failed.'.format(_execution_id))
+            if time.time() >= deadline:
+                return False
+
+
 def poll_workflow_after_execute(_timeout,
                                 _interval,
                                 _client,
@@ -233,7 +431,10 @@ def poll_workflow_after_execute(_timeout,
                                 _state,
                                 _workflow_id,
                                 _execution_id,
-                                _log_redirect=False):
+                                _log_redirect=False,
+                                _initial_interval=POLLING_INITIAL_INTERVAL,
+                                _backoff_factor=POLLING_BACKOFF_FACTOR,
+                                _shared_client_key=None):
 
     pollster_args = {
         '_client': _client,
@@ -246,12 +447,19 @@ def poll_workflow_after_execute(_timeout,
 
     ctx.logger.debug('Polling: {0}'.format(pollster_args))
 
-    success = \
-        poll_with_timeout(
-            dep_workflow_in_state_pollster,
-            timeout=_timeout,
-            interval=_interval,
-            pollster_args=pollster_args)
+    if _shared_client_key is not None:
+        success = poll_workflow_shared(
+            _timeout, _interval, _client, _shared_client_key, _state,
+            _execution_id, _log_redirect=_log_redirect)
+    else:
+        success = \
+            poll_with_timeout(
+                dep_workflow_in_state_pollster,
+                timeout=_timeout,
+                interval=_interval,
+                pollster_args=pollster_args,
+                initial_interval=_initial_interval,
+                backoff_factor=_backoff_factor)
 
     if not success:
         raise NonRecoverableError(
@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from itertools import islice
+
 import mock
 
 from cloudify.state import current_ctx
 from cloudify.exceptions import NonRecoverableError
 from cloudify_rest_client.exceptions import CloudifyClientError
+from requests.exceptions import ConnectionError
 
 from .base import DeploymentProxyTestBase
 from .client_mock import MockCloudifyRestClient
@@ -26,10 +29,13 @@ from ..polling import (
     all_deps_by_id,
     resource_by_id,
     poll_with_timeout,
+    polling_intervals,
     dep_logs_redirect,
     dep_workflow_in_state_pollster,
     dep_system_workflows_finished,
-    poll_workflow_after_execute)
+    poll_workflow_after_execute,
+    poll_workflow_shared,
+    ExecutionsPoller)
 
 
 class TestPolling(DeploymentProxyTestBase):
@@ -144,6 +150,21 @@ class TestPolling(DeploymentProxyTestBase):
             output = all_deps_by_id(cfy_mock_client, test_name)
             self.assertTrue(output)
 
+    # test that resource_by_id requests only resources with same id
+    def test_resource_by_id_filter(self):
+        test_name = 'test_resource_by_id_filter'
+        _ctx = self.get_mock_ctx(test_name)
+        current_ctx.set(_ctx)
+
+        cfy_mock_client = MockCloudifyRestClient()
+        cfy_mock_client.deployments.list = mock.Mock(
+            return_value=[{'id': test_name}])
+        self.assertEqual(
+            resource_by_id(cfy_mock_client, test_name, 'deployments'),
+            [True])
+        cfy_mock_client.deployments.list.assert_called_once_with(
+            _include=['id'], id=test_name)
+
     # test that resource_by_id raises when it catches an exception
     def test_resource_by_id_client_error(self):
         test_name = 'test_resource_by_id_client_error'
@@ -206,6 +227,33 @@ class TestPolling(DeploymentProxyTestBase):
                 True)
         self.assertTrue(output)
 
+    # Test that intervals grow up to max interval
+    def test_polling_intervals(self):
+        self.assertEqual(
+            list(islice(polling_intervals(1, 10, 2, 0), 6)),
+            [1, 2, 4, 8, 10, 10])
+        for interval, expected in zip(
+            islice(polling_intervals(1, 10, 2, 0.1), 6), [1, 2, 4, 8, 10, 10]
+        ):
+            self.assertTrue(expected * 0.9 <= interval <= min(expected * 1.1,
+                                                              10))
+
+    # Test that last sleep is limited by timeout
+    def test_poll_with_timeout_deadline(self):
+        test_name = 'test_poll_with_timeout_deadline'
+        _ctx = self.get_mock_ctx(test_name)
+        current_ctx.set(_ctx)
+
+        mock_pollster = mock.MagicMock(return_value=False)
+        with mock.patch('cloudify_deployment_proxy.polling.time') as mock_time:
+            mock_time.time = mock.MagicMock(side_effect=[0, 1, 4.5, 5])
+            output = poll_with_timeout(
+                mock_pollster, 5, interval=10, initial_interval=3,
+                backoff_factor=2, jitter=0)
+            self.assertFalse(output)
+            mock_time.sleep.assert_has_calls([mock.call(3), mock.call(0.5)])
+        self.assertEqual(mock_pollster.call_count, 3)
+
     # Test that no matching executions returns False
     def test_dep_system_workflows_finished_no_executions(self):
         test_name = 'test_dep_system_workflows_finished_no_executions'
@@ -441,6 +489,151 @@ class TestPolling(DeploymentProxyTestBase):
                     None, None, None, None, None, None,  None)
             self.assertTrue(output)
 
+    # test that all waited executions are requested by one call
+    def test_executions_poller_tick(self):
+        _ctx = self.get_mock_ctx('test_executions_poller_tick')
+        current_ctx.set(_ctx)
+
+        cfy_mock_client = MockCloudifyRestClient()
+        cfy_mock_client.executions.list = mock.MagicMock(return_value=[
+            {'id': 'a', 'status': 'started'},
+            {'id': 'b', 'status': 'terminated'}])
+        poller = ExecutionsPoller(cfy_mock_client)
+        # ticks are run by test, not by poller thread
+        poller._thread = mock.MagicMock()
+        with poller.watch('a'), poller.watch('b'):
+            poller._tick()
+            cfy_mock_client.executions.list.assert_called_once_with(
+                id=['a', 'b'], include_system_workflows=True,
+                _include=['id', 'status'], _size=2)
+            self.assertEqual(poller.wait('a', None, 0), 'started')
+            self.assertEqual(poller.wait('b', None, 0), 'terminated')
+        # nothing to wait
+        poller._tick()
+        self.assertEqual(cfy_mock_client.executions.list.call_count, 1)
+
+    # test that ids are requested by chunks
+    def test_executions_poller_tick_chunks(self):
+        _ctx = self.get_mock_ctx('test_executions_poller_tick_chunks')
+        current_ctx.set(_ctx)
+
+        cfy_mock_client = MockCloudifyRestClient()
+        cfy_mock_client.executions.list = mock.MagicMock(return_value=[])
+        poller = ExecutionsPoller(cfy_mock_client)
+        # ticks are run by test, not by poller thread
+        poller._thread = mock.MagicMock()
+        with mock.patch(
+            'cloudify_deployment_proxy.polling.POLLING_IDS_PER_REQUEST', 2
+        ), poller.watch('a'), poller.watch('b'), poller.watch('c'):
+            poller._tick()
+        cfy_mock_client.executions.list.assert_has_calls([
+            mock.call(id=['a', 'b'], include_system_workflows=True,
+                      _include=['id', 'status'], _size=2),
+            mock.call(id=['c'], include_system_workflows=True,
+                      _include=['id', 'status'], _size=1)])
+
+    # test that waiters get error only after several failed ticks
+    def test_executions_poller_tick_errors(self):
+        _ctx = self.get_mock_ctx('test_executions_poller_tick_errors')
+        current_ctx.set(_ctx)
+
+        cfy_mock_client = MockCloudifyRestClient()
+        cfy_mock_client.executions.list = mock.MagicMock(
+            side_effect=CloudifyClientError('Mistake'))
+        poller = ExecutionsPoller(cfy_mock_client)
+        # ticks are run by test, not by poller thread
+        poller._thread = mock.MagicMock()
+        with poller.watch('a'):
+            poller._tick()
+            poller._tick()
+            self.assertIsNone(poller.wait('a', None, 0))
+            poller._tick()
+            output = self.assertRaises(NonRecoverableError, poller.wait,
+                                       'a', None, 0)
+            self.assertIn('Mistake', output.message)
+            # manager is available again
+            cfy_mock_client.executions.list = mock.MagicMock(
+                return_value=[{'id': 'a', 'status': 'started'}])
+            poller._tick()
+            self.assertEqual(poller.wait('a', None, 0), 'started')
+            # connection errors are not wrapped by client
+            cfy_mock_client.executions.list = mock.MagicMock(
+                side_effect=ConnectionError('Refused'))
+            poller._tick()
+            self.assertEqual(poller.wait('a', None, 0), 'started')
+            self.assertEqual(poller._failures, 1)
+
+    # test that stopped poller is forgotten and waiters are not blocked
+    def test_executions_poller_run_error(self):
+        _ctx = self.get_mock_ctx('test_executions_poller_run_error')
+        current_ctx.set(_ctx)
+
+        cfy_mock_client = MockCloudifyRestClient()
+        poller = ExecutionsPoller.get(
+            'test_executions_poller_run_error', cfy_mock_client)
+        poller._thread = mock.MagicMock()
+        poller._tick = mock.MagicMock(side_effect=RuntimeError('Broken'))
+        with poller.watch('a'):
+            # run in test thread
+            poller._run()
+            self.assertIsNone(poller._thread)
+            output = self.assertRaises(NonRecoverableError, poller.wait,
+                                       'a', None, 10)
+            self.assertIn('Broken', output.message)
+        self.assertIsNot(
+            ExecutionsPoller.get(
+                'test_executions_poller_run_error', cfy_mock_client),
+            poller)
+
+    def _shared_client(self, statuses):
+        cfy_mock_client = MockCloudifyRestClient()
+
+        def mock_return(id, **kwargs):
+            del kwargs
+            status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+            return [{'id': _id, 'status': status} for _id in id]
+
+        cfy_mock_client.executions.list = mock_return
+        return cfy_mock_client
+
+    # test that shared polling returns after status changed to expected
+    def test_poll_workflow_shared(self):
+        _ctx = self.get_mock_ctx('test_poll_workflow_shared')
+        current_ctx.set(_ctx)
+
+        cfy_mock_client = self._shared_client(['started', 'terminated'])
+        self.assertTrue(poll_workflow_shared(
+            1, .001, cfy_mock_client, 'test_poll_workflow_shared',
+            'terminated', 'exec_id'))
+
+    # test that shared polling raises on failed execution
+    def test_poll_workflow_shared_failed(self):
+        _ctx = self.get_mock_ctx('test_poll_workflow_shared_failed')
+        current_ctx.set(_ctx)
+
+        cfy_mock_client = self._shared_client(['failed'])
+        output = self.assertRaises(
+            NonRecoverableError, poll_workflow_shared,
+            1, .001, cfy_mock_client, 'test_poll_workflow_shared_failed',
+            'terminated', 'exec_id')
+        self.assertIn('failed', output.message)
+
+    # test that shared polling uses shared poller
+    def test_poll_workflow_after_execute_shared(self):
+        _ctx = self.get_mock_ctx('test_poll_workflow_after_execute_shared')
+        current_ctx.set(_ctx)
+
+        with mock.patch(
+                'cloudify_deployment_proxy.polling.poll_workflow_shared') \
+                as mocked_fn:
+            mocked_fn.return_value = True
+            self.assertTrue(poll_workflow_after_execute(
+                1, 2, 'client', None, 'terminated', None, 'exec_id',
+                _shared_client_key='key'))
+            mocked_fn.assert_called_once_with(
+                1, 2, 'client', 'key', 'terminated', 'exec_id',
+                _log_redirect=False)
+
     def test_dep_logs_redirect_predefined_level(self):
         test_name = "dep_logs_redirect_predefined_level"
         _ctx = self.get_mock_ctx(test_name)
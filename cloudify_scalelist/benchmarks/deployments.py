@@ -0,0 +1,528 @@
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure scalelist workflows on synthetic large deployments.
+
+Deployment has scaling group 'server_group' with 'server' and 'app' nodes
+(app is connected to server from same group instance and to single 'db'
+instance), each group instance is created in transaction with 9 others.
+REST client, workflow context and tasks graph are in-process stand-ins,
+lifecycle subgraphs are replaced by empty subgraphs, so results show only
+time and memory spent in scalelist code.
+
+Each case is run in separate process, memory is growth of peak RSS in
+process while case is running.
+
+Run as:
+    python -m cloudify_scalelist.benchmarks.deployments \\
+        --instances 1000 10000 50000 --output results.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+from mock import patch
+
+from cloudify_rest_client.responses import ListResponse
+
+from cloudify_scalelist import storage
+import cloudify_scalelist.workflows as workflows
+
+DEFAULT_INSTANCES = [1000, 10000, 50000]
+# group instances in one transaction
+TRANSACTION_SIZE = 10
+# one of such group instances is selected for scale down, so with
+# transactions 10% of group instances are removed
+SELECTED_STEP = 100
+# group instances added by scale up, in percents of current count
+SCALEUP_PERCENTAGE = 10
+
+OPERATION = 'cloudify.interfaces.lifecycle.update'
+NODE_SEQUENCE = ['server', 'app']
+
+
+class FakeRelationship(object):
+
+    def __init__(self, target_id):
+        self.target_id = target_id
+
+
+class FakeNodeInstance(object):
+    # node instance as returned by REST client and as part of workflow
+    # context at same time
+
+    def __init__(self, instance_id, node, runtime_properties,
+                 relationships=None):
+        self.id = instance_id
+        self.node_id = node.id
+        self.node = node
+        self.runtime_properties = runtime_properties
+        self.relationships = [FakeRelationship(target_id)
+                              for target_id in relationships or []]
+        self.state = 'started'
+        self.version = 1
+        self.modification = None
+
+    @property
+    def _node_instance(self):
+        return self
+
+
+class FakeNode(object):
+
+    def __init__(self, node_id, host_node=None, relationships=None):
+        self.id = node_id
+        self.host_node = host_node
+        self.relationships = relationships or []
+        self.type_hierarchy = ['cloudify.nodes.Root', node_id + '_type']
+        self.operations = {OPERATION: {}}
+        self.instances = []
+
+    @property
+    def number_of_instances(self):
+        return len(self.instances)
+
+
+class FakeNodeInstances(object):
+
+    def __init__(self, counters):
+        self._counters = counters
+        self._instances = {}
+        self._sorted_ids = None
+
+    def _count(self, name):
+        self._counters[name] = self._counters.get(name, 0) + 1
+
+    def add(self, instance):
+        self._instances[instance.id] = instance
+        self._sorted_ids = None
+
+    def remove(self, instance_id):
+        del self._instances[instance_id]
+        self._sorted_ids = None
+
+    def list(self, _offset=0, _size=None, id=None, **kwargs):
+        self._count('node_instances.list')
+        if id is not None:
+            items = [self._instances[instance_id] for instance_id in id
+                     if instance_id in self._instances]
+            return ListResponse(items, {'pagination': {
+                'total': len(items), 'offset': 0, 'size': len(items)}})
+        if self._sorted_ids is None:
+            self._sorted_ids = sorted(self._instances)
+        if _size is None:
+            _size = len(self._sorted_ids)
+        return ListResponse(
+            [self._instances[instance_id] for instance_id in
+             self._sorted_ids[_offset:_offset + _size]],
+            {'pagination': {'total': len(self._sorted_ids),
+                            'offset': _offset, 'size': _size}})
+
+    def get(self, node_instance_id, **kwargs):
+        self._count('node_instances.get')
+        return self._instances[node_instance_id]
+
+    def update(self, node_instance_id, state=None, runtime_properties=None,
+               version=1):
+        self._count('node_instances.update')
+        instance = self._instances[node_instance_id]
+        if runtime_properties is not None:
+            instance.runtime_properties = runtime_properties
+        if state is not None:
+            instance.state = state
+        instance.version = version
+        return instance
+
+
+class FakeDeployments(object):
+
+    def __init__(self, counters, groups):
+        self._counters = counters
+        self._groups = groups
+
+    def get(self, deployment_id, **kwargs):
+        self._counters['deployments.get'] = (
+            self._counters.get('deployments.get', 0) + 1)
+        return {'groups': self._groups}
+
+
+class FakeRestClient(object):
+
+    def __init__(self, groups):
+        self.counters = {}
+        self.node_instances = FakeNodeInstances(self.counters)
+        self.deployments = FakeDeployments(self.counters, groups)
+
+
+class FakeModificationInstances(object):
+
+    def __init__(self, node_instances):
+        self.node_instances = node_instances
+
+
+class FakeModification(object):
+
+    def __init__(self, deployment, added, removed):
+        self.id = 'modification_{}'.format(deployment.modifications)
+        self._deployment = deployment
+        self.added = FakeModificationInstances(added)
+        self.removed = FakeModificationInstances(removed)
+
+    def finish(self):
+        self._deployment.finish_modification(self)
+
+    def rollback(self):
+        self._deployment.rollback_modification(self)
+
+
+class FakeDeployment(object):
+
+    def __init__(self, deployment_id, client, nodes, group_name):
+        self.id = deployment_id
+        self._client = client
+        self._nodes = dict((node.id, node) for node in nodes)
+        self._group_name = group_name
+        self._units = 0
+        self._next_unit = 0
+        self.modifications = 0
+        self.scaling_groups = {
+            group_name: {
+                'members': list(NODE_SEQUENCE),
+                'properties': {'current_instances': 0}
+            }
+        }
+
+    def add_unit(self, runtime_properties=None):
+        # create server and app instances of one group instance
+        unit = self._next_unit
+        self._next_unit += 1
+        server_node = self._nodes['server']
+        app_node = self._nodes['app']
+        db_id = self._nodes['db'].instances[0].id
+        server = FakeNodeInstance('server_{:07d}'.format(unit), server_node,
+                                  dict(runtime_properties or {}))
+        app = FakeNodeInstance('app_{:07d}'.format(unit), app_node,
+                               dict(runtime_properties or {}),
+                               [server.id, db_id])
+        for instance in (server, app):
+            instance.node.instances.append(instance)
+            self._client.node_instances.add(instance)
+        return [server, app]
+
+    def _set_units(self, units):
+        self._units = units
+        self.scaling_groups[self._group_name]['properties'][
+            'current_instances'] = units
+
+    def start_modification(self, scale_settings):
+        self.modifications += 1
+        settings = scale_settings[self._group_name]
+        delta = settings['instances'] - self._units
+        added = []
+        removed = []
+        if delta > 0:
+            for _ in range(delta):
+                for instance in self.add_unit():
+                    instance.modification = 'added'
+                    added.append(instance)
+        elif delta < 0:
+            hint = set(settings.get('removed_ids_include_hint', []))
+            servers = [instance for instance in
+                       self._nodes['server'].instances
+                       if instance.id in hint][:-delta]
+            for server in servers:
+                app_id = server.id.replace('server_', 'app_')
+                app = self._client.node_instances.get(app_id)
+                for instance in (server, app):
+                    instance.modification = 'removed'
+                    removed.append(instance)
+        return FakeModification(self, added, removed)
+
+    def _remove_instances(self, instances):
+        removed_ids = set(instance.id for instance in instances)
+        for node in self._nodes.values():
+            node.instances = [instance for instance in node.instances
+                              if instance.id not in removed_ids]
+        for instance_id in removed_ids:
+            self._client.node_instances.remove(instance_id)
+
+    def finish_modification(self, modification):
+        self._remove_instances(modification.removed.node_instances)
+        self._set_units(self._units +
+                        len(modification.added.node_instances) // 2 -
+                        len(modification.removed.node_instances) // 2)
+
+    def rollback_modification(self, modification):
+        self._remove_instances(modification.added.node_instances)
+
+
+class FakeSubgraph(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeGraph(object):
+    # count subgraphs and dependencies without execution
+
+    def __init__(self):
+        self.subgraphs = 0
+        self.dependencies = 0
+
+    def subgraph(self, name):
+        self.subgraphs += 1
+        return FakeSubgraph(name)
+
+    def add_dependency(self, src_task, dst_task):
+        self.dependencies += 1
+
+    def tasks_iter(self):
+        return iter([])
+
+    def remove_task(self, task):
+        pass
+
+    def execute(self):
+        pass
+
+    def _is_execution_cancelled(self):
+        return False
+
+
+class FakeContext(object):
+
+    def __init__(self, deployment, nodes):
+        self.deployment = deployment
+        self.nodes = nodes
+        self._nodes = dict((node.id, node) for node in nodes)
+        self.execution_id = 'benchmark'
+        self.wait_after_fail = 0
+        self.logger = logging.getLogger('cloudify_scalelist.benchmarks')
+        self.graphs = []
+
+    def get_node(self, node_id):
+        return self._nodes.get(node_id)
+
+    def graph_mode(self):
+        graph = FakeGraph()
+        self.graphs.append(graph)
+        return graph
+
+
+def _stub_subgraph(node_instance, graph, ignore_failure=False):
+    return graph.subgraph(node_instance.id)
+
+
+def gen_deployment(count):
+    # returns workflow context and REST client for deployment with about
+    # count node instances
+    group_name = 'server_group'
+    client = FakeRestClient({
+        group_name: {'members': list(NODE_SEQUENCE)},
+        'any': {'members': list(NODE_SEQUENCE) + ['db']}
+    })
+    db_node = FakeNode('db')
+    server_node = FakeNode('server')
+    app_node = FakeNode('app', relationships=[
+        FakeRelationship('server'), FakeRelationship('db')])
+    nodes = [db_node, server_node, app_node]
+    deployment = FakeDeployment('benchmark_{}'.format(count), client, nodes,
+                                group_name)
+    db = FakeNodeInstance('db_0000000', db_node, {'name': 'db'})
+    db_node.instances.append(db)
+    client.node_instances.add(db)
+
+    units = max((count - 1) // 2, 1)
+    for unit in range(units):
+        deployment.add_unit({
+            'name': 'unit{}'.format(unit),
+            '_transaction': 'transaction{}'.format(unit // TRANSACTION_SIZE)
+        })
+    deployment._set_units(units)
+    return FakeContext(deployment, nodes), client
+
+
+def _selected_values(ctx):
+    units = ctx.deployment.scaling_groups['server_group']['properties'][
+        'current_instances']
+    return ['unit{}'.format(unit) for unit in range(0, units, SELECTED_STEP)]
+
+
+def _case_transactions(ctx):
+    _, instance_ids = workflows._get_transaction_instances(
+        ctx, '_transaction', None, ['name'], _selected_values(ctx),
+        all_results=True)
+    return {'selected': len(instance_ids)}
+
+
+def _case_scale_list(ctx):
+    node_instances = {}
+    for node_id in NODE_SEQUENCE:
+        node_instances[node_id] = [
+            instance.id for instance in
+            ctx.get_node(node_id).instances[::SELECTED_STEP // 10]]
+    scale_list = workflows._get_scale_list(ctx, node_instances, basestring)
+    return {'selected': sum(len(settings['values'])
+                            for settings in scale_list.values())}
+
+
+def _case_filter(ctx):
+    values = ['unit{}'.format(unit) for unit in range(
+        0, ctx.get_node('server').number_of_instances, SELECTED_STEP // 10)]
+    return {'selected': len(list(workflows._filter_node_instances(
+        ctx, ['app'], None, ['cloudify.nodes.Root'], OPERATION, ['name'],
+        values)))}
+
+
+def _case_process(ctx):
+    graph = FakeGraph()
+    workflows._process_node_instances(
+        ctx, graph,
+        [instance for node in ctx.nodes for instance in node.instances],
+        False, _stub_subgraph, NODE_SEQUENCE)
+    return {'subgraphs': graph.subgraphs,
+            'dependencies': graph.dependencies}
+
+
+def _graphs_size(ctx):
+    return {'subgraphs': sum(graph.subgraphs for graph in ctx.graphs),
+            'dependencies': sum(graph.dependencies for graph in ctx.graphs)}
+
+
+def _case_scaleuplist(ctx):
+    units = ctx.deployment.scaling_groups['server_group']['properties'][
+        'current_instances']
+    workflows.scaleuplist(
+        ctx=ctx,
+        scalable_entity_properties={'server': [
+            {'name': 'new{}'.format(unit)} for unit in
+            range(max(units * SCALEUP_PERCENTAGE // 100, 1))]},
+        scale_transaction_field='_transaction',
+        node_sequence=NODE_SEQUENCE)
+    return _graphs_size(ctx)
+
+
+def _case_scaledownlist(ctx):
+    workflows.scaledownlist(
+        ctx=ctx,
+        scale_transaction_field='_transaction',
+        scale_node_field='name',
+        scale_node_field_value=_selected_values(ctx),
+        all_results=True,
+        node_sequence=NODE_SEQUENCE)
+    return _graphs_size(ctx)
+
+
+CASES = [
+    ('transactions', _case_transactions),
+    ('scale_list', _case_scale_list),
+    ('filter_node_instances', _case_filter),
+    ('process_node_instances', _case_process),
+    ('scaleuplist', _case_scaleuplist),
+    ('scaledownlist', _case_scaledownlist),
+]
+
+
+def _max_rss_kb():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_case(name, count):
+    # generate deployment and run case in current process, returns result
+    # dictionary
+    case = dict(CASES)[name]
+    ctx, client = gen_deployment(count)
+    storage_path = tempfile.mkdtemp()
+    try:
+        with patch("cloudify_scalelist.workflows.get_rest_client",
+                   return_value=client), \
+                patch.object(storage, 'STORAGE_PATH', storage_path), \
+                patch.object(workflows.lifecycle,
+                             'install_node_instance_subgraph',
+                             _stub_subgraph), \
+                patch.object(workflows.lifecycle,
+                             'uninstall_node_instance_subgraph',
+                             _stub_subgraph):
+            workflows._groups_cache.clear()
+            memory_before = _max_rss_kb()
+            started = time.time()
+            details = case(ctx)
+            seconds = time.time() - started
+            memory_kb = _max_rss_kb() - memory_before
+    finally:
+        shutil.rmtree(storage_path)
+    return {
+        'case': name,
+        'instances': count,
+        'seconds': round(seconds, 4),
+        'memory_kb': memory_kb,
+        'rest_calls': client.counters,
+        'details': details
+    }
+
+
+def _run_case_process(name, count, results):
+    results.put(run_case(name, count))
+
+
+def run_isolated(name, count):
+    # run case in separate process, so peak RSS is not shared between cases
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case_process,
+                                      args=(name, count, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--instances', type=int, nargs='+',
+                        default=DEFAULT_INSTANCES)
+    parser.add_argument('--cases', nargs='+', default=[
+        name for name, _ in CASES], choices=[name for name, _ in CASES])
+    parser.add_argument('--output', help='path to JSON file with results')
+    args = parser.parse_args()
+
+    logging.getLogger('cloudify_scalelist.benchmarks').setLevel(
+        logging.WARNING)
+    results = []
+    for count in args.instances:
+        for name in args.cases:
+            result = run_isolated(name, count)
+            print('{case}: instances: {instances}, time: {seconds:.3f}s, '
+                  'memory: {memory_kb}KB, details: {details}'
+                  .format(**result))
+            results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'python': platform.python_version(),
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': results
+            }, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare transaction lookup in scaledownlist with previous implementation.
+
+Run as:
+    python -m cloudify_scalelist.benchmarks.transactions --instances 20000
+"""
+import argparse
+import time
+
+from mock import Mock, patch
+
+import cloudify_scalelist.workflows as workflows
+
+
+class FakeInstance(object):
+
+    def __init__(self, instance_id, node_id, runtime_properties):
+        self.id = instance_id
+        self.node_id = node_id
+        self.runtime_properties = runtime_properties
+
+
+def gen_instances(count, transaction_size):
+    instances = []
+    for i in range(count):
+        instances.append(FakeInstance(
+            'node{}_{}'.format(i % 3, i), 'node{}'.format(i % 3), {
+                'name': 'name{}'.format(i),
+                '_transaction': 'transaction{}'.format(
+                    i // transaction_size)
+            }))
+    return instances
+
+
+def gen_list(instances):
+
+    def _list(_offset=0, _size=None, **kwargs):
+        if _size is None:
+            return instances
+        return instances[_offset:_offset + _size]
+
+    return _list
+
+
+def legacy_get_field_value_recursive(properties, path):
+    if not path:
+        return properties
+    key = path[0]
+    if isinstance(properties, list):
+        try:
+            return legacy_get_field_value_recursive(properties[int(key)],
+                                                    path[1:])
+        except Exception:
+            return None
+    elif isinstance(properties, dict):
+        try:
+            return legacy_get_field_value_recursive(properties[key],
+                                                    path[1:])
+        except Exception:
+            return None
+    else:
+        return None
+
+
+def legacy_get_transaction_instances(ctx, client, scale_transaction_field,
+                                     scale_node_names, scale_node_field_path,
+                                     scale_node_field_values):
+    # two full scans with recursive field search and list membership
+    # checks, as before single pass lookup
+    transaction_ids = []
+    node_instances = {}
+    instance_ids = []
+    for instance in client.node_instances.list():
+        runtime_properties = instance.runtime_properties
+        if scale_node_names and instance.node_id not in scale_node_names:
+            continue
+        value = legacy_get_field_value_recursive(runtime_properties,
+                                                 scale_node_field_path)
+        if value not in scale_node_field_values:
+            continue
+        if not node_instances.get(instance.node_id):
+            node_instances[instance.node_id] = []
+        if instance.id not in node_instances[instance.node_id]:
+            node_instances[instance.node_id].append(instance.id)
+        if instance.id not in instance_ids:
+            instance_ids.append(instance.id)
+        if runtime_properties.get(scale_transaction_field):
+            transaction_ids.append(
+                runtime_properties.get(scale_transaction_field))
+    for instance in client.node_instances.list():
+        transaction_id = instance.runtime_properties.get(
+            scale_transaction_field)
+        if transaction_id not in transaction_ids:
+            continue
+        if not node_instances.get(instance.node_id):
+            node_instances[instance.node_id] = []
+        if instance.id not in node_instances[instance.node_id]:
+            node_instances[instance.node_id].append(instance.id)
+        if instance.id not in instance_ids:
+            instance_ids.append(instance.id)
+    return node_instances, instance_ids
+
+
+def run(count, transaction_size, selected):
+    ctx = Mock()
+    ctx.deployment.id = 'benchmark'
+    client = Mock()
+    client.node_instances.list = gen_list(
+        gen_instances(count, transaction_size))
+    values = ['name{}'.format(i * transaction_size)
+              for i in range(selected)]
+    kwargs = {
+        'scale_transaction_field': '_transaction',
+        'scale_node_names': None,
+        'scale_node_field_path': ['name'],
+        'scale_node_field_values': values
+    }
+
+    started = time.time()
+    legacy = legacy_get_transaction_instances(ctx, client, **kwargs)
+    legacy_time = time.time() - started
+
+    with patch("cloudify_scalelist.workflows.get_rest_client",
+               Mock(return_value=client)):
+        started = time.time()
+        current = workflows._get_transaction_instances(
+            ctx=ctx, all_results=True, **kwargs)
+        current_time = time.time() - started
+
+    if legacy != current:
+        raise RuntimeError('Results are different.')
+
+    print('instances: {}, selected: {}, legacy: {:.3f}s, current: {:.3f}s, '
+          'speedup: {:.1f}x'.format(count, len(current[1]), legacy_time,
+                                    current_time,
+                                    legacy_time / max(current_time, 1e-6)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--instances', type=int, default=20000)
+    parser.add_argument('--transaction-size', type=int, default=10)
+    parser.add_argument('--selected', type=int, default=200,
+                        help='count of transactions for remove')
+    args = parser.parse_args()
+    run(args.instances, args.transaction_size, args.selected)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,86 @@
 #!/opt/manager/env/bin/python
+"""Remove uninitialized/deleted node instances of deployment from manager DB.
+
+Relationships to removed instances, count of node instances and scaling
+groups are updated for alive instances. Changes are committed by chunks.
+"""
+import argparse
 import sys
 from copy import deepcopy
 
-from manager_rest.flask_utils import setup_flask_app
-from manager_rest.storage import get_storage_manager, models
-from manager_rest.manager_exceptions import NotFoundError
-from manager_rest.resource_manager import ResourceManager
+# manager_rest is imported only for real cleanup, so plan_cleanup can be
+# imported (and tested) without manager environment
+
+# instances deleted/updated in one DB transaction
+CHUNK_SIZE = 500
+DELETED_STATES = ('uninitialized', 'deleted')
+
+
+def _progress(message):
+    sys.stderr.write(message + "\n")
+    sys.stderr.flush()
+
+
+def _chunks(items, chunk_size):
+    for offset in range(0, len(items), chunk_size):
+        yield items[offset:offset + chunk_size]
+
+
+def plan_cleanup(instances, scaling_groups):
+    # returns ids of instances for delete, alive instances id -> new
+    # relationships (only for changed), node id -> count of alive instances
+    # and updated scaling groups
+    alive_ids = set()
+    delete_ids = []
+    count_instances = {}
+    for instance in instances:
+        count_instances.setdefault(instance.node_id, 0)
+        if instance.state not in DELETED_STATES:
+            alive_ids.add(instance.id)
+            # update count of instances internaly
+            count_instances[instance.node_id] += 1
+        else:
+            delete_ids.append(instance.id)
+
+    # cleanup relationships only if some target is removed
+    relationships = {}
+    for instance in instances:
+        if instance.id not in alive_ids:
+            continue
+        alive_relationships = [
+            relationship for relationship in instance.relationships
+            if relationship['target_id'] in alive_ids]
+        if len(alive_relationships) != len(instance.relationships):
+            relationships[instance.id] = alive_relationships
+
+    scaling_groups = deepcopy(scaling_groups or {})
+    for scaling_group in scaling_groups.values():
+        instances_count = max([count_instances.get(node_id, 0)
+                               for node_id in scaling_group['members']] +
+                              [0])
+        scaling_group['properties']['planned_instances'] = instances_count
+        scaling_group['properties']['current_instances'] = instances_count
+
+    return delete_ids, relationships, count_instances, scaling_groups
+
+
+def _commit_by_chunks(session, objects, chunk_size, change, action):
+    # apply change for each object and commit each chunk_size objects
+    done = 0
+    for chunk in _chunks(objects, chunk_size):
+        for obj in chunk:
+            change(obj)
+        session.commit()
+        done += len(chunk)
+        _progress("{}: {}/{}".format(action, done, len(objects)))
+
 
+def cleanup_deployment(depl_id, get_all, dry_run=False,
+                       chunk_size=CHUNK_SIZE):
+    from manager_rest.flask_utils import setup_flask_app
+    from manager_rest.storage import db, get_storage_manager, models
+    from manager_rest.resource_manager import ResourceManager
 
-def cleanup_deployment(depl_id, get_all):
     with setup_flask_app().app_context():
         sm = get_storage_manager()
         params_filter = ResourceManager.create_filters_dict(
@@ -20,84 +92,79 @@ def cleanup_deployment(depl_id, get_all):
         if get_all:
             list_kwargs['get_all_results'] = True
 
-        instances = get_storage_manager().list(
-            models.NodeInstance, **list_kwargs
-        ).items
-        alive_instances = []
-        delete_instances = []
-        count_instances = {}
-        for instance in instances:
-            if instance.node_id not in count_instances:
-                count_instances[instance.node_id] = 0
-            if instance.state not in ('uninitialized', 'deleted'):
-                alive_instances.append(instance.id)
-                # update count of instances internaly
-                count_instances[instance.node_id] += 1
-            else:
-                delete_instances.append(instance.id)
-                sm.delete(instance)
-        sys.stderr.write("For save as alive: {}\n"
-                         .format(repr(alive_instances)))
-        sys.stderr.write("For delete as uninitialized: {}\n"
-                         .format(repr(delete_instances)))
-        # cleanup instances relationships
-        for instance in instances:
-            if instance.id in alive_instances:
-                sys.stderr.write("{}:Before relationships{}\n".format(
-                    instance.id, repr(instance.relationships)))
-                relationships = []
-                for relationship in instance.relationships:
-                    if relationship['target_id'] in alive_instances:
-                        relationships.append(relationship)
-                instance.relationships = relationships
-                sys.stderr.write("{}:After relationships{}\n".format(
-                    instance.id, repr(instance.relationships)))
-                sm.update(instance)
+        deployment = sm.get(models.Deployment, depl_id)
+        instances = sm.list(models.NodeInstance, **list_kwargs).items
+        _progress("Loaded instances: {}".format(len(instances)))
+
+        delete_ids, relationships, count_instances, scaling_groups = (
+            plan_cleanup(instances, deployment.scaling_groups))
+        _progress("For delete as uninitialized: {}, relationships for "
+                  "update: {}".format(len(delete_ids), len(relationships)))
+        if dry_run:
+            _progress("Instances for delete: {}".format(repr(delete_ids)))
+            _progress("Instances for relationships update: {}"
+                      .format(repr(sorted(relationships))))
+        _progress("Count instances after cleanup: {}"
+                  .format(repr(count_instances)))
+        _progress("Scaling groups before: {}"
+                  .format(repr(deployment.scaling_groups)))
+        _progress("Scaling groups after: {}".format(repr(scaling_groups)))
+
+        nodes = [node for node in
+                 sm.list(models.Node, **list_kwargs).items
+                 if node.id in count_instances and
+                 node.number_of_instances != count_instances[node.id]]
+        _progress("Nodes for update: {}"
+                  .format(repr([node.id for node in nodes])))
+
+        if dry_run:
+            _progress("Dry run, nothing changed.")
+            return
+
+        delete_ids = set(delete_ids)
+        _commit_by_chunks(
+            db.session,
+            [instance for instance in instances
+             if instance.id in relationships],
+            chunk_size,
+            lambda instance: setattr(instance, 'relationships',
+                                     relationships[instance.id]),
+            "Updated relationships")
+        _commit_by_chunks(
+            db.session,
+            [instance for instance in instances if instance.id in delete_ids],
+            chunk_size, db.session.delete, "Deleted instances")
         # cleanup nodes
-        nodes = get_storage_manager().list(models.Node, **list_kwargs).items
-        for node in nodes:
-            if node.id in count_instances:
-                node.number_of_instances = count_instances[node.id]
-                sm.update(node)
-        sys.stderr.write("Count instances after cleanup: {}\n"
-                         .format(repr(count_instances)))
-        # deployemnts update
-        deployment = sm.get(
-            models.Deployment,
-            depl_id
-        )
-        sys.stderr.write("Scaling groups before: {}\n"
-                         .format(repr(deployment.scaling_groups)))
-        scaling_groups = deepcopy(deployment.scaling_groups)
-        for scaling_group_name in scaling_groups:
-            scaling_group = scaling_groups[scaling_group_name]
-            instances_count = 0
-            for node in scaling_group['members']:
-                if instances_count < count_instances.get(node, 0):
-                    instances_count = count_instances[node]
-            scaling_group['properties']['planned_instances'] = instances_count
-            scaling_group['properties']['current_instances'] = instances_count
-        deployment.scaling_groups = scaling_groups
-        sm.update(deployment)
-        sys.stderr.write("Scaling groups after: {}\n"
-                         .format(repr(scaling_groups)))
+        _commit_by_chunks(
+            db.session, nodes, chunk_size,
+            lambda node: setattr(node, 'number_of_instances',
+                                 count_instances[node.id]),
+            "Updated nodes")
+        # deployments update
+        if scaling_groups != deployment.scaling_groups:
+            deployment.scaling_groups = scaling_groups
+            sm.update(deployment)
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2 or len(sys.argv) > 3:
-        sys.stderr.write(
-            'Usage: {prog} <deployment id> {page, all}\n'.format(
-                prog=sys.argv[0],
-            )
-        )
-        sys.exit(1)
-    depl_id = sys.argv[1]
-    get_all = False
-    if len(sys.argv) == 3 and sys.argv[2] == 'all':
-        get_all = True
+def main():
+    from manager_rest.manager_exceptions import NotFoundError
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('deployment_id')
+    parser.add_argument('results', nargs='?', choices=['page', 'all'],
+                        default='page',
+                        help='check only first page or all instances')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only show changes')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='instances updated in one transaction')
+    args = parser.parse_args()
+    depl_id = args.deployment_id
 
     try:
-        cleanup_deployment(depl_id, get_all)
+        cleanup_deployment(depl_id, args.results == 'all',
+                           dry_run=args.dry_run,
+                           chunk_size=max(args.chunk_size, 1))
     except NotFoundError:
         sys.stderr.write(
             'Could not find deployment: {depl_id}\n'.format(
@@ -116,3 +183,7 @@ if __name__ == '__main__':
     print('Successfully cleaned up deployment: {depl_id}'.format(
         depl_id=depl_id,
     ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import shutil
+import tempfile
+
+# place for save scalelist data between workflow runs, one directory per
+# deployment
+STORAGE_PATH = os.path.expanduser('~/.cloudify_scalelist')
+
+INDEX_NAME = 'index'
+# instances selected by last failed scaledownlist run
+CHECKPOINT_NAME = 'scaledown_checkpoint'
+# instances created by scaleuplist in each transaction
+MANIFEST_NAME = 'transactions'
+# directory for workflow metrics files
+METRICS_DIR = 'metrics'
+# creation time of deployment which owns saved data
+DEPLOYMENT_NAME = 'deployment'
+
+
+def get_path(deployment_id, name):
+    return os.path.join(STORAGE_PATH, deployment_id, name + '.json')
+
+
+def load(deployment_id, name, default=None):
+    path = get_path(deployment_id, name)
+    if not os.path.isfile(path):
+        return default
+    with open(path) as data_file:
+        return json.load(data_file)
+
+
+def save(deployment_id, name, data):
+    path = get_path(deployment_id, name)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # write to temporary file and replace, so we never have half saved data
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as data_file:
+        json.dump(data, data_file)
+    os.rename(temp_path, path)
+
+
+def remove(deployment_id, name):
+    path = get_path(deployment_id, name)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def check_deployment(deployment_id, created_at):
+    # deployment can be recreated with same id, drop all data saved for
+    # previous deployment
+    if not created_at:
+        return
+    data = load(deployment_id, DEPLOYMENT_NAME)
+    if data and data.get('created_at') == created_at:
+        return
+    directory = os.path.join(STORAGE_PATH, deployment_id)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    save(deployment_id, DEPLOYMENT_NAME, {'created_at': created_at})
+
+
+def _key(value):
+    return json.dumps(value, sort_keys=True)
+
+
+class InstancesIndex(object):
+    """Runtime properties field path -> field value -> instance ids."""
+
+    def __init__(self, deployment_id, fields=None):
+        self.deployment_id = deployment_id
+        self._fields = {}
+        for path_key, values in (fields or {}).items():
+            self._fields[path_key] = dict(
+                (value_key, set(instance_ids))
+                for value_key, instance_ids in values.items())
+
+    @classmethod
+    def load(cls, deployment_id):
+        data = load(deployment_id, INDEX_NAME, {})
+        return cls(deployment_id, data.get('fields'))
+
+    @classmethod
+    def exists(cls, deployment_id):
+        return os.path.isfile(get_path(deployment_id, INDEX_NAME))
+
+    def save(self):
+        save(self.deployment_id, INDEX_NAME, {
+            'fields': dict(
+                (path_key, dict(
+                    (value_key, sorted(instance_ids))
+                    for value_key, instance_ids in values.items()
+                    if instance_ids))
+                for path_key, values in self._fields.items())
+        })
+
+    @property
+    def paths(self):
+        return [json.loads(path_key) for path_key in self._fields]
+
+    def has_path(self, path):
+        return _key(path) in self._fields
+
+    def reset_path(self, path):
+        self._fields[_key(path)] = {}
+
+    def add(self, path, instance_id, value):
+        values = self._fields.get(_key(path))
+        # path is not indexed
+        if values is None:
+            return
+        # we can't compare structures by set, ignore it
+        if value is None or isinstance(value, (dict, list)):
+            return
+        values.setdefault(_key(value), set()).add(instance_id)
+
+    def lookup(self, path, values):
+        indexed = self._fields.get(_key(path), {})
+        instance_ids = set()
+        for value in values:
+            instance_ids |= indexed.get(_key(value), set())
+        return instance_ids
+
+    def discard(self, instance_ids):
+        instance_ids = set(instance_ids)
+        for values in self._fields.values():
+            for indexed_ids in values.values():
+                indexed_ids -= instance_ids
+
+
+class TransactionsManifest(object):
+    """Transaction id -> instance ids created in such transaction."""
+
+    def __init__(self, deployment_id, transactions=None):
+        self.deployment_id = deployment_id
+        self._transactions = dict(
+            (transaction_id, set(instance_ids))
+            for transaction_id, instance_ids in (transactions or {}).items())
+
+    @classmethod
+    def load(cls, deployment_id):
+        return cls(deployment_id,
+                   load(deployment_id, MANIFEST_NAME, {}).get('transactions'))
+
+    @classmethod
+    def exists(cls, deployment_id):
+        return os.path.isfile(get_path(deployment_id, MANIFEST_NAME))
+
+    def save(self):
+        save(self.deployment_id, MANIFEST_NAME, {
+            'transactions': dict(
+                (transaction_id, sorted(instance_ids))
+                for transaction_id, instance_ids in self._transactions.items()
+                if instance_ids)
+        })
+
+    def has(self, transaction_id):
+        return transaction_id in self._transactions
+
+    def add(self, transaction_id, instance_ids):
+        self._transactions.setdefault(transaction_id, set()).update(
+            instance_ids)
+
+    def lookup(self, transaction_ids):
+        instance_ids = set()
+        for transaction_id in transaction_ids:
+            instance_ids |= self._transactions.get(transaction_id, set())
+        return instance_ids
+
+    def discard(self, instance_ids):
+        instance_ids = set(instance_ids)
+        for transaction_id in list(self._transactions):
+            self._transactions[transaction_id] -= instance_ids
+            if not self._transactions[transaction_id]:
+                del self._transactions[transaction_id]
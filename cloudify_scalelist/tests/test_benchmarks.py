@@ -0,0 +1,57 @@
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+import cloudify_scalelist.benchmarks.deployments as deployments
+import cloudify_scalelist.workflows as workflows
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def tearDown(self):
+        workflows._groups_cache.clear()
+        super(TestBenchmarks, self).tearDown()
+
+    def test_gen_deployment(self):
+        ctx, client = deployments.gen_deployment(1001)
+        self.assertEqual(len(client.node_instances.list()), 1001)
+        self.assertEqual(
+            ctx.deployment.scaling_groups['server_group']['properties'],
+            {'current_instances': 500})
+        self.assertEqual(ctx.get_node('app').number_of_instances, 500)
+
+    def test_run_case(self):
+        # 100 group instances, 10 transactions
+        results = dict(
+            (name, deployments.run_case(name, 201))
+            for name, _ in deployments.CASES)
+        self.assertEqual(results['transactions']['details'],
+                         {'selected': 20})
+        self.assertEqual(results['transactions']['rest_calls'],
+                         {'node_instances.list': 1})
+        self.assertEqual(results['process_node_instances']['details'],
+                         {'subgraphs': 202, 'dependencies': 200})
+        # 10 group instances added
+        self.assertEqual(results['scaleuplist']['details'],
+                         {'subgraphs': 21, 'dependencies': 20})
+        # 1 selected transaction is removed
+        self.assertEqual(results['scaledownlist']['details'],
+                         {'subgraphs': 21, 'dependencies': 20})
+        for result in results.values():
+            self.assertEqual(result['instances'], 201)
+            self.assertTrue(result['seconds'] >= 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
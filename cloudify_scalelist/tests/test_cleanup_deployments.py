@@ -0,0 +1,87 @@
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import imp
+import os
+import unittest
+from mock import Mock
+
+SCRIPT_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'examples', 'scripts', 'cleanup_deployments.py')
+
+cleanup = imp.load_source('cleanup_deployments', SCRIPT_PATH)
+
+
+class TestCleanupDeployments(unittest.TestCase):
+
+    def _gen_instance(self, _id, node_id, state, targets=None):
+        instance = Mock()
+        instance.id = _id
+        instance.node_id = node_id
+        instance.state = state
+        instance.relationships = [{'target_id': target_id}
+                                  for target_id in (targets or [])]
+        return instance
+
+    def _gen_instances(self):
+        return [
+            self._gen_instance('a0', 'a', 'started'),
+            self._gen_instance('a1', 'a', 'uninitialized'),
+            self._gen_instance('a2', 'a', 'started'),
+            self._gen_instance('b0', 'b', 'started', ['a0']),
+            self._gen_instance('b1', 'b', 'deleted', ['a1']),
+            self._gen_instance('b2', 'b', 'started', ['a1', 'a2']),
+            self._gen_instance('c0', 'c', 'deleted')]
+
+    def test_plan_cleanup_instances(self):
+        delete_ids, relationships, count_instances, _ = cleanup.plan_cleanup(
+            self._gen_instances(), {})
+        self.assertEqual(delete_ids, ['a1', 'b1', 'c0'])
+        # only changed relationships of alive instances
+        self.assertEqual(relationships, {'b2': [{'target_id': 'a2'}]})
+        # node without alive instances is counted too
+        self.assertEqual(count_instances, {'a': 2, 'b': 2, 'c': 0})
+
+    def test_plan_cleanup_scaling_groups(self):
+        scaling_groups = {
+            'ab': {'members': ['a', 'b'],
+                   'properties': {'planned_instances': 3,
+                                  'current_instances': 3}},
+            'c': {'members': ['c'],
+                  'properties': {'planned_instances': 1,
+                                 'current_instances': 1}},
+            'other': {'members': ['unknown'],
+                      'properties': {'planned_instances': 1,
+                                     'current_instances': 1}}}
+        _, _, _, updated = cleanup.plan_cleanup(
+            self._gen_instances(), scaling_groups)
+        self.assertEqual(
+            dict((name, group['properties'])
+                 for name, group in updated.items()),
+            {'ab': {'planned_instances': 2, 'current_instances': 2},
+             'c': {'planned_instances': 0, 'current_instances': 0},
+             'other': {'planned_instances': 0, 'current_instances': 0}})
+        # original groups are untouched
+        self.assertEqual(scaling_groups['ab']['properties'],
+                         {'planned_instances': 3, 'current_instances': 3})
+
+    def test_plan_cleanup_nothing(self):
+        instances = [self._gen_instance('a0', 'a', 'started'),
+                     self._gen_instance('b0', 'b', 'started', ['a0'])]
+        self.assertEqual(cleanup.plan_cleanup(instances, None),
+                         ([], {}, {'a': 1, 'b': 1}, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
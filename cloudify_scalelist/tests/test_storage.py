@@ -0,0 +1,108 @@
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+import cloudify_scalelist.storage as storage
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        super(TestStorage, self).setUp()
+        self.storage_path = tempfile.mkdtemp()
+        self.patcher = patch(
+            "cloudify_scalelist.storage.STORAGE_PATH", self.storage_path)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.storage_path)
+        super(TestStorage, self).tearDown()
+
+    def test_load_save_remove(self):
+        self.assertEqual(storage.load('dep', 'data', {}), {})
+        storage.save('dep', 'data', {'a': [1, 2]})
+        self.assertEqual(storage.load('dep', 'data'), {'a': [1, 2]})
+        # other deployment has own data
+        self.assertIsNone(storage.load('other', 'data'))
+        storage.remove('dep', 'data')
+        self.assertIsNone(storage.load('dep', 'data'))
+        # remove of missed data is not error
+        storage.remove('dep', 'data')
+
+    def test_instances_index(self):
+        self.assertFalse(storage.InstancesIndex.exists('dep'))
+        index = storage.InstancesIndex('dep')
+        self.assertFalse(index.has_path(['name']))
+        index.reset_path(['name'])
+        self.assertTrue(index.has_path(['name']))
+        index.add(['name'], 'a', 'value')
+        index.add(['name'], 'b', 'other')
+        index.add(['name'], 'c', 'value')
+        # unsupported values and not indexed paths are ignored
+        index.add(['name'], 'd', None)
+        index.add(['name'], 'e', {'a': 'b'})
+        index.add(['other'], 'f', 'value')
+        index.save()
+
+        self.assertTrue(storage.InstancesIndex.exists('dep'))
+        index = storage.InstancesIndex.load('dep')
+        self.assertEqual(index.paths, [['name']])
+        self.assertEqual(index.lookup(['name'], ['value']), set(['a', 'c']))
+        self.assertEqual(index.lookup(['name'], ['value', 'other']),
+                         set(['a', 'b', 'c']))
+        self.assertEqual(index.lookup(['other'], ['value']), set())
+
+        index.discard(['a', 'b'])
+        self.assertEqual(index.lookup(['name'], ['value', 'other']),
+                         set(['c']))
+
+    def test_check_deployment(self):
+        storage.save('dep', 'data', {'a': 'b'})
+        # unknown creation time, nothing to compare
+        storage.check_deployment('dep', None)
+        self.assertEqual(storage.load('dep', 'data'), {'a': 'b'})
+        # data without deployment time is removed
+        storage.check_deployment('dep', 'first')
+        self.assertIsNone(storage.load('dep', 'data'))
+        storage.save('dep', 'data', {'a': 'b'})
+        storage.check_deployment('dep', 'first')
+        self.assertEqual(storage.load('dep', 'data'), {'a': 'b'})
+        # recreated deployment
+        storage.check_deployment('dep', 'second')
+        self.assertIsNone(storage.load('dep', 'data'))
+
+    def test_transactions_manifest(self):
+        self.assertFalse(storage.TransactionsManifest.exists('dep'))
+        manifest = storage.TransactionsManifest('dep')
+        manifest.add('t1', ['a', 'b'])
+        manifest.add('t2', ['c'])
+        manifest.save()
+
+        self.assertTrue(storage.TransactionsManifest.exists('dep'))
+        manifest = storage.TransactionsManifest.load('dep')
+        self.assertTrue(manifest.has('t1'))
+        self.assertFalse(manifest.has('t3'))
+        self.assertEqual(manifest.lookup(['t1', 't3']), set(['a', 'b']))
+
+        manifest.discard(['a', 'c'])
+        self.assertEqual(manifest.lookup(['t1', 't2']), set(['b']))
+        self.assertFalse(manifest.has('t2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,20 +11,49 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import Queue
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 from mock import Mock, patch, call
 
 from cloudify.mocks import MockCloudifyContext
 from cloudify.state import current_ctx
+from cloudify.workflows.tasks import HandlerResult, LocalWorkflowTask
+from cloudify.workflows.tasks_graph import TaskDependencyGraph
 from cloudify.workflows.workflow_api import ExecutionCancelled
+from cloudify_rest_client.exceptions import CloudifyClientError
+from cloudify_rest_client.responses import ListResponse
 
+import cloudify_scalelist.storage as storage
 import cloudify_scalelist.workflows as workflows
 
 
+def _list_response(items, total=None):
+    # list response of REST client with pagination metadata
+    return ListResponse(items, {'pagination': {
+        'total': len(items) if total is None else total,
+        'offset': 0, 'size': len(items)}})
+
+
 class TestScaleList(unittest.TestCase):
 
+    def setUp(self):
+        super(TestScaleList, self).setUp()
+        # checkpoints and indexes are saved in temporary directory
+        self.storage_path = tempfile.mkdtemp()
+        self.storage_patcher = patch(
+            "cloudify_scalelist.storage.STORAGE_PATH", self.storage_path)
+        self.storage_patcher.start()
+
     def tearDown(self):
+        self.storage_patcher.stop()
+        shutil.rmtree(self.storage_path)
         current_ctx.clear()
+        workflows._groups_cache.clear()
         super(TestScaleList, self).tearDown()
 
     def _gen_rest_client(self):
@@ -57,8 +86,8 @@ class TestScaleList(unittest.TestCase):
         }
 
         client = Mock()
-        client.node_instances.list = Mock(return_value=[
-            instance_a, instance_b, instance_c, instance_d])
+        client.node_instances.list = Mock(return_value=_list_response([
+            instance_a, instance_b, instance_c, instance_d]))
         client.deployments.get = Mock(return_value={
             'groups': {
                 'one_scale': {
@@ -154,6 +183,152 @@ class TestScaleList(unittest.TestCase):
             runtime_properties={'a': 'c', 'd': 'e'}, version=2)
         client.node_instances.get.assert_called_with('target')
 
+    def test_update_runtime_properties_nothing_changed(self):
+        client = self._gen_rest_client()
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            self.assertEqual(
+                workflows._update_runtime_properties(
+                    self._gen_ctx(),
+                    'target',
+                    {'a': 'b'}
+                ), {'a': 'b', 'd': 'e'})
+        client.node_instances.update.assert_not_called()
+
+    def test_updatelist(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        fake_update_bulk = Mock(return_value=[])
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            with patch(
+                "cloudify_scalelist.workflows._update_runtime_properties_bulk",
+                fake_update_bulk
+            ):
+                # wrong values
+                with self.assertRaises(ValueError):
+                    workflows.updatelist(
+                        ctx=_ctx, node_field='name', node_field_value='other',
+                        node_properties=['a'])
+                with self.assertRaises(ValueError):
+                    workflows.updatelist(
+                        ctx=_ctx, instances_properties={'a_id': 'b'})
+                # nothing to update
+                workflows.updatelist(ctx=_ctx)
+                fake_update_bulk.assert_not_called()
+                # instance from other deployment
+                instances = client.node_instances.list()
+                client.node_instances.list = Mock(
+                    return_value=_list_response(instances[:1]))
+                with self.assertRaises(ValueError):
+                    workflows.updatelist(
+                        ctx=_ctx,
+                        instances_properties={'a_id': {'a': 'c'},
+                                              'other_id': {'e': 'f'}})
+                client.node_instances.list.assert_called_with(
+                    id=['a_id', 'other_id'], _size=2,
+                    _include=['runtime_properties', 'node_id', 'id'],
+                    deployment_id='deployment_id', sort='id')
+                fake_update_bulk.assert_not_called()
+                client.node_instances.list = Mock(
+                    return_value=_list_response(instances))
+
+                workflows.updatelist(
+                    ctx=_ctx,
+                    instances_properties={'a_id': {'a': 'c'},
+                                          'c_id': {'e': 'f'}},
+                    node_ids=['b_type', 'c_type'],
+                    node_field='name', node_field_value='other',
+                    node_properties={'e': 'g', 'h': 'i'})
+        fake_update_bulk.assert_called_with(_ctx, [
+            ('a_id', {'a': 'c'}),
+            ('b_id', {'e': 'g', 'h': 'i'}),
+            # instance specific values override values by filter
+            ('c_id', {'e': 'f', 'h': 'i'})])
+
+    def test_update_runtime_properties_conflict(self):
+        client = self._gen_rest_client()
+        client.node_instances.update = Mock(side_effect=[
+            CloudifyClientError('conflict', status_code=409), None])
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            workflows._update_runtime_properties(
+                self._gen_ctx(),
+                'target',
+                {'a': 'c'}
+            )
+        self.assertEqual(client.node_instances.update.call_count, 2)
+
+        # unexpected error
+        client.node_instances.update = Mock(
+            side_effect=CloudifyClientError('broken', status_code=500))
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            with self.assertRaises(CloudifyClientError):
+                workflows._update_runtime_properties(
+                    self._gen_ctx(),
+                    'target',
+                    {'a': 'c'}
+                )
+        self.assertEqual(client.node_instances.update.call_count, 1)
+
+    def test_update_runtime_properties_bulk(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        fake_update_instances = Mock(return_value=None)
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            with patch(
+                "cloudify_scalelist.workflows._update_runtime_properties",
+                fake_update_instances
+            ):
+                workflows._update_runtime_properties_bulk(_ctx, [])
+                fake_update_instances.assert_not_called()
+
+                workflows._update_runtime_properties_bulk(
+                    _ctx, [('a', {'b': 'c'}), ('d', {'e': 'f'}),
+                           ('g', {'h': 'i'})],
+                    workers=2, batch_size=2)
+        fake_update_instances.assert_has_calls([
+            call(_ctx, 'a', {'b': 'c'}, client),
+            call(_ctx, 'd', {'e': 'f'}, client),
+            call(_ctx, 'g', {'h': 'i'}, client)], any_order=True)
+        self.assertEqual(fake_update_instances.call_count, 3)
+
+    def test_update_runtime_properties_bulk_thread_context(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        main_thread = threading.current_thread()
+
+        def _get_rest_client():
+            # workflow context is available only in workflow thread
+            if threading.current_thread() is not main_thread:
+                raise RuntimeError('No context set in current thread')
+            return client
+
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            _get_rest_client
+        ):
+            self.assertEqual(
+                workflows._update_runtime_properties_bulk(
+                    _ctx, [('a', {'a': 'c'}), ('d', {'a': 'b'})],
+                    workers=2),
+                [('a', {'a': 'c', 'd': 'e'}), ('d', {'a': 'b', 'd': 'e'})])
+        client.node_instances.update.assert_called_once_with(
+            node_instance_id='a', runtime_properties={'a': 'c', 'd': 'e'},
+            version=2)
+
     def test_cleanup_instances(self):
         client = self._gen_rest_client()
         with patch(
@@ -168,6 +343,96 @@ class TestScaleList(unittest.TestCase):
             runtime_properties={}, version=2)
         client.node_instances.get.assert_called_with('target')
 
+    def test_cleanup_instances_delta(self):
+        client = self._gen_rest_client()
+        target_node = client.node_instances.get.return_value
+        target_node.state = 'uninitialized'
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            # only runtime properties are changed
+            workflows._cleanup_instances(
+                self._gen_ctx(), ['target']
+            )
+            client.node_instances.update.assert_called_once_with(
+                node_instance_id='target', runtime_properties={}, version=2)
+
+            # only state is changed
+            client.node_instances.update.reset_mock()
+            target_node.state = 'started'
+            target_node.runtime_properties = {}
+            workflows._cleanup_instances(
+                self._gen_ctx(), ['target']
+            )
+            client.node_instances.update.assert_called_once_with(
+                node_instance_id='target', state='uninitialized', version=2)
+
+            # already cleaned up
+            client.node_instances.update.reset_mock()
+            target_node.state = 'uninitialized'
+            workflows._cleanup_instances(
+                self._gen_ctx(), ['target']
+            )
+            client.node_instances.update.assert_not_called()
+
+    def test_collect_metrics(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        nested_metrics = []
+
+        @workflows._collect_metrics('fake')
+        def _fake_workflow(ctx, fail=False, nested=False, **kwargs):
+            with workflows._phase('lookup'):
+                workflows._get_rest_client().node_instances.get('target')
+                workflows._get_rest_client().node_instances.get('target')
+            if nested:
+                # other workflow in same process, has own metrics
+                thread = threading.Thread(
+                    target=lambda: nested_metrics.append(
+                        workflows._current_metrics()))
+                thread.start()
+                thread.join()
+            if fail:
+                raise ValueError('broken')
+            return 'result'
+
+        def _load_metrics(name):
+            return storage.load('deployment_id',
+                                os.path.join(storage.METRICS_DIR, name))
+
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            self.assertEqual(
+                _fake_workflow(_ctx, nested=True,
+                               metrics_file='metrics.json'),
+                'result')
+            self.assertEqual(nested_metrics, [None])
+            summary = _load_metrics('metrics')
+            self.assertEqual(summary['workflow'], 'fake')
+            self.assertEqual(summary['status'], 'succeeded')
+            self.assertEqual(summary['rest_calls'],
+                             {'node_instances.get': 2})
+            self.assertEqual(sorted(summary['phases']), ['lookup'])
+            client.node_instances.get.assert_called_with('target')
+
+            # failed workflow, still have metrics, only file name is used
+            with self.assertRaises(ValueError):
+                _fake_workflow(_ctx, fail=True,
+                               metrics_file='/etc/metrics')
+            self.assertEqual(_load_metrics('metrics')['status'], 'failed')
+            self.assertFalse(os.path.exists('/etc/metrics'))
+
+        # not counted outside of workflow
+        self.assertIsNone(workflows._current_metrics())
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            self.assertEqual(workflows._get_rest_client(), client)
+
     def test_empty_scaleup_params(self):
         with self.assertRaises(ValueError):
             workflows.scaleuplist(ctx=Mock(),
@@ -194,7 +459,7 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=['runtime_properties', 'node_id', 'id'],
-                _get_all_results=True,
+                sort='id', _offset=0, _size=1000,
                 deployment_id='deployment_id')
         # only first page
         client.node_instances.list = Mock(return_value=[])
@@ -210,6 +475,7 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=['runtime_properties', 'node_id', 'id'],
+                sort='id', _offset=0, _size=1000,
                 deployment_id='deployment_id')
 
     def test_scaleup_group_to_settings(self):
@@ -320,7 +586,8 @@ class TestScaleList(unittest.TestCase):
             fake_run_scale.assert_called_with(
                 _ctx, {'one_scale': {'instances': 11}},
                 {'one': [{'name': 'one'}]}, '_transaction',
-                'transaction_value', False, False, node_sequence=None)
+                'transaction_value', False, False, node_sequence=None,
+                max_parallel_instances=0)
             # can downscale without errors, ignore failure
             fake_run_scale = Mock(return_value=None)
             with patch(
@@ -338,7 +605,83 @@ class TestScaleList(unittest.TestCase):
             fake_run_scale.assert_called_with(
                 _ctx, {'one_scale': {'instances': 11}},
                 {'one': [{'name': 'one'}]}, '_transaction',
-                'transaction_value', False, True, node_sequence=None)
+                'transaction_value', False, True, node_sequence=None,
+                max_parallel_instances=0)
+
+    def test_entity_properties_file(self):
+        entity_dir = tempfile.mkdtemp()
+        entity_path = os.path.join(entity_dir, 'entities.jsonl')
+        try:
+            with open(entity_path, 'w') as entity_output:
+                entity_output.write('{"one": {"name": "one0"}}\n'
+                                    '{"two": {"name": "two0"}}\n'
+                                    '\n'
+                                    '{"one": {"name": "one1"}}\n')
+            entity_file = workflows._EntityPropertiesFile(entity_path)
+            one_reader = entity_file.get('one')
+            self.assertTrue(one_reader)
+            self.assertEqual(one_reader.pop(), {'name': 'one0'})
+            # same reader for next wave
+            self.assertEqual(entity_file.get('one').pop(), {'name': 'one1'})
+            self.assertFalse(one_reader)
+            with self.assertRaises(IndexError):
+                one_reader.pop()
+            self.assertFalse(entity_file.get('three'))
+
+            # wrong values
+            with open(entity_path, 'w') as entity_output:
+                entity_output.write('{"one": {"name": "one0"}}\n'
+                                    '{"one": ["secret"]}\n'
+                                    'secret\n')
+            with self.assertRaises(ValueError) as error:
+                list(workflows._EntityPropertiesFile(
+                    entity_path).iter_items())
+            self.assertNotIn('secret', str(error.exception))
+            self.assertIn('line 2', str(error.exception))
+        finally:
+            shutil.rmtree(entity_dir)
+
+    def test_scaleuplist_properties_file(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        entity_dir = tempfile.mkdtemp()
+        resource_path = os.path.join(entity_dir, 'resource')
+        with open(resource_path, 'w') as entity_output:
+            entity_output.write('{"one": {"name": "one0"}}\n'
+                                '{"two": {"name": "two0"}}\n'
+                                '{"one": {"name": "one1"}}\n')
+        _ctx.internal = Mock()
+        _ctx.internal.handler.download_deployment_resource = Mock(
+            return_value=resource_path)
+        try:
+            with patch(
+                "cloudify_scalelist.workflows.get_rest_client",
+                Mock(return_value=client)
+            ):
+                # only one source of properties
+                with self.assertRaises(ValueError):
+                    workflows.scaleuplist(
+                        ctx=_ctx,
+                        scalable_entity_properties={'one': [{}]},
+                        scalable_entity_properties_file='entities.jsonl')
+
+                fake_run_scale = Mock(return_value=None)
+                with patch(
+                    "cloudify_scalelist.workflows._run_scale_settings",
+                    fake_run_scale
+                ):
+                    # blueprint resource, removed after workflow
+                    workflows.scaleuplist(
+                        ctx=_ctx,
+                        scalable_entity_properties_file='entities.jsonl')
+                    settings, entity_file = fake_run_scale.call_args[0][1:3]
+                    self.assertEqual(settings,
+                                     {'one_scale': {'instances': 12}})
+                    _ctx.internal.handler.download_deployment_resource.\
+                        assert_called_with('entities.jsonl')
+                    self.assertFalse(os.path.isfile(resource_path))
+        finally:
+            shutil.rmtree(entity_dir)
 
     def test_run_scale_settings(self):
         _ctx = self._gen_ctx()
@@ -397,6 +740,37 @@ class TestScaleList(unittest.TestCase):
         _ctx._get_modification.finish.assert_called_with()
         _ctx._get_modification.rollback.assert_not_called()
 
+    def test_run_scale_settings_already_uninstalled(self):
+        _ctx = self._gen_ctx()
+
+        uninstalled_instance = Mock()
+        uninstalled_instance._node_instance.id = "a"
+        uninstalled_instance.modification = 'removed'
+        delete_instance = Mock()
+        delete_instance._node_instance.id = "b"
+        delete_instance.modification = 'removed'
+        _ctx._get_modification.removed.node_instances = [
+            uninstalled_instance, delete_instance]
+        scale_settings = {'a': {
+            'instances': 0,
+            'removed_ids_include_hint': []}}
+        fake_uninstall_instances = Mock()
+        with patch(
+            "cloudify_scalelist.workflows._uninstall_instances",
+            fake_uninstall_instances
+        ), patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=self._gen_rest_client())
+        ):
+            workflows._run_scale_settings(_ctx, scale_settings, {},
+                                          uninstalled_ids=['a'])
+        # only removed from deployment
+        fake_uninstall_instances.assert_called_with(
+            ctx=_ctx, graph=_ctx.graph_mode(),
+            removed=set([delete_instance]), ignore_failure=False,
+            related=set(), node_sequence=None, max_parallel_instances=None)
+        _ctx._get_modification.finish.assert_called_with()
+
     def test_run_scale_settings_wrongids_uninstall(self):
         _ctx = self._gen_ctx()
 
@@ -477,7 +851,8 @@ class TestScaleList(unittest.TestCase):
                     removed=set([added_instance]),
                     related=set([related_instance]),
                     ignore_failure=False,
-                    node_sequence=None)
+                    node_sequence=None,
+                    max_parallel_instances=None)
             fake_install_node_instances.assert_called_with(
                 graph=_ctx.graph_mode(),
                 node_instances=set([added_instance]),
@@ -616,6 +991,36 @@ class TestScaleList(unittest.TestCase):
                         ):
                             self.assertRaises(RuntimeError)
 
+    def test_wait_for_sent_tasks(self):
+        _ctx = self._gen_ctx(False)
+        graph = _ctx.graph_mode()
+        finished_task = Mock()
+        finished_task.get_state.return_value = 'succeeded'
+        sent_task = Mock()
+        sent_task.get_state.return_value = 'sent'
+        # first wait is timeouted, second one gets notification
+        sent_task.wait_for_terminated = Mock(
+            side_effect=[Queue.Empty(), None])
+        graph._terminated_tasks.return_value = [finished_task]
+        graph.tasks_iter.return_value = [finished_task, sent_task]
+        workflows._wait_for_sent_tasks(_ctx, graph, time.time() + 10)
+        self.assertEqual(sent_task.wait_for_terminated.call_count, 2)
+        self.assertEqual(graph._handle_terminated_task.call_args_list, [
+            call(finished_task), call(sent_task)])
+        # only one check of all tasks
+        graph.tasks_iter.assert_called_once_with()
+
+        # no time for wait
+        graph._handle_terminated_task.reset_mock()
+        workflows._wait_for_sent_tasks(_ctx, graph, time.time() - 1)
+        graph._handle_terminated_task.assert_not_called()
+
+        # cancel while wait
+        graph._is_execution_cancelled.side_effect = [False, True]
+        sent_task.wait_for_terminated = Mock(side_effect=Queue.Empty())
+        with self.assertRaises(ExecutionCancelled):
+            workflows._wait_for_sent_tasks(_ctx, graph, time.time() + 10)
+
     def test_run_scale_settings_install(self):
         _ctx = self._gen_ctx()
 
@@ -660,7 +1065,8 @@ class TestScaleList(unittest.TestCase):
                         )
                     fake_update_instances.assert_called_with(
                         _ctx, "a", {'c': 'f',
-                                    '_transaction': 'transaction_id'})
+                                    '_transaction': 'transaction_id'},
+                        client)
                 fake_uninstall_instances.assert_not_called()
             fake_install_node_instances.assert_called_with(
                 graph=_ctx.graph_mode(),
@@ -673,6 +1079,38 @@ class TestScaleList(unittest.TestCase):
         _ctx._get_modification.rollback.assert_not_called()
         _ctx._get_modification.finish.assert_called_with()
 
+    def test_run_scale_settings_install_chunks(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        added = []
+        for instance_id in ['a', 'b', 'c']:
+            added_instance = Mock()
+            added_instance._node_instance.id = instance_id
+            added_instance._node_instance.node_id = "type_a"
+            added_instance.modification = 'added'
+            added.append(added_instance)
+        _ctx._get_modification.added.node_instances = added
+        fake_update_bulk = Mock(return_value=[])
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ), patch(
+            "cloudify_scalelist.workflows.lifecycle.install_node_instances",
+            Mock()
+        ), patch(
+            "cloudify_scalelist.workflows._update_runtime_properties_bulk",
+            fake_update_bulk
+        ), patch(
+            "cloudify_scalelist.workflows.RUNTIME_UPDATE_CHUNK", 2
+        ):
+            workflows._run_scale_settings(
+                _ctx, {'a': {'instances': 3}},
+                {"type_a": [{"c": "f"}, {"c": "g"}, {"c": "h"}]})
+        # properties are written before all instances are read
+        self.assertEqual(
+            [len(args[1]) for args, _ in fake_update_bulk.call_args_list],
+            [2, 1])
+
     def test_run_scale_settings_install_withtransacrtion_id(self):
         _ctx = self._gen_ctx()
 
@@ -717,7 +1155,8 @@ class TestScaleList(unittest.TestCase):
                             scale_transaction_value='value'
                         )
                     fake_update_instances.assert_called_with(
-                        _ctx, "a", {'c': 'f', '_transaction': 'value'})
+                        _ctx, "a", {'c': 'f', '_transaction': 'value'},
+                        client)
                 fake_uninstall_instances.assert_not_called()
             fake_install_node_instances.assert_called_with(
                 graph=_ctx.graph_mode(),
@@ -729,6 +1168,10 @@ class TestScaleList(unittest.TestCase):
         )
         _ctx._get_modification.rollback.assert_not_called()
         _ctx._get_modification.finish.assert_called_with()
+        # new instances are saved in transactions manifest
+        self.assertEqual(
+            storage.TransactionsManifest.load('deployment_id').lookup(
+                ['value']), set(['a']))
 
     def test_run_scale_settings_install_scalelist(self):
         _ctx = self._gen_ctx()
@@ -774,7 +1217,8 @@ class TestScaleList(unittest.TestCase):
                             node_sequence=['a', 'b']
                         )
                     fake_update_instances.assert_called_with(
-                        _ctx, "a", {'c': 'f', '_transaction': 'value'})
+                        _ctx, "a", {'c': 'f', '_transaction': 'value'},
+                        client)
                 fake_uninstall_instances.assert_not_called()
 
             call_func = workflows.lifecycle.install_node_instance_subgraph
@@ -784,7 +1228,8 @@ class TestScaleList(unittest.TestCase):
                 ignore_failure=False,
                 node_instance_subgraph_func=call_func,
                 node_instances=set([added_instance]),
-                node_sequence=['a', 'b']
+                node_sequence=['a', 'b'],
+                max_parallel_instances=None
             )
         _ctx.deployment.start_modification.assert_called_with(
             scale_settings
@@ -819,6 +1264,127 @@ class TestScaleList(unittest.TestCase):
             call(added_instance, graph, ignore_failure=False),
             call(related_instance, graph, ignore_failure=False)])
 
+    def test_process_node_instances_barrier(self):
+        _ctx = self._gen_ctx()
+
+        node_instances = []
+        for instance_id, node_id in [("a1", "type_a"), ("a2", "type_a"),
+                                     ("f1", "type_f"), ("f2", "type_f"),
+                                     ("f3", "type_f"), ("g1", "type_g")]:
+            node_instance = Mock()
+            node_instance.id = instance_id
+            node_instance._node_instance.id = instance_id
+            node_instance._node_instance.node_id = node_id
+            node_instances.append(node_instance)
+
+        graph = _ctx.graph_mode()
+        workflows._process_node_instances(
+            ctx=_ctx,
+            graph=graph,
+            ignore_failure=False,
+            node_instances=node_instances,
+            node_instance_subgraph_func=(
+                lambda instance, graph, ignore_failure: instance.id),
+            node_sequence=["type_a", "type_f", "type_g"])
+
+        barrier = _ctx._subgraph[0]
+        self.assertEqual(barrier.instance_id, "subgraphscale_barrier_type_f")
+        # 2 + 3 dependencies by barrier, and 3 without barrier for last
+        # level with one instance
+        self.assertEqual(graph.add_dependency.call_args_list, [
+            call("a1", barrier), call("a2", barrier),
+            call(barrier, "f1"), call(barrier, "f2"), call(barrier, "f3"),
+            call("f1", "g1"), call("f2", "g1"), call("f3", "g1")])
+
+    def test_process_node_instances_max_parallel(self):
+        _ctx = self._gen_ctx()
+
+        node_instances = []
+        for instance_id, node_id in [("a1", "type_a"), ("f1", "type_f"),
+                                     ("f2", "type_f"), ("x1", "type_x")]:
+            node_instance = Mock()
+            node_instance.id = instance_id
+            node_instance._node_instance.id = instance_id
+            node_instance._node_instance.node_id = node_id
+            node_instances.append(node_instance)
+
+        graph = _ctx.graph_mode()
+        workflows._process_node_instances(
+            ctx=_ctx,
+            graph=graph,
+            ignore_failure=False,
+            node_instances=node_instances,
+            node_instance_subgraph_func=(
+                lambda instance, graph, ignore_failure: instance.id),
+            node_sequence=["type_a", "type_f"],
+            max_parallel_instances=2)
+
+        self.assertEqual(graph.add_dependency.call_args_list, [
+            # levels
+            call("a1", "f1"), call("a1", "f2"),
+            # limits, type_f is run before type_a
+            call("a1", "f1"), call("x1", "f2")])
+
+    def test_limit_parallel_subgraphs(self):
+        graph = Mock()
+        workflows._limit_parallel_subgraphs(graph, ['a', 'b', 'c'], 0)
+        graph.add_dependency.assert_not_called()
+        workflows._limit_parallel_subgraphs(graph, ['a', 'b', 'c', 'd', 'e'],
+                                            2)
+        self.assertEqual(graph.add_dependency.call_args_list, [
+            call('c', 'a'), call('d', 'b'), call('e', 'c')])
+
+    def _gen_related_instances(self):
+        # c -> b -> a, d without relationships
+        instances = {}
+        for instance_id, targets in [('c', ['b']), ('a', []),
+                                     ('b', ['a', 'external']), ('d', [])]:
+            instance = Mock()
+            instance.id = instance_id
+            instance.relationships = []
+            for target_id in targets:
+                relationship = Mock()
+                relationship.target_id = target_id
+                instance.relationships.append(relationship)
+            instances[instance_id] = instance
+        return instances
+
+    def test_sort_by_relationships(self):
+        instances = self._gen_related_instances()
+        self.assertEqual(
+            [instance.id for instance in workflows._sort_by_relationships(
+                instances.values(), True)],
+            ['a', 'd', 'b', 'c'])
+        self.assertEqual(
+            [instance.id for instance in workflows._sort_by_relationships(
+                instances.values(), False)],
+            ['c', 'd', 'b', 'a'])
+
+        # cycle
+        instances['a'].relationships = instances['c'].relationships
+        with self.assertRaises(ValueError):
+            workflows._sort_by_relationships(instances.values(), True)
+
+    def test_limited_lifecycle_processor(self):
+        instances = self._gen_related_instances()
+        graph = Mock()
+        with patch(
+            "cloudify_scalelist.workflows.lifecycle.LifecycleProcessor"
+            "._finish_subgraphs"
+        ) as fake_finish_subgraphs:
+            processor = workflows._LimitedLifecycleProcessor(
+                2, graph=graph, node_instances=set(instances.values()))
+            processor._finish_subgraphs(
+                subgraphs=dict((instance_id, 'sub_' + instance_id)
+                               for instance_id in instances),
+                intact_op='establish', install=True)
+        fake_finish_subgraphs.assert_called_with(
+            subgraphs={'a': 'sub_a', 'b': 'sub_b', 'c': 'sub_c',
+                       'd': 'sub_d'},
+            intact_op='establish', install=True)
+        self.assertEqual(graph.add_dependency.call_args_list, [
+            call('sub_b', 'sub_a'), call('sub_c', 'sub_d')])
+
     def test_scaledownlist_with_anytype_and_without_transaction(self):
         _ctx = self._gen_ctx()
 
@@ -845,7 +1411,367 @@ class TestScaleList(unittest.TestCase):
                         'removed_ids_include_hint': ['a_id']
                     }
                 }, {}, instances_remove_ids=['a_id'],
-                ignore_failure=False, node_sequence=None)
+                ignore_failure=False, node_sequence=None,
+                max_parallel_instances=0, uninstalled_ids=[])
+
+    def test_split_scale_settings(self):
+        _ctx = self._gen_ctx()
+        fake_node = Mock()
+        fake_node.number_of_instances = 3
+        _ctx.get_node = Mock(return_value=fake_node)
+        scale_settings = {
+            'alfa_types': {
+                'instances': 50,
+                'removed_ids_include_hint': ['a_id']
+            },
+            'node': {
+                'instances': 1,
+                'removed_ids_include_hint': ['b_id']
+            }
+        }
+        # without batch size, everything in one modification
+        self.assertEqual(
+            workflows._split_scale_settings(_ctx, scale_settings, 0),
+            [scale_settings])
+        self.assertEqual(
+            workflows._split_scale_settings(_ctx, scale_settings, 3), [{
+                'alfa_types': {
+                    'instances': 52,
+                    'removed_ids_include_hint': ['a_id']
+                }
+            }, {
+                'alfa_types': {
+                    'instances': 50,
+                    'removed_ids_include_hint': ['a_id']
+                },
+                'node': {
+                    'instances': 2,
+                    'removed_ids_include_hint': ['b_id']
+                }
+            }, {
+                'node': {
+                    'instances': 1,
+                    'removed_ids_include_hint': ['b_id']
+                }
+            }])
+        _ctx.get_node.assert_called_with('node')
+        # scale up
+        self.assertEqual(
+            workflows._split_scale_settings(
+                _ctx, {'one_scale': {'instances': 13}}, 2),
+            [{'one_scale': {'instances': 12}},
+             {'one_scale': {'instances': 13}}])
+
+    def test_scaleuplist_waves(self):
+        _ctx = MockCloudifyContext(deployment_id="deployment_id",
+                                   execution_id="execution_id")
+        _ctx.deployment.scaling_groups = {
+            'one_scale': {
+                'members': ['one'],
+                'properties': {'current_instances': 10}
+            }
+        }
+        client = self._gen_rest_client()
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            fake_run_scale = Mock(return_value=None)
+            with patch(
+                "cloudify_scalelist.workflows._run_scale_settings",
+                fake_run_scale
+            ):
+                workflows.scaleuplist(
+                    ctx=_ctx,
+                    scale_transaction_field="_transaction",
+                    scalable_entity_properties={
+                        'one': [{'name': 'one'}, {'name': 'two'},
+                                {'name': 'three'}],
+                    },
+                    batch_size=2)
+        # all waves use same transaction
+        properties = {'one': [{'name': 'one'}, {'name': 'two'},
+                              {'name': 'three'}]}
+        fake_run_scale.assert_has_calls([
+            call(_ctx, {'one_scale': {'instances': 12}}, properties,
+                 '_transaction', 'execution_id', False, True,
+                 node_sequence=None,
+                 max_parallel_instances=0),
+            call(_ctx, {'one_scale': {'instances': 13}}, properties,
+                 '_transaction', 'execution_id', False, True,
+                 node_sequence=None,
+                 max_parallel_instances=0)])
+
+    def test_scaledownlist_waves_failure(self):
+        _ctx = self._gen_ctx()
+        _ctx.deployment.scaling_groups['alfa_types']['properties'][
+            'current_instances'] = 2
+        client = self._gen_rest_client()
+        instances = client.node_instances.list()
+        # both instances in same node
+        instances[1].node_id = 'a_type'
+        client.node_instances.list = Mock(side_effect=[
+            # search instances
+            instances,
+            # check instances after first wave
+            _list_response([instances[1]])])
+        a_instance = Mock()
+        a_instance.id = "a_id"
+        b_instance = Mock()
+        b_instance.id = "b_id"
+        a_node = Mock()
+        a_node.instances = [a_instance, b_instance]
+        _ctx.nodes = [a_node]
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            # first wave is finished, second is failed
+            fake_run_scale = Mock(side_effect=[None, ValueError("Failed")])
+            fake_uninstall_instances = Mock(return_value=None)
+            with patch(
+                "cloudify_scalelist.workflows._run_scale_settings",
+                fake_run_scale
+            ):
+                with patch(
+                    "cloudify_scalelist.workflows._uninstall_instances",
+                    fake_uninstall_instances
+                ):
+                    workflows.scaledownlist(
+                        ctx=_ctx,
+                        scale_transaction_field='_transaction',
+                        scale_node_name="a_type", scale_node_field="name",
+                        scale_node_field_value="value",
+                        batch_size=1)
+        self.assertEqual(fake_run_scale.call_count, 2)
+        fake_run_scale.assert_called_with(
+            _ctx, {
+                'alfa_types': {
+                    'instances': 0,
+                    'removed_ids_include_hint': ['a_id', 'b_id']
+                }
+            }, {}, instances_remove_ids=['a_id', 'b_id'],
+            ignore_failure=False, node_sequence=None,
+            max_parallel_instances=0, uninstalled_ids=[])
+        client.node_instances.list.assert_called_with(
+            _include=['runtime_properties', 'node_id', 'id'],
+            sort='id', id=['a_id', 'b_id'], _size=2,
+            deployment_id='deployment_id')
+        # only instance from failed wave
+        fake_uninstall_instances.assert_called_with(
+            ctx=_ctx,
+            graph=_ctx.graph_mode(),
+            removed=[b_instance],
+            related=[],
+            ignore_failure=False, node_sequence=None,
+            max_parallel_instances=0)
+
+    def _gen_scale_nodes(self, _ctx):
+        # 'one' is member of 'one_scale' group with 10 instances and
+        # contains two 'child' instances per 'one' instance
+        one_node = Mock()
+        one_node.id = 'one'
+        one_node.host_node = None
+        one_node.number_of_instances = 10
+        one_node.relationships = []
+        child_node = Mock()
+        child_node.id = 'child'
+        child_node.host_node = one_node
+        child_node.number_of_instances = 20
+        child_node.relationships = [Mock()]
+        other_node = Mock()
+        other_node.id = 'other'
+        other_node.host_node = None
+        other_node.number_of_instances = 3
+        other_node.relationships = []
+        nodes = {'one': one_node, 'child': child_node, 'other': other_node}
+        _ctx.nodes = [one_node, child_node, other_node]
+        _ctx.get_node = Mock(side_effect=nodes.get)
+
+    def test_estimate_scale_graph(self):
+        _ctx = self._gen_ctx()
+        self._gen_scale_nodes(_ctx)
+        self.assertEqual(
+            workflows._estimate_scale_instances(
+                _ctx, {'one_scale': {'instances': 12},
+                       'other': {'instances': 1}}),
+            {'one': 2, 'child': 4, 'other': 2})
+        # 2 * 15 + 4 * (15 + 6) tasks
+        self.assertEqual(
+            workflows._estimate_scale_graph(_ctx, {'one': 2, 'child': 4},
+                                            True),
+            (114, 118))
+        # 2 * 9 + 4 * (9 + 2) tasks, levels and parallel limit
+        self.assertEqual(
+            workflows._estimate_scale_graph(
+                _ctx, {'one': 2, 'child': 4}, False,
+                node_sequence=['child', 'one'], max_parallel_instances=2),
+            (62, 76))
+
+    def test_scaleuplist_dry_run(self):
+        _ctx = self._gen_ctx()
+        self._gen_scale_nodes(_ctx)
+        client = self._gen_rest_client()
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            fake_run_scale = Mock(return_value=None)
+            with patch(
+                "cloudify_scalelist.workflows._run_scale_settings",
+                fake_run_scale
+            ):
+                plan = workflows.scaleuplist(
+                    ctx=_ctx,
+                    scalable_entity_properties={
+                        'one': [{'name': 'one'}, {'name': 'two'}],
+                    },
+                    batch_size=1,
+                    dry_run=True)
+        fake_run_scale.assert_not_called()
+        _ctx.deployment.start_modification.assert_not_called()
+        self.assertEqual(sorted(plan['phases']),
+                         ['estimate', 'scale_list', 'scale_settings'])
+        del plan['phases']
+        self.assertEqual(plan, {
+            'scale_settings': {'one_scale': {'instances': 12}},
+            'waves': 2,
+            'instances': {'one': 2, 'child': 4},
+            'tasks': 114,
+            'dependencies': 118})
+
+    def test_scaledownlist_resume(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        instances = client.node_instances.list()
+        a_instance = Mock()
+        a_instance.id = "a_id"
+        b_instance = Mock()
+        b_instance.id = "b_id"
+        a_node = Mock()
+        a_node.instances = [a_instance, b_instance]
+        _ctx.nodes = [a_node]
+        params = {
+            'scale_transaction_field': '_transaction',
+            'scale_node_name': ['a_type'],
+            'scale_node_field': ['name'],
+            'scale_node_field_value': ['value'],
+            'all_results': False
+        }
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            # failed run, instances are uninstalled
+            fake_run_scale = Mock(side_effect=ValueError("Failed"))
+            fake_uninstall_instances = Mock(return_value=None)
+            with patch(
+                "cloudify_scalelist.workflows._run_scale_settings",
+                fake_run_scale
+            ):
+                with patch(
+                    "cloudify_scalelist.workflows._uninstall_instances",
+                    fake_uninstall_instances
+                ):
+                    workflows.scaledownlist(
+                        ctx=_ctx,
+                        scale_transaction_field='_transaction',
+                        scale_node_name="a_type", scale_node_field="name",
+                        scale_node_field_value="value")
+            checkpoint = storage.load('deployment_id',
+                                      storage.CHECKPOINT_NAME)
+            self.assertTrue(checkpoint.pop('saved_at') <= time.time())
+            self.assertEqual(checkpoint, {
+                'params': params,
+                'instance_ids': ['a_id', 'b_id'],
+                'uninstalled_ids': ['a_id', 'b_id']})
+
+            # resume, 'a_id' is removed by someone else, properties are
+            # already cleaned up, so we can't search instances by value
+            client.node_instances.list = Mock(
+                return_value=_list_response([instances[1]]))
+            fake_run_scale = Mock(return_value=None)
+            with patch(
+                "cloudify_scalelist.workflows._run_scale_settings",
+                fake_run_scale
+            ):
+                workflows.scaledownlist(
+                    ctx=_ctx,
+                    scale_transaction_field='_transaction',
+                    scale_node_name="a_type", scale_node_field="name",
+                    scale_node_field_value="value", resume=True)
+            client.node_instances.list.assert_called_once_with(
+                id=['a_id', 'b_id'], _size=2,
+                _include=['runtime_properties', 'node_id', 'id'],
+                deployment_id='deployment_id', sort='id')
+            fake_run_scale.assert_called_with(
+                _ctx, {
+                    'alfa_types': {
+                        'instances': 54,
+                        'removed_ids_include_hint': ['b_id']
+                    }
+                }, {}, instances_remove_ids=['b_id'],
+                ignore_failure=False, node_sequence=None,
+                max_parallel_instances=0, uninstalled_ids=['b_id'])
+            # checkpoint is removed after success
+            self.assertIsNone(
+                storage.load('deployment_id', storage.CHECKPOINT_NAME))
+
+    def test_load_scaledown_checkpoint_expired(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            workflows._save_scaledown_checkpoint(_ctx, {'a': 'b'}, ['a_id'],
+                                                 [])
+            # other search parameters
+            self.assertIsNone(workflows._load_scaledown_checkpoint(
+                _ctx, {'a': 'c'}))
+            self.assertEqual(
+                workflows._load_scaledown_checkpoint(_ctx, {'a': 'b'})[1],
+                ['a_id'])
+            # too old checkpoint is removed
+            with patch("cloudify_scalelist.workflows.CHECKPOINT_TTL", -1):
+                self.assertIsNone(workflows._load_scaledown_checkpoint(
+                    _ctx, {'a': 'b'}))
+            self.assertIsNone(
+                storage.load('deployment_id', storage.CHECKPOINT_NAME))
+
+    def test_scaledownlist_dry_run(self):
+        _ctx = self._gen_ctx()
+        _ctx.get_node = Mock(return_value=None)
+        client = self._gen_rest_client()
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            fake_run_scale = Mock(return_value=None)
+            with patch(
+                "cloudify_scalelist.workflows._run_scale_settings",
+                fake_run_scale
+            ):
+                plan = workflows.scaledownlist(
+                    ctx=_ctx,
+                    scale_transaction_field='_transaction',
+                    scale_node_name="a_type", scale_node_field="name",
+                    scale_node_field_value="value",
+                    dry_run=True)
+        fake_run_scale.assert_not_called()
+        _ctx.deployment.start_modification.assert_not_called()
+        self.assertEqual(sorted(plan['phases']),
+                         ['estimate', 'scale_list', 'scale_settings',
+                          'transactions'])
+        self.assertEqual(plan['scale_settings'], {
+            'alfa_types': {
+                'instances': 54,
+                'removed_ids_include_hint': ['a_id', 'b_id']
+            }
+        })
+        self.assertEqual(plan['removed_ids'], ['a_id', 'b_id'])
+        self.assertEqual(plan['instances'], {'a_type': 1, 'b_type': 1})
+        self.assertEqual(plan['waves'], 1)
 
     def test_scaledownlist(self):
         _ctx = self._gen_ctx()
@@ -874,7 +1800,8 @@ class TestScaleList(unittest.TestCase):
                         'removed_ids_include_hint': ['a_id', 'b_id']
                     }
                 }, {}, instances_remove_ids=['a_id', 'b_id'],
-                ignore_failure=False, node_sequence=None)
+                ignore_failure=False, node_sequence=None,
+                max_parallel_instances=0, uninstalled_ids=[])
 
             # we have downscale issues
             fake_run_scale = Mock(side_effect=ValueError("No Down Scale!"))
@@ -920,7 +1847,8 @@ class TestScaleList(unittest.TestCase):
                     graph=_ctx.graph_mode(),
                     removed=[a_instance, b_instance],
                     related=[],
-                    ignore_failure=False, node_sequence=None)
+                    ignore_failure=False, node_sequence=None,
+                    max_parallel_instances=0)
             fake_run_scale.assert_called_with(
                 _ctx, {
                     'alfa_types': {
@@ -928,7 +1856,8 @@ class TestScaleList(unittest.TestCase):
                         'removed_ids_include_hint': ['a_id', 'b_id']
                     }
                 }, {}, instances_remove_ids=['a_id', 'b_id'],
-                ignore_failure=False, node_sequence=None)
+                ignore_failure=False, node_sequence=None,
+                max_parallel_instances=0, uninstalled_ids=[])
 
     def test_deployments_get_groups(self):
         _ctx = self._gen_ctx()
@@ -952,6 +1881,60 @@ class TestScaleList(unittest.TestCase):
                     }
                 })
 
+    def test_deployments_get_groups_cached(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            groups = workflows._deployments_get_groups(ctx=_ctx)
+            self.assertEqual(workflows._deployments_get_groups(ctx=_ctx),
+                             groups)
+            # only scaling groups, 'any' is not scaling group
+            self.assertEqual(workflows._get_node_groups(ctx=_ctx), {
+                'a_type': 'alfa_types',
+                'b_type': 'alfa_types',
+                'one': 'one_scale',
+                'two': 'one_scale'})
+            workflows._get_scale_list(
+                ctx=_ctx,
+                scalable_entity_properties={'one': [{'name': 'one'}]},
+                property_type=dict)
+            client.deployments.get.assert_called_once_with(
+                'deployment_id', _include=['groups', 'created_at'])
+
+            # other execution
+            _ctx = MockCloudifyContext(deployment_id="deployment_id",
+                                       execution_id="other")
+            _ctx.deployment.scaling_groups = {}
+            self.assertEqual(workflows._get_node_groups(ctx=_ctx), {})
+            self.assertEqual(client.deployments.get.call_count, 2)
+
+    def test_get_node_groups_cache_cleared(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        deployments_get = workflows._deployments_get
+
+        def _deployments_get(ctx):
+            # other execution in same worker replaces cache
+            cached = deployments_get(ctx)
+            workflows._groups_cache.clear()
+            return cached
+
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ), patch(
+            "cloudify_scalelist.workflows._deployments_get",
+            _deployments_get
+        ):
+            self.assertEqual(workflows._get_node_groups(ctx=_ctx), {
+                'a_type': 'alfa_types',
+                'b_type': 'alfa_types',
+                'one': 'one_scale',
+                'two': 'one_scale'})
+
     def test_get_scale_list(self):
         _ctx = self._gen_ctx()
         client = self._gen_rest_client()
@@ -1090,6 +2073,195 @@ class TestScaleList(unittest.TestCase):
                     False
                 )
 
+    def test_iter_node_instances_fields(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        instances = client.node_instances.list()
+        client.node_instances.list = Mock(side_effect=[
+            _list_response(instances[:2], 4),
+            _list_response(instances[2:], 4)])
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            self.assertEqual(
+                list(workflows._iter_node_instances_fields(
+                    _ctx, [workflows._compile_field_path(['name']),
+                           workflows._compile_field_path(['_transaction'])],
+                    page_size=2)),
+                [('a_id', 'a_type', ['value', '1']),
+                 ('b_id', 'b_type', ['other', '1']),
+                 ('c_id', 'c_type', ['other', '-']),
+                 ('b_id', 'c_type', ['other', None])])
+        client.node_instances.list.assert_has_calls([
+            call(_include=['runtime_properties', 'node_id', 'id'],
+                 sort='id', _offset=0, _size=2,
+                 deployment_id='deployment_id'),
+            call(_include=['runtime_properties', 'node_id', 'id'],
+                 sort='id', _offset=2, _size=2,
+                 deployment_id='deployment_id')])
+
+        # manager returns less instances than requested
+        client.node_instances.list = Mock(side_effect=[
+            _list_response(instances[:2], 4),
+            _list_response(instances[2:], 4)])
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            self.assertEqual(
+                len(list(workflows._iter_node_instances_fields(
+                    _ctx, [], page_size=10))), 4)
+        client.node_instances.list.assert_called_with(
+            _include=['runtime_properties', 'node_id', 'id'],
+            sort='id', _offset=2, _size=10, deployment_id='deployment_id')
+
+        # only first page
+        client.node_instances.list = Mock(side_effect=[
+            _list_response(instances[:2], 4),
+            _list_response(instances[2:], 4)])
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            self.assertEqual(
+                list(workflows._iter_node_instances_fields(
+                    _ctx, [workflows._compile_field_path(['name'])],
+                    page_size=2, all_results=False)),
+                [('a_id', 'a_type', ['value']),
+                 ('b_id', 'b_type', ['other'])])
+        self.assertEqual(client.node_instances.list.call_count, 1)
+
+    def test_iter_node_instances_fields_ids(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        client.node_instances.list = Mock(return_value=[])
+        instance_ids = ['id{:03}'.format(i) for i in range(150)]
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            with patch("cloudify_scalelist.workflows.ID_FILTER_SIZE", 100):
+                list(workflows._iter_node_instances_fields(
+                    _ctx, [], page_size=1000, instance_ids=instance_ids))
+        # ids are requested by small chunks independent of page size
+        client.node_instances.list.assert_has_calls([
+            call(id=instance_ids[:100], _size=100,
+                 _include=['runtime_properties', 'node_id', 'id'],
+                 deployment_id='deployment_id', sort='id'),
+            call(id=instance_ids[100:], _size=50,
+                 _include=['runtime_properties', 'node_id', 'id'],
+                 deployment_id='deployment_id', sort='id')])
+        self.assertEqual(client.node_instances.list.call_count, 2)
+
+    def test_check_storage(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        client.deployments.get = Mock(return_value={
+            'groups': {}, 'created_at': 'first'})
+        storage.InstancesIndex('deployment_id', {'a': {}}).save()
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            # data saved before without deployment time is not trusted
+            workflows._check_storage(_ctx)
+            self.assertFalse(storage.InstancesIndex.exists('deployment_id'))
+            storage.InstancesIndex('deployment_id', {'a': {}}).save()
+            workflows._check_storage(_ctx)
+            self.assertTrue(storage.InstancesIndex.exists('deployment_id'))
+
+            # deployment recreated with same id
+            client.deployments.get = Mock(return_value={
+                'groups': {}, 'created_at': 'second'})
+            _ctx = MockCloudifyContext(deployment_id="deployment_id",
+                                       execution_id="other")
+            workflows._check_storage(_ctx)
+            self.assertFalse(storage.InstancesIndex.exists('deployment_id'))
+
+    def test_scaledownlist_check_storage(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        client.deployments.get = Mock(return_value={
+            'groups': {}, 'created_at': 'second'})
+        client.node_instances.list = Mock(return_value=[])
+        # manifest of previous deployment with same id
+        storage.check_deployment('deployment_id', 'first')
+        storage.TransactionsManifest('deployment_id', {'1': ['a_id']}).save()
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            with patch(
+                "cloudify_scalelist.workflows.storage.TransactionsManifest."
+                "load"
+            ) as load:
+                workflows.scaledownlist(
+                    ctx=_ctx,
+                    scale_transaction_field='_transaction',
+                    scale_node_name="node", scale_node_field="name",
+                    scale_node_field_value="value")
+        load.assert_not_called()
+        self.assertFalse(
+            storage.TransactionsManifest.exists('deployment_id'))
+
+    def test_get_transaction_instances_manifest(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        instances = client.node_instances.list()
+        client.node_instances.list = Mock(side_effect=[
+            # search selected instances
+            instances,
+            # members of transaction from manifest
+            _list_response(instances[:2])])
+        manifest = storage.TransactionsManifest('deployment_id', {
+            # 'x_id' is already removed
+            '1': ['a_id', 'b_id', 'x_id']})
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            self.assertEqual(
+                workflows._get_transaction_instances(
+                    ctx=_ctx,
+                    all_results=True,
+                    scale_transaction_field='_transaction',
+                    scale_node_names=["a_type"],
+                    scale_node_field_path=["name"],
+                    scale_node_field_values=["value"],
+                    manifest=manifest
+                ), ({
+                    'a_type': ['a_id'],
+                    'b_type': ['b_id']
+                }, ['a_id', 'b_id'])
+            )
+        client.node_instances.list.assert_called_with(
+            id=['a_id', 'b_id', 'x_id'], _size=3,
+            _include=['runtime_properties', 'node_id', 'id'],
+            deployment_id='deployment_id', sort='id')
+
+    def test_update_transactions_manifest(self):
+        _ctx = self._gen_ctx()
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=self._gen_rest_client())
+        ):
+            # nothing to save
+            workflows._update_transactions_manifest(_ctx, None, [], ['a'])
+            self.assertFalse(
+                storage.TransactionsManifest.exists('deployment_id'))
+            workflows._update_transactions_manifest(_ctx, 't1', ['a', 'b'],
+                                                    [])
+            workflows._update_transactions_manifest(_ctx, 't2', ['c'],
+                                                    ['a'])
+            manifest = storage.TransactionsManifest.load('deployment_id')
+            self.assertEqual(manifest.lookup(['t1']), set(['b']))
+            self.assertEqual(manifest.lookup(['t2']), set(['c']))
+            # removed transactions are dropped
+            workflows._update_transactions_manifest(_ctx, None, [], ['b'])
+            manifest = storage.TransactionsManifest.load('deployment_id')
+            self.assertFalse(manifest.has('t1'))
+
     def test_get_transaction_instances_nosuch(self):
         _ctx = self._gen_ctx()
         client = self._gen_rest_client()
@@ -1111,7 +2283,7 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=['runtime_properties', 'node_id', 'id'],
-                _get_all_results=True,
+                sort='id', _offset=0, _size=1000,
                 deployment_id='deployment_id')
         # get only first page
         client.node_instances.list = Mock(return_value=[])
@@ -1130,6 +2302,7 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=['runtime_properties', 'node_id', 'id'],
+                sort='id', _offset=0, _size=1000,
                 deployment_id='deployment_id')
 
     def test_get_transaction_instances_notransaction(self):
@@ -1143,7 +2316,8 @@ class TestScaleList(unittest.TestCase):
             'name': 'value'
         }
         # get all instances
-        client.node_instances.list = Mock(return_value=[instance_a])
+        client.node_instances.list = Mock(
+            return_value=_list_response([instance_a]))
         with patch(
             "cloudify_scalelist.workflows.get_rest_client",
             Mock(return_value=client)
@@ -1159,10 +2333,11 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=['runtime_properties', 'node_id', 'id'],
-                _get_all_results=True,
+                sort='id', _offset=0, _size=1000,
                 deployment_id='deployment_id')
         # get only first page
-        client.node_instances.list = Mock(return_value=[instance_a])
+        client.node_instances.list = Mock(
+            return_value=_list_response([instance_a]))
         with patch(
             "cloudify_scalelist.workflows.get_rest_client",
             Mock(return_value=client)
@@ -1177,6 +2352,7 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=['runtime_properties', 'node_id', 'id'],
+                sort='id', _offset=0, _size=1000,
                 deployment_id='deployment_id')
 
     def test_get_transaction_instances_notransaction_field(self):
@@ -1190,7 +2366,8 @@ class TestScaleList(unittest.TestCase):
             'name': 'value'
         }
         # get all instances
-        client.node_instances.list = Mock(return_value=[instance_a])
+        client.node_instances.list = Mock(
+            return_value=_list_response([instance_a]))
         with patch(
             "cloudify_scalelist.workflows.get_rest_client",
             Mock(return_value=client)
@@ -1206,10 +2383,11 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=['runtime_properties', 'node_id', 'id'],
-                _get_all_results=True,
+                sort='id', _offset=0, _size=1000,
                 deployment_id='deployment_id')
         # get only first page
-        client.node_instances.list = Mock(return_value=[instance_a])
+        client.node_instances.list = Mock(
+            return_value=_list_response([instance_a]))
         with patch(
             "cloudify_scalelist.workflows.get_rest_client",
             Mock(return_value=client)
@@ -1224,6 +2402,7 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=['runtime_properties', 'node_id', 'id'],
+                sort='id', _offset=0, _size=1000,
                 deployment_id='deployment_id')
 
     def test_get_transaction_instances(self):
@@ -1247,6 +2426,143 @@ class TestScaleList(unittest.TestCase):
                 }, ['a_id', 'b_id'])
             )
 
+    def test_get_transaction_instances_several_transactions(self):
+        _ctx = self._gen_ctx()
+        instances = []
+        for instance_id, transaction, name in [('x', 't1', 'other'),
+                                               ('y', 't2', 'value'),
+                                               ('z', 't1', 'value'),
+                                               ('w', 't3', 'other'),
+                                               ('v', 't2', 'other')]:
+            instance = Mock()
+            instance.id = instance_id
+            instance.node_id = 'a_type'
+            instance.runtime_properties = {
+                'name': name,
+                '_transaction': transaction
+            }
+            instances.append(instance)
+        client = self._gen_rest_client()
+        client.node_instances.list = Mock(
+            return_value=_list_response(instances))
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            self.assertEqual(
+                workflows._get_transaction_instances(
+                    ctx=_ctx,
+                    scale_transaction_field='_transaction',
+                    scale_node_names=None,
+                    scale_node_field_path=["name"],
+                    scale_node_field_values=["value"]
+                ), ({
+                    'a_type': ['y', 'z', 'x', 'v'],
+                }, ['y', 'z', 'x', 'v'])
+            )
+        # only one request to list instances
+        self.assertEqual(client.node_instances.list.call_count, 1)
+
+    def test_get_transaction_instances_index(self):
+        _ctx = self._gen_ctx()
+        instances = {}
+        for instance_id, transaction, name in [('x', 't1', 'other'),
+                                               ('y', 't2', 'value'),
+                                               ('z', 't1', 'value'),
+                                               ('w', 't3', 'other'),
+                                               ('v', 't2', 'other')]:
+            instance = Mock()
+            instance.id = instance_id
+            instance.node_id = 'a_type'
+            instance.runtime_properties = {
+                'name': name,
+                '_transaction': transaction
+            }
+            instances[instance_id] = instance
+
+        def _fake_list(**kwargs):
+            return _list_response([instances[instance_id]
+                                   for instance_id in sorted(kwargs['id'])])
+
+        client = self._gen_rest_client()
+        client.node_instances.list = Mock(side_effect=_fake_list)
+
+        index = Mock()
+        index.lookup = Mock(side_effect=[
+            # 'x' has stale value in index, must be skipped
+            set(['x', 'y', 'z']),
+            set(['x', 'y', 'z', 'v'])])
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            self.assertEqual(
+                workflows._get_transaction_instances(
+                    ctx=_ctx,
+                    scale_transaction_field='_transaction',
+                    scale_node_names=None,
+                    scale_node_field_path=["name"],
+                    scale_node_field_values=["value"],
+                    index=index
+                ), ({
+                    'a_type': ['y', 'z', 'x', 'v'],
+                }, ['y', 'z', 'x', 'v'])
+            )
+        index.lookup.assert_has_calls([
+            call(['name'], ['value']),
+            call(['_transaction'], set(['t1', 't2']))])
+        # instance 'w' has never been requested
+        for list_call in client.node_instances.list.call_args_list:
+            self.assertNotIn('w', list_call[1]['id'])
+
+    def test_instances_index_update(self):
+        _ctx = self._gen_ctx()
+        storage_path = tempfile.mkdtemp()
+        client = self._gen_rest_client()
+        instance = Mock()
+        instance.id = 'a_id'
+        instance.runtime_properties = {'name': 'value'}
+        client.node_instances.list = Mock(
+            return_value=_list_response([instance]))
+        try:
+            with patch(
+                "cloudify_scalelist.storage.STORAGE_PATH", storage_path
+            ), patch(
+                "cloudify_scalelist.workflows.get_rest_client",
+                Mock(return_value=client)
+            ):
+                # index is not created, nothing to update
+                workflows._update_instances_index(_ctx, [
+                    ('b_id', {'name': 'value'})])
+                self.assertFalse(
+                    storage.InstancesIndex.exists(_ctx.deployment.id))
+
+                with patch(
+                    "cloudify_scalelist.workflows.get_rest_client",
+                    Mock(return_value=client)
+                ):
+                    index = workflows._get_instances_index(_ctx, [['name']])
+                    self.assertEqual(index.lookup(['name'], ['value']),
+                                     set(['a_id']))
+                    # index is reused without scan
+                    workflows._get_instances_index(_ctx, [['name']])
+                    self.assertEqual(client.node_instances.list.call_count,
+                                     1)
+
+                workflows._update_instances_index(_ctx, [
+                    ('b_id', {'name': 'value'}),
+                    ('a_id', {'name': 'other'})])
+                index = storage.InstancesIndex.load(_ctx.deployment.id)
+                self.assertEqual(index.lookup(['name'], ['value']),
+                                 set(['b_id']))
+
+                workflows._discard_instances_index(_ctx, ['b_id'])
+                index = storage.InstancesIndex.load(_ctx.deployment.id)
+                self.assertEqual(index.lookup(['name'], ['value', 'other']),
+                                 set(['a_id']))
+        finally:
+            shutil.rmtree(storage_path)
+
     def test_uninstall_instances_relationships(self):
         _ctx = self._gen_ctx()
         a_instance = Mock()
@@ -1325,54 +2641,83 @@ class TestScaleList(unittest.TestCase):
             ignore_failure=True,
             node_instance_subgraph_func=call_func,
             node_instances=[a_instance, b_instance],
-            node_sequence=['b', 'a']
+            node_sequence=['b', 'a'],
+            max_parallel_instances=None
         )
         _ctx.graph_mode().remove_task.assert_called_with('task1')
 
-    def test_get_field_value_recursive(self):
-        _ctx = self._gen_ctx()
+    def test_compile_field_path(self):
         # check list
         self.assertEqual(
             'a',
-            workflows._get_field_value_recursive(
-                _ctx, ['a'], ['0'])
+            workflows._compile_field_path(['0'])(['a'])
         )
         # not in list
         self.assertEqual(
             None,
-            workflows._get_field_value_recursive(
-                _ctx, ['a'], ['1'])
+            workflows._compile_field_path(['1'])(['a'])
         )
         # check dict
         self.assertEqual(
             'a',
-            workflows._get_field_value_recursive(
-                _ctx, {'0': 'a'}, ['0'])
+            workflows._compile_field_path(['0'])({'0': 'a'})
         )
         # not in dict
         self.assertEqual(
             None,
-            workflows._get_field_value_recursive(
-                _ctx, {'0': 'a'}, ['1'])
+            workflows._compile_field_path(['1'])({'0': 'a'})
         )
         # check dict in list
         self.assertEqual(
             'b',
-            workflows._get_field_value_recursive(
-                _ctx, [{'a': 'b'}], ['0', 'a'])
+            workflows._compile_field_path(['0', 'a'])([{'a': 'b'}])
         )
-        # check dict in list
+        # not dict or list
+        self.assertEqual(
+            None,
+            workflows._compile_field_path(['1', 'a'])('a')
+        )
+
+        # empty path
+        self.assertEqual(
+            {'a': 'b'},
+            workflows._compile_field_path([])({'a': 'b'})
+        )
+        # wrong index
         self.assertEqual(
             None,
-            workflows._get_field_value_recursive(
-                _ctx, 'a', ['1', 'a'])
+            workflows._compile_field_path(['a'])(['b'])
         )
 
+    def test_compile_values_matcher(self):
+        match_value = workflows._compile_values_matcher(
+            ['a', 1, {'b': 'c'}])
+        self.assertTrue(match_value('a'))
+        self.assertTrue(match_value(1))
+        self.assertTrue(match_value({'b': 'c'}))
+        self.assertFalse(match_value('b'))
+        self.assertFalse(match_value(None))
+        self.assertFalse(match_value(['a']))
+
     def test_filter_node_instances(self):
-        # everything empty
         _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        rest_instance = Mock()
+        rest_instance.id = 'a'
+        rest_instance.node_id = 'a'
+        rest_instance.runtime_properties = {}
+        client.node_instances.list = Mock(
+            return_value=_list_response([rest_instance]))
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            self._check_filter_node_instances(_ctx, rest_instance)
+
+    def _check_filter_node_instances(self, _ctx, rest_instance):
+        # everything empty
         self.assertEqual(
-            workflows._filter_node_instances(
+            list(workflows._filter_node_instances(
                 ctx=_ctx,
                 node_ids=[],
                 node_instance_ids=[],
@@ -1380,7 +2725,7 @@ class TestScaleList(unittest.TestCase):
                 operation='a.b.c',
                 node_field_path=['a'],
                 node_field_value=['b']
-            ),
+            )),
             []
         )
         # no such operation
@@ -1390,11 +2735,10 @@ class TestScaleList(unittest.TestCase):
         node.id = 'a'
         instance = Mock()
         instance.id = 'a'
-        instance._node_instance.runtime_properties = {}
         node.instances = [instance]
         _ctx.nodes = [node]
         self.assertEqual(
-            workflows._filter_node_instances(
+            list(workflows._filter_node_instances(
                 ctx=_ctx,
                 node_ids=[],
                 node_instance_ids=[],
@@ -1402,13 +2746,13 @@ class TestScaleList(unittest.TestCase):
                 operation='a.b.c',
                 node_field_path=['a'],
                 node_field_value=['b']
-            ),
+            )),
             []
         )
         # no such field
         node.operations = ['c.b.a', 'a.b.c']
         self.assertEqual(
-            workflows._filter_node_instances(
+            list(workflows._filter_node_instances(
                 ctx=_ctx,
                 node_ids=[],
                 node_instance_ids=[],
@@ -1416,13 +2760,13 @@ class TestScaleList(unittest.TestCase):
                 operation='a.b.c',
                 node_field_path=['a'],
                 node_field_value=['b']
-            ),
+            )),
             []
         )
         # we have such value
-        instance._node_instance.runtime_properties = {'a': 'b'}
+        rest_instance.runtime_properties = {'a': 'b'}
         self.assertEqual(
-            workflows._filter_node_instances(
+            list(workflows._filter_node_instances(
                 ctx=_ctx,
                 node_ids=[],
                 node_instance_ids=[],
@@ -1430,13 +2774,13 @@ class TestScaleList(unittest.TestCase):
                 operation='a.b.c',
                 node_field_path=['a'],
                 node_field_value=['b']
-            ),
+            )),
             [instance]
         )
         # we have such value, but wrong instance_id
         instance.id = 'c'
         self.assertEqual(
-            workflows._filter_node_instances(
+            list(workflows._filter_node_instances(
                 ctx=_ctx,
                 node_ids=[],
                 node_instance_ids=['a'],
@@ -1444,13 +2788,13 @@ class TestScaleList(unittest.TestCase):
                 operation='a.b.c',
                 node_field_path=['a'],
                 node_field_value=['b']
-            ),
+            )),
             []
         )
         # we have such value, but wrong node_id
         node.id = 'c'
         self.assertEqual(
-            workflows._filter_node_instances(
+            list(workflows._filter_node_instances(
                 ctx=_ctx,
                 node_ids=['a'],
                 node_instance_ids=[],
@@ -1458,13 +2802,13 @@ class TestScaleList(unittest.TestCase):
                 operation='a.b.c',
                 node_field_path=['a'],
                 node_field_value=['b']
-            ),
+            )),
             []
         )
         # we have such value, but wrong type
         node.type_hierarchy = ['c_type']
         self.assertEqual(
-            workflows._filter_node_instances(
+            list(workflows._filter_node_instances(
                 ctx=_ctx,
                 node_ids=[],
                 node_instance_ids=[],
@@ -1472,10 +2816,44 @@ class TestScaleList(unittest.TestCase):
                 operation='a.b.c',
                 node_field_path=['a'],
                 node_field_value=['b']
-            ),
+            )),
             []
         )
 
+    def test_filter_node_instances_types(self):
+        _ctx = self._gen_ctx()
+        nodes = []
+        for node_id, type_hierarchy in [('a', ['root', 'a_type']),
+                                        ('b', ['root', 'b_type']),
+                                        ('c', ['root', 'a_type', 'c_type'])]:
+            node = Mock()
+            node.id = node_id
+            node.type_hierarchy = type_hierarchy
+            node.operations = {'a.b.c': {}}
+            node_instance = Mock()
+            node_instance.id = node_id + '_id'
+            node.instances = [node_instance]
+            nodes.append(node)
+        _ctx.nodes = nodes
+        self.assertEqual(workflows._get_type_nodes(nodes), {
+            'root': nodes, 'a_type': [nodes[0], nodes[2]],
+            'b_type': [nodes[1]], 'c_type': [nodes[2]]})
+
+        filtered = workflows._filter_node_instances(
+            ctx=_ctx, node_ids=['c', 'b'], node_instance_ids=[],
+            type_names=['c_type', 'a_type'], operation='a.b.c',
+            node_field_path=[], node_field_value=[])
+        # iterator, instances are checked only on request
+        self.assertFalse(isinstance(filtered, list))
+        self.assertEqual([instance.id for instance in filtered], ['c_id'])
+
+        self.assertEqual(
+            [instance.id for instance in workflows._filter_node_instances(
+                ctx=_ctx, node_ids=[], node_instance_ids=['b_id', 'a_id'],
+                type_names=['root'], operation='a.b.c',
+                node_field_path=[], node_field_value=[])],
+            ['a_id', 'b_id'])
+
     def test_execute_operation(self):
         _ctx = self._gen_ctx()
         # fake instance
@@ -1504,21 +2882,232 @@ class TestScaleList(unittest.TestCase):
         # context lists
         _ctx.node_instances = [instance_a, instance_b]
         _ctx.nodes = [node_a, node_b]
+        # runtime properties in manager
+        client = self._gen_rest_client()
+        rest_instance_a = Mock()
+        rest_instance_a.id = 'a'
+        rest_instance_a.node_id = 'a'
+        rest_instance_a.runtime_properties = {'c': 'd'}
+        rest_instance_b = Mock()
+        rest_instance_b.id = 'b'
+        rest_instance_b.node_id = 'b'
+        rest_instance_b.runtime_properties = {'a': 'b'}
+        client.node_instances.list = Mock(return_value=_list_response(
+            [rest_instance_a, rest_instance_b]))
         # run executions
-        workflows.execute_operation(
-            ctx=_ctx,
-            operation='a.b.c',
-            operation_kwargs={'c': 'f'},
-            allow_kwargs_override=True,
-            run_by_dependency_order=True,
-            type_names=[],
-            node_ids=[],
-            node_instance_ids=[],
-            node_field='a',
-            node_field_value='b'
-        )
-        _ctx._graph.add_dependency.assert_called_with(_ctx._subgraph[1],
-                                                      _ctx._subgraph[0])
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            workflows.execute_operation(
+                ctx=_ctx,
+                operation='a.b.c',
+                operation_kwargs={'c': 'f'},
+                allow_kwargs_override=True,
+                run_by_dependency_order=True,
+                type_names=[],
+                node_ids=[],
+                node_instance_ids=[],
+                node_field='a',
+                node_field_value='b',
+                page_size=10
+            )
+        client.node_instances.list.assert_called_with(
+            _include=['runtime_properties', 'node_id', 'id'],
+            sort='id', _offset=0, _size=10,
+            deployment_id='deployment_id')
+        # 'a' is not selected and it is not between selected instances
+        self.assertEqual(len(_ctx._subgraph), 1)
+        _ctx._graph.add_dependency.assert_not_called()
+
+    def _gen_instances_list(self, relationships):
+        instances = []
+        for instance_id, targets in relationships:
+            instance = Mock()
+            instance.id = instance_id
+            instance.relationships = []
+            for target_id in targets:
+                relationship = Mock()
+                relationship.target_id = target_id
+                instance.relationships.append(relationship)
+            instances.append(instance)
+        return instances
+
+    def _batches_ids(self, batches):
+        return [[instance.id for instance in batch] for batch in batches]
+
+    def test_split_operation_batches_indirect(self):
+        # a -> c -> b, c is not selected
+        instances = self._gen_instances_list([
+            ('a', ['c']), ('c', ['b']), ('b', [])])
+        selected = [instances[0], instances[2]]
+        self.assertEqual(
+            self._batches_ids(workflows._split_operation_batches(
+                selected, 1, 0, True, instances)),
+            [['b'], ['a']])
+
+    def test_split_operation_batches(self):
+        instances = self._gen_instances_list([
+            ('c', ['b']), ('b', ['a']), ('a', []), ('d', []), ('e', [])])
+        _ids = self._batches_ids
+
+        self.assertEqual(
+            _ids(workflows._split_operation_batches(instances, 0, 0, False)),
+            [['c', 'b', 'a', 'd', 'e']])
+        self.assertEqual(
+            _ids(workflows._split_operation_batches(instances, 2, 0, False)),
+            [['c', 'b'], ['a', 'd'], ['e']])
+        # dependency order, targets first
+        self.assertEqual(
+            _ids(workflows._split_operation_batches(instances, 2, 0, True)),
+            [['a', 'd'], ['e', 'b'], ['c']])
+        # 50% of 5 instances
+        self.assertEqual(
+            _ids(workflows._split_operation_batches(instances, 0, 50,
+                                                    False)),
+            [['c', 'b', 'a'], ['d', 'e']])
+
+    def _gen_operation_ctx(self):
+        _ctx = self._gen_ctx()
+        node = Mock()
+        node.type_hierarchy = ['a_type']
+        node.operations = ["a.b.c", "a.b.check"]
+        node.id = 'a'
+        node.instances = []
+        for instance_id in ['a1', 'a2', 'a3']:
+            instance = Mock()
+            instance.id = instance_id
+            instance.node_id = 'a'
+            instance.relationships = []
+            node.instances.append(instance)
+        _ctx.node_instances = node.instances
+        _ctx.nodes = [node]
+        return _ctx
+
+    def test_execute_operation_batches(self):
+        _ctx = self._gen_operation_ctx()
+
+        def _execute():
+            # fail first subgraph in batch
+            subgraph = _ctx._subgraph[-1]
+            subgraph.name = subgraph.instance_id
+            subgraph.tasks = {'task': 'operation'}
+            subgraph.on_failure(subgraph)
+            subgraph.remove_task.assert_called_with('operation')
+
+        _ctx._graph.execute = Mock(side_effect=_execute)
+        fake_sleep = Mock()
+        with patch("cloudify_scalelist.workflows.time.sleep", fake_sleep):
+            workflows.execute_operation(
+                ctx=_ctx, operation='a.b.c', operation_kwargs={},
+                allow_kwargs_override=None, run_by_dependency_order=False,
+                type_names=[], node_ids=[], node_instance_ids=[],
+                node_field=[], node_field_value=[], batch_size=2,
+                batch_pause=5, health_check_operation='a.b.check',
+                max_failures=2)
+        self.assertEqual(_ctx._graph.execute.call_count, 2)
+        fake_sleep.assert_called_once_with(5)
+        self.assertEqual(
+            [subgraph.instance_id for subgraph in _ctx._subgraph],
+            ['subgrapha1', 'subgrapha2', 'subgrapha3'])
+        _ctx.nodes[0].instances[0].execute_operation.assert_has_calls([
+            call(kwargs={}, operation='a.b.c'),
+            call('a.b.check')])
+
+        # stop after first batch
+        _ctx = self._gen_operation_ctx()
+        _ctx._graph.execute = Mock(side_effect=_execute)
+        with self.assertRaises(RuntimeError):
+            workflows.execute_operation(
+                ctx=_ctx, operation='a.b.c', operation_kwargs={},
+                allow_kwargs_override=None, run_by_dependency_order=False,
+                type_names=[], node_ids=[], node_instance_ids=[],
+                node_field=[], node_field_value=[], batch_percentage=50)
+        self.assertEqual(_ctx._graph.execute.call_count, 1)
+
+    def test_execute_operation_batches_graph(self):
+        _ctx = self._gen_operation_ctx()
+        graph = TaskDependencyGraph(_ctx)
+        _ctx.graph_mode = Mock(return_value=graph)
+        # run local tasks in place
+        _ctx.internal = Mock()
+        _ctx.internal.add_local_task = lambda task: task()
+        executed = []
+
+        def _gen_task(instance, name, fail=False):
+            def _task():
+                executed.append((instance.id, name))
+                if fail:
+                    raise RuntimeError("failed")
+            return LocalWorkflowTask(
+                _task, _ctx, name=name, total_retries=0,
+                on_failure=lambda task: HandlerResult.fail())
+
+        for instance in _ctx.node_instances:
+            instance.send_event = Mock(side_effect=(
+                lambda message, instance=instance: _gen_task(
+                    instance, message)))
+            instance.execute_operation = Mock(side_effect=(
+                lambda operation, instance=instance, **kwargs: _gen_task(
+                    instance, operation, instance.id == 'a1')))
+
+        # graph with pending tasks never finishes, stop it
+        fake_sleep = Mock(side_effect=(
+            lambda seconds: fake_sleep.call_count > 100 and self.fail(
+                "graph hangs")))
+        with patch("cloudify.workflows.tasks_graph.time.sleep", fake_sleep):
+            with patch("cloudify.workflows.tasks_graph.api."
+                       "has_cancel_request", Mock(return_value=False)):
+                workflows.execute_operation(
+                    ctx=_ctx, operation='a.b.c', operation_kwargs={},
+                    allow_kwargs_override=None,
+                    run_by_dependency_order=False,
+                    type_names=[], node_ids=[], node_instance_ids=[],
+                    node_field=[], node_field_value=[], batch_size=2,
+                    health_check_operation='a.b.check', max_failures=1)
+        # check is not called for failed instance
+        self.assertNotIn(('a1', 'a.b.check'), executed)
+        self.assertIn(('a3', 'a.b.check'), executed)
+        self.assertEqual(len(graph.graph.node), 0)
+
+    def test_execute_operation_health_check_missed(self):
+        _ctx = self._gen_operation_ctx()
+        _ctx.nodes[0].operations = ["a.b.c"]
+        with self.assertRaises(ValueError):
+            workflows.execute_operation(
+                ctx=_ctx, operation='a.b.c', operation_kwargs={},
+                allow_kwargs_override=None, run_by_dependency_order=False,
+                type_names=[], node_ids=[], node_instance_ids=[],
+                node_field=[], node_field_value=[], batch_size=2,
+                health_check_operation='a.b.check')
+        _ctx._graph.execute.assert_not_called()
+
+    def test_get_connecting_instances(self):
+        # e -> d -> c -> b -> a, f -> c, c -> g
+        instances = []
+        for instance_id, targets in [('a', []), ('b', ['a']),
+                                     ('c', ['b', 'g']), ('d', ['c']),
+                                     ('e', ['d']), ('f', ['c']), ('g', [])]:
+            instance = Mock()
+            instance.id = instance_id
+            instance.relationships = []
+            for target_id in targets:
+                relationship = Mock()
+                relationship.target_id = target_id
+                instance.relationships.append(relationship)
+            instances.append(instance)
+        self.assertEqual(
+            workflows._get_connecting_instances(instances, set(['d', 'b'])),
+            set(['c']))
+        self.assertEqual(
+            workflows._get_connecting_instances(instances, set(['e', 'a'])),
+            set(['b', 'c', 'd']))
+        self.assertEqual(
+            workflows._get_connecting_instances(instances, set(['f', 'g'])),
+            set(['c']))
+        self.assertEqual(
+            workflows._get_connecting_instances(instances, set(['a', 'g'])),
+            set())
 
 
 if __name__ == '__main__':
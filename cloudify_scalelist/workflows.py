@@ -11,14 +11,162 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import Queue
+import functools
+import json
+import logging
+import math
+import os
 import subprocess
+import threading
 import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 from cloudify.decorators import workflow
 from cloudify.manager import get_rest_client
 from cloudify.plugins import lifecycle
 from cloudify.workflows import api
 from cloudify.workflows import tasks
+from cloudify_rest_client.exceptions import CloudifyClientError
+
+from cloudify_scalelist import storage
+
+# runtime properties updates: threads, instances per batch and retries on
+# version conflict
+RUNTIME_UPDATE_WORKERS = 10
+RUNTIME_UPDATE_BATCH = 100
+RUNTIME_UPDATE_RETRIES = 5
+# properties of added instances kept in memory before write to manager
+RUNTIME_UPDATE_CHUNK = 1000
+# node instances per request, manager default
+PAGE_SIZE = 1000
+# node instances ids per id filtered request, all ids are sent in query
+# string, so keep it far from request line limits
+ID_FILTER_SIZE = 100
+
+# seconds while checkpoint of failed scaledownlist can be resumed
+CHECKPOINT_TTL = 24 * 60 * 60
+
+# max time in seconds to wait for task termination before check of
+# execution cancel
+DRAIN_CHECK_INTERVAL = 1
+
+# approximate count of tasks in lifecycle subgraph for one node instance and
+# for each instance relationship, key is install(True)/uninstall(False)
+INSTANCE_TASKS = {True: 15, False: 9}
+RELATIONSHIP_TASKS = {True: 6, False: 2}
+
+# deployment groups of current execution, (deployment_id, execution_id) ->
+# {'groups': ..., 'node_groups': ...}
+_groups_cache = {}
+
+# phases time and REST calls of workflow running in current thread, see
+# _collect_metrics
+_local = threading.local()
+
+
+class _WorkflowMetrics(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.rest_calls = {}
+        # REST calls are counted from runtime properties update threads
+        self._lock = threading.Lock()
+
+    def count_call(self, name):
+        with self._lock:
+            self.rest_calls[name] = self.rest_calls.get(name, 0) + 1
+
+
+class _CountingRestClient(object):
+    # proxy for REST client, count calls as 'resource.method'
+
+    def __init__(self, client, metrics, prefix=None):
+        self._client = client
+        self._metrics = metrics
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        value = getattr(self._client, name)
+        if self._prefix is None:
+            return _CountingRestClient(value, self._metrics, name)
+        if not callable(value):
+            return value
+        call_name = '{}.{}'.format(self._prefix, name)
+
+        def _call(*args, **kwargs):
+            self._metrics.count_call(call_name)
+            return value(*args, **kwargs)
+        return _call
+
+
+def _current_metrics():
+    return getattr(_local, 'metrics', None)
+
+
+def _get_rest_client():
+    client = get_rest_client()
+    metrics = _current_metrics()
+    if metrics is None:
+        return client
+    return _CountingRestClient(client, metrics)
+
+
+def _collect_metrics(workflow_name):
+    # measure workflow and send summary as one event, with metrics_file
+    # parameter save summary to such file as json. Metrics are kept per
+    # thread, so workflows running in same process are measured separately.
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(ctx, *args, **kwargs):
+            previous = _current_metrics()
+            metrics = _local.metrics = _WorkflowMetrics()
+            status = 'failed'
+            try:
+                result = func(ctx, *args, **kwargs)
+                status = 'succeeded'
+                return result
+            finally:
+                _local.metrics = previous
+                _report_metrics(ctx, workflow_name, metrics, status,
+                                kwargs.get('metrics_file'))
+        return _wrapper
+    return _decorator
+
+
+def _report_metrics(ctx, workflow_name, metrics, status, metrics_file=None):
+    summary = {
+        'workflow': workflow_name,
+        'deployment_id': ctx.deployment.id,
+        'execution_id': ctx.execution_id,
+        'status': status,
+        'total': time.time() - metrics.started,
+        'phases': metrics.phases,
+        'rest_calls': metrics.rest_calls
+    }
+    ctx.logger.info("Workflow metrics: {}"
+                    .format(json.dumps(summary, sort_keys=True, default=repr)))
+    if metrics_file:
+        # only file name is used, metrics are always saved to plugin
+        # storage directory of deployment
+        name = os.path.basename(metrics_file)
+        if name.endswith('.json'):
+            name = name[:-len('.json')]
+        name = os.path.join(storage.METRICS_DIR, name)
+        try:
+            if name == storage.METRICS_DIR + os.sep:
+                raise ValueError("Empty file name")
+            storage.save(ctx.deployment.id, name,
+                         json.loads(json.dumps(summary, default=repr)))
+            ctx.logger.info("Workflow metrics saved to {}".format(
+                storage.get_path(ctx.deployment.id, name)))
+        except (IOError, OSError, ValueError) as e:
+            # metrics should never break workflow
+            ctx.logger.warn("Can't save metrics to {}: {}"
+                            .format(metrics_file, repr(e)))
+    return summary
 
 
 def _execute_command(ctx, command):
@@ -47,121 +195,370 @@ def _execute_command(ctx, command):
                     repr(error)))
 
 
-def _update_runtime_properties(ctx, instance_id, properties_updates):
-    manager = get_rest_client()
-
-    resulted_state = manager.node_instances.get(instance_id)
-    ctx.logger.debug('State before update: {}'
-                     .format(repr(resulted_state)))
-    ctx.logger.info("Update node: {}".format(instance_id))
-    runtime_properties = resulted_state.runtime_properties or {}
-    runtime_properties.update(properties_updates)
-    manager.node_instances.update(node_instance_id=instance_id,
-                                  runtime_properties=runtime_properties,
-                                  version=resulted_state.version + 1)
-    resulted_state = manager.node_instances.get(instance_id)
-    ctx.logger.debug('State after update: {}'
-                     .format(repr(resulted_state)))
-
-
-def _cleanup_instances(ctx, instance_ids):
-    manager = get_rest_client()
+def _write_node_instance(ctx, instance_id, properties_updates=None,
+                         state=None, replace_properties=False, client=None):
+    # compare with current instance and send only changed parts, returns
+    # runtime properties after write. Client must be created in workflow
+    # thread, context used by get_rest_client is thread local.
+    manager = client or _get_rest_client()
 
-    for instance_id in instance_ids:
+    for attempt in range(RUNTIME_UPDATE_RETRIES):
         resulted_state = manager.node_instances.get(instance_id)
         ctx.logger.debug('State before update: {}'
                          .format(repr(resulted_state)))
-        ctx.logger.info("Cleanup node: {}".format(instance_id))
-        manager.node_instances.update(node_instance_id=instance_id,
-                                      runtime_properties={},
-                                      state='uninitialized',
-                                      version=resulted_state.version + 1)
+        runtime_properties = dict(resulted_state.runtime_properties or {})
+        update_kwargs = {}
+
+        if properties_updates is not None:
+            if replace_properties:
+                if runtime_properties != properties_updates:
+                    runtime_properties = dict(properties_updates)
+                    update_kwargs['runtime_properties'] = runtime_properties
+            else:
+                changed_properties = dict(
+                    (key, value) for key, value in properties_updates.items()
+                    if key not in runtime_properties or
+                    runtime_properties[key] != value)
+                if changed_properties:
+                    ctx.logger.info("Update node: {} keys: {}"
+                                    .format(instance_id,
+                                            repr(sorted(changed_properties))))
+                    runtime_properties.update(changed_properties)
+                    update_kwargs['runtime_properties'] = runtime_properties
+
+        if state is not None and resulted_state.state != state:
+            update_kwargs['state'] = state
+
+        # write only if we have some real changes
+        if not update_kwargs:
+            ctx.logger.debug("Nothing to update in node: {}"
+                             .format(instance_id))
+            return runtime_properties
+
+        try:
+            manager.node_instances.update(
+                node_instance_id=instance_id,
+                version=resulted_state.version + 1,
+                **update_kwargs)
+        except CloudifyClientError as e:
+            # someone else has updated instance, try with fresh version
+            if e.status_code != 409 or attempt + 1 >= RUNTIME_UPDATE_RETRIES:
+                raise
+            ctx.logger.debug('Version conflict on {}: {}'
+                             .format(instance_id, repr(e)))
+            continue
+        break
+
+    # additional request only for show result
+    if ctx.logger.isEnabledFor(logging.DEBUG):
         resulted_state = manager.node_instances.get(instance_id)
         ctx.logger.debug('State after update: {}'
                          .format(repr(resulted_state)))
 
+    return runtime_properties
 
-def _deployments_get_groups(ctx):
-    client = get_rest_client()
-    deployment = client.deployments.get(
-        ctx.deployment.id, _include=['groups'])
-    return deployment['groups']
+
+def _update_runtime_properties(ctx, instance_id, properties_updates,
+                               client=None):
+    return _write_node_instance(ctx, instance_id, properties_updates,
+                                client=client)
+
+
+def _update_runtime_properties_bulk(ctx, properties_updates,
+                                    workers=RUNTIME_UPDATE_WORKERS,
+                                    batch_size=RUNTIME_UPDATE_BATCH):
+    # properties_updates - list of (instance_id, properties) pairs,
+    # returns list of (instance_id, runtime_properties) after update
+    if not properties_updates:
+        return []
+
+    # pool threads have no workflow context, share client created here
+    client = _get_rest_client()
+
+    def _update_instance(update):
+        instance_id, properties = update
+        return instance_id, _update_runtime_properties(ctx, instance_id,
+                                                       properties, client)
+
+    results = []
+    pool = ThreadPool(min(workers, len(properties_updates)))
+    try:
+        for offset in range(0, len(properties_updates), batch_size):
+            batch = properties_updates[offset:offset + batch_size]
+            started = time.time()
+            results += pool.map(_update_instance, batch)
+            ctx.logger.info(
+                'Updated runtime properties for {} instances in {:.3f}s '
+                '({}/{}).'.format(len(batch), time.time() - started,
+                                  offset + len(batch),
+                                  len(properties_updates)))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def _cleanup_instances(ctx, instance_ids):
+    client = _get_rest_client()
+    for instance_id in instance_ids:
+        ctx.logger.info("Cleanup node: {}".format(instance_id))
+        # already cleaned up instances are skipped
+        _write_node_instance(ctx, instance_id, properties_updates={},
+                             state='uninitialized', replace_properties=True,
+                             client=client)
+
+    _discard_instances_index(ctx, instance_ids)
+
+
+def _deployments_get(ctx):
+    # groups are not changed while workflow is running, so request them
+    # only once per execution
+    key = (ctx.deployment.id, ctx.execution_id)
+    cached = _groups_cache.get(key)
+    if cached is None:
+        client = _get_rest_client()
+        deployment = client.deployments.get(
+            ctx.deployment.id, _include=['groups', 'created_at'])
+        cached = {'groups': deployment['groups'],
+                  'created_at': deployment.get('created_at')}
+        _groups_cache.clear()
+        _groups_cache[key] = cached
+    # return own dict, cache can be cleared by other execution in worker
+    return cached
 
 
-def _get_field_value_recursive(ctx, properties, path):
-    if not path:
+def _deployments_get_groups(ctx):
+    return _deployments_get(ctx)['groups']
+
+
+def _check_storage(ctx):
+    # saved data is checked once per execution, data of previous deployment
+    # with same id is removed
+    cached = _deployments_get(ctx)
+    if not cached.get('storage_checked'):
+        storage.check_deployment(ctx.deployment.id, cached['created_at'])
+        cached['storage_checked'] = True
+
+
+def _get_node_groups(ctx):
+    # node name -> first scaling group with such node in members, built once
+    # per execution
+    cached = _deployments_get(ctx)
+    if 'node_groups' not in cached:
+        scaling_groups = ctx.deployment.scaling_groups
+        groups = cached['groups']
+        node_groups = {}
+        for scalegroup in groups:
+            # check that we really have such scalling group
+            if scalegroup not in scaling_groups:
+                continue
+            for node_name in groups[scalegroup]['members']:
+                node_groups.setdefault(node_name, scalegroup)
+        cached['node_groups'] = node_groups
+    return cached['node_groups']
+
+
+def _compile_field_path(path):
+    # convert path to getter, supported search by ['a', 'b'] on
+    # {'a': {'b': 'c'}} or ['0', 'b'] on [{'b': 'c'}]. Getter returns None
+    # for any missed key.
+    steps = []
+    for key in path:
+        try:
+            index = int(key)
+        except (TypeError, ValueError):
+            index = None
+        steps.append((key, index))
+
+    def _get_field_value(properties):
+        for key, index in steps:
+            if isinstance(properties, dict):
+                properties = properties.get(key)
+            elif isinstance(properties, list):
+                if index is None or not (
+                    -len(properties) <= index < len(properties)
+                ):
+                    return None
+                properties = properties[index]
+            else:
+                return None
         return properties
-    key = path[0]
-    if isinstance(properties, list):
+
+    return _get_field_value
+
+
+def _compile_values_matcher(values):
+    # check value in set for hashable values, and in list for other
+    hashable_values = set()
+    other_values = []
+    for value in values:
         try:
-            return _get_field_value_recursive(
-                ctx,
-                properties[int(key)],
-                path[1:]
-            )
-        except Exception as e:
-            ctx.logger.debug('Can filter by {}'.format(repr(e)))
-            return None
-    elif isinstance(properties, dict):
+            hashable_values.add(value)
+        except TypeError:
+            other_values.append(value)
+
+    def _match_value(value):
         try:
-            return _get_field_value_recursive(
-                ctx,
-                properties[key],
-                path[1:]
-            )
-        except Exception as e:
-            ctx.logger.debug('Can filter by {}'.format(repr(e)))
-            return None
-    else:
-        return None
+            if value in hashable_values:
+                return True
+        except TypeError:
+            pass
+        return value in other_values
+
+    return _match_value
+
+
+def _iter_node_instances_fields(ctx, field_getters, page_size=PAGE_SIZE,
+                                all_results=True, instance_ids=None):
+    # walk over deployment node instances page by page and return only
+    # (id, node_id, [values by field_getters]) for each instance, so we never
+    # have full runtime properties for all instances in memory. With
+    # instance_ids walk only over such instances.
+    client = _get_rest_client()
+    list_kwargs = {
+        'deployment_id': ctx.deployment.id,
+        '_include': ['runtime_properties', 'node_id', 'id'],
+        'sort': 'id'
+    }
+    if instance_ids is not None:
+        instance_ids = sorted(instance_ids)
+    offset = 0
+    while True:
+        if instance_ids is None:
+            instances = client.node_instances.list(
+                _offset=offset, _size=page_size, **list_kwargs)
+        else:
+            selected_ids = instance_ids[offset:offset + ID_FILTER_SIZE]
+            if not selected_ids:
+                break
+            instances = client.node_instances.list(
+                id=selected_ids, _size=len(selected_ids), **list_kwargs)
+        for instance in instances:
+            runtime_properties = instance.runtime_properties or {}
+            yield instance.id, instance.node_id, [
+                get_field_value(runtime_properties)
+                for get_field_value in field_getters]
+        if instance_ids is None:
+            offset += len(instances)
+            ctx.logger.debug("Checked {} instances.".format(offset))
+            # no more pages or we need only first one, manager can return
+            # less than requested page size, so check by total count
+            if (
+                not all_results or not instances or
+                offset >= instances.metadata.pagination.total
+            ):
+                break
+        else:
+            offset += len(selected_ids)
+
+
+def _get_instances_index(ctx, field_paths, rebuild=False,
+                         page_size=PAGE_SIZE):
+    # load index of runtime properties values, build index by full scan
+    # only for paths which we have never seen before
+    _check_storage(ctx)
+    index = storage.InstancesIndex.load(ctx.deployment.id)
+    missed_paths = [path for path in field_paths
+                    if rebuild or not index.has_path(path)]
+    if not missed_paths:
+        return index
+
+    ctx.logger.info("Build index for {}.".format(repr(missed_paths)))
+    for path in missed_paths:
+        index.reset_path(path)
+    field_getters = [_compile_field_path(path) for path in missed_paths]
+    for instance_id, _, values in _iter_node_instances_fields(
+        ctx, field_getters, page_size=page_size
+    ):
+        for path, value in zip(missed_paths, values):
+            index.add(path, instance_id, value)
+    index.save()
+    return index
+
+
+def _update_instances_index(ctx, instances_properties):
+    # instances_properties - list of (instance_id, runtime_properties),
+    # index is updated only if it has been already created
+    _check_storage(ctx)
+    if not storage.InstancesIndex.exists(ctx.deployment.id):
+        return
+    index = storage.InstancesIndex.load(ctx.deployment.id)
+    index.discard([instance_id for instance_id, _ in instances_properties])
+    for path in index.paths:
+        get_field_value = _compile_field_path(path)
+        for instance_id, runtime_properties in instances_properties:
+            index.add(path, instance_id, get_field_value(runtime_properties))
+    index.save()
+
+
+def _discard_instances_index(ctx, instance_ids):
+    _check_storage(ctx)
+    if not storage.InstancesIndex.exists(ctx.deployment.id):
+        return
+    index = storage.InstancesIndex.load(ctx.deployment.id)
+    index.discard(instance_ids)
+    index.save()
 
 
 def _get_transaction_instances(ctx, scale_transaction_field,
                                scale_node_names, scale_node_field_path,
-                               scale_node_field_values, all_results=False):
-    client = get_rest_client()
+                               scale_node_field_values, all_results=False,
+                               page_size=PAGE_SIZE, index=None,
+                               manifest=None):
     # search transaction ids
-    list_kwargs = {
-        'deployment_id': ctx.deployment.id,
-        '_include': ['runtime_properties', 'node_id', 'id']
-    }
-    if all_results:
-        list_kwargs['_get_all_results'] = True
-    instances = client.node_instances.list(**list_kwargs)
-    transaction_ids = []
+    field_getters = [_compile_field_path(scale_node_field_path)]
+    if scale_transaction_field:
+        field_getters.append(_compile_field_path([scale_transaction_field]))
+    match_value = _compile_values_matcher(scale_node_field_values)
+    if index is None:
+        instances = _iter_node_instances_fields(
+            ctx, field_getters, page_size=page_size, all_results=all_results)
+    else:
+        # check only instances with such values in index
+        instances = _iter_node_instances_fields(
+            ctx, field_getters, page_size=page_size,
+            instance_ids=index.lookup(scale_node_field_path,
+                                      scale_node_field_values))
+    # transaction id -> instances created in same transaction
+    transactions = {}
+    transaction_ids = set()
     node_instances = {}
     instance_ids = []
-
-    for instance in instances:
-        runtime_properties = instance.runtime_properties
+    # (node_id, instance_id) pairs and instance ids already in results
+    seen_node_instances = set()
+    seen_instance_ids = set()
+
+    def _add_instance(node_id, instance_id):
+        if (node_id, instance_id) not in seen_node_instances:
+            seen_node_instances.add((node_id, instance_id))
+            node_instances.setdefault(node_id, []).append(instance_id)
+        if instance_id not in seen_instance_ids:
+            seen_instance_ids.add(instance_id)
+            instance_ids.append(instance_id)
+
+    position = 0
+    for position, (instance_id, node_id, values) in enumerate(instances):
+        # save transaction for expand selected instances later
+        transaction_id = None
+        if scale_transaction_field:
+            transaction_id = values[1]
+            # members of transactions from manifest are requested later
+            if transaction_id and not (manifest is not None and
+                                       manifest.has(transaction_id)):
+                transactions.setdefault(transaction_id, []).append(
+                    (position, node_id, instance_id))
         # check that we have correct node name
-        if scale_node_names and instance.node_id not in scale_node_names:
+        if scale_node_names and node_id not in scale_node_names:
             continue
         # check that we have such values in properties
-        value = _get_field_value_recursive(ctx,
-                                           runtime_properties,
-                                           scale_node_field_path)
-        if value not in scale_node_field_values:
+        if not match_value(values[0]):
             continue
         # save instances to scale "settings", for case when instances created
         # without transaction
-        if not node_instances.get(instance.node_id):
-            node_instances[instance.node_id] = []
-        # save node type (instances without transaction)
-        if instance.id not in node_instances[instance.node_id]:
-            node_instances[instance.node_id].append(instance.id)
-        # save exact instance id (instances without transaction)
-        if instance.id not in instance_ids:
-            instance_ids.append(instance.id)
-        # ignore transaction
-        if not scale_transaction_field:
-            continue
-        # check transactions
-        if not runtime_properties.get(scale_transaction_field):
-            continue
+        _add_instance(node_id, instance_id)
         # save transaction to list
-        transaction_ids.append(
-            runtime_properties.get(scale_transaction_field))
+        if transaction_id:
+            transaction_ids.add(transaction_id)
 
     # list will be empty if no scale_transaction_field
     if not transaction_ids:
@@ -171,24 +568,35 @@ def _get_transaction_instances(ctx, scale_transaction_field,
 
     ctx.logger.debug("Transaction ids: {}".format(repr(transaction_ids)))
 
-    # search instances for remove
-    instances = client.node_instances.list(**list_kwargs)
-
-    for instance in instances:
-        runtime_properties = instance.runtime_properties
-        transaction_id = runtime_properties.get(scale_transaction_field)
-        # not our transaction, skip
-        if transaction_id not in transaction_ids:
-            continue
-        # no such group yet
-        if not node_instances.get(instance.node_id):
-            node_instances[instance.node_id] = []
-        # maybe we already have such type
-        if instance.id not in node_instances[instance.node_id]:
-            node_instances[instance.node_id].append(instance.id)
-        # maybe we already have such instance
-        if instance.id not in instance_ids:
-            instance_ids.append(instance.id)
+    member_ids = set()
+    unknown_ids = transaction_ids
+    if manifest is not None:
+        # instances created by scaleuplist, without search over all instances
+        known_ids = set(transaction_id for transaction_id in transaction_ids
+                        if manifest.has(transaction_id))
+        unknown_ids = transaction_ids - known_ids
+        member_ids |= manifest.lookup(known_ids)
+    if index is not None:
+        # we have checked only selected instances, get other instances from
+        # same transactions
+        member_ids |= index.lookup([scale_transaction_field], unknown_ids)
+    if member_ids:
+        # check that instances still exist and have same transaction
+        members = _iter_node_instances_fields(
+            ctx, field_getters, page_size=page_size, instance_ids=member_ids)
+        for position, (instance_id, node_id, values) in enumerate(
+            members, position + 1
+        ):
+            if values[1] in transaction_ids:
+                transactions.setdefault(values[1], []).append(
+                    (position, node_id, instance_id))
+
+    # expand selected transactions by index in original instances order
+    selected = []
+    for transaction_id in transaction_ids:
+        selected += transactions.get(transaction_id, [])
+    for _, node_id, instance_id in sorted(selected):
+        _add_instance(node_id, instance_id)
 
     ctx.logger.debug("List nodes: {}".format(repr(node_instances)))
     ctx.logger.debug("List instances: {}".format(repr(instance_ids)))
@@ -202,8 +610,7 @@ def _get_scale_list(ctx, scalable_entity_properties, property_type):
     # }
     # property_type - kind of values inside list of node names(types).
     scalable_entity_dict = {}
-    scaling_groups = ctx.deployment.scaling_groups
-    groups = _deployments_get_groups(ctx)
+    node_groups = _get_node_groups(ctx)
 
     ctx.logger.debug("Scale entities: {}"
                      .format(repr(scalable_entity_properties)))
@@ -226,46 +633,252 @@ def _get_scale_list(ctx, scalable_entity_properties, property_type):
                 raise ValueError(
                     "You use wrong value for runtime properties item: {}"
                     .format(repr(scalable_entity_properties[node_name])))
-        # get parent group
-        for scalegroup in groups:
-            # check that we really have such scalling group
-            if scalegroup not in scaling_groups:
-                continue
-            # check node in nodes group
-            if node_name in groups[scalegroup]['members']:
-                # not selected
-                if scalegroup not in scalable_entity_dict:
-                    scalable_entity_dict[scalegroup] = {
-                        'count': 0,
-                        'values': []
-                    }
-                # already have have such group, scale by max value
-                if scalable_entity_dict[scalegroup]['count'] < node_amount:
-                    scalable_entity_dict[scalegroup]['count'] = node_amount
-                # save instance id's for scale down workflow
-                # ignored for scale up
-                scalable_entity_dict[scalegroup]['values'] += (
-                    scalable_entity_properties[node_name]
-                )
-                break
-        else:
-            # no such group
-            if node_name not in scalable_entity_dict:
-                scalable_entity_dict[node_name] = {
-                    'count': 0,
-                    'values': []
-                }
-            scalable_entity_dict[node_name]['count'] = node_amount
-            scalable_entity_dict[node_name]['values'] += (
-                scalable_entity_properties[node_name]
-            )
+        _add_scale_entity(scalable_entity_dict, node_groups, node_name,
+                          node_amount, scalable_entity_properties[node_name])
+
+    ctx.logger.info("Scale rules: {}".format(repr(scalable_entity_dict)))
+    return scalable_entity_dict
+
+
+def _add_scale_entity(scalable_entity_dict, node_groups, node_name,
+                      node_amount, values):
+    # get parent group
+    scalegroup = node_groups.get(node_name)
+    if scalegroup:
+        # not selected
+        if scalegroup not in scalable_entity_dict:
+            scalable_entity_dict[scalegroup] = {
+                'count': 0,
+                'values': []
+            }
+        # already have have such group, scale by max value
+        if scalable_entity_dict[scalegroup]['count'] < node_amount:
+            scalable_entity_dict[scalegroup]['count'] = node_amount
+        # save instance id's for scale down workflow
+        # ignored for scale up
+        scalable_entity_dict[scalegroup]['values'] += values
+    else:
+        # no such group
+        if node_name not in scalable_entity_dict:
+            scalable_entity_dict[node_name] = {
+                'count': 0,
+                'values': []
+            }
+        scalable_entity_dict[node_name]['count'] = node_amount
+        scalable_entity_dict[node_name]['values'] += values
+
+
+class _EntityPropertiesFile(object):
+    # scalable_entity_properties saved as JSON Lines file, each line is
+    # {"node_name": {runtime properties}}. Properties are read by node only
+    # when instance is created, so we never have all file in memory.
+
+    def __init__(self, path):
+        self.path = path
+        self._nodes = {}
+
+    def iter_items(self):
+        with open(self.path) as entity_file:
+            for number, line in enumerate(entity_file, 1):
+                if not line.strip():
+                    continue
+                # report only line number, file content should not be
+                # shown in events
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    item = None
+                if (
+                    not isinstance(item, dict) or len(item) != 1 or
+                    not isinstance(item.values()[0], dict)
+                ):
+                    raise ValueError(
+                        "You use wrong value for runtime properties item in "
+                        "line {}.".format(number))
+                yield item.items()[0]
+
+    def get(self, node_name, default=None):
+        # same instance for all waves, so each line is used only once
+        if node_name not in self._nodes:
+            self._nodes[node_name] = _NodePropertiesReader(self, node_name)
+        return self._nodes[node_name]
+
+
+class _NodePropertiesReader(object):
+    # properties of one node from _EntityPropertiesFile with list like
+    # pop() and check for emptiness
+
+    def __init__(self, entity_file, node_name):
+        self._items = (properties for item_node, properties in
+                       entity_file.iter_items() if item_node == node_name)
+        self._next = None
+
+    def _fetch(self):
+        if self._next is None:
+            self._next = next(self._items, None)
+        return self._next
+
+    def __nonzero__(self):
+        return self._fetch() is not None
+
+    def pop(self):
+        properties = self._fetch()
+        if properties is None:
+            raise IndexError('pop from empty properties list')
+        self._next = None
+        return properties
+
+
+def _get_file_scale_list(ctx, entity_file):
+    # same as _get_scale_list, but without values
+    scalable_entity_dict = {}
+    node_groups = _get_node_groups(ctx)
+    node_amounts = {}
+    for node_name, _ in entity_file.iter_items():
+        node_amounts[node_name] = node_amounts.get(node_name, 0) + 1
+    for node_name, node_amount in node_amounts.items():
+        _add_scale_entity(scalable_entity_dict, node_groups, node_name,
+                          node_amount, [])
 
     ctx.logger.info("Scale rules: {}".format(repr(scalable_entity_dict)))
     return scalable_entity_dict
 
 
+@contextmanager
+def _entity_properties_file(ctx, path):
+    # only blueprint/deployment resource, files on manager are never read
+    # directly
+    path = ctx.internal.handler.download_deployment_resource(path)
+    try:
+        yield _EntityPropertiesFile(path)
+    finally:
+        os.remove(path)
+
+
+def _limit_parallel_subgraphs(graph, subgraphs, max_parallel_instances):
+    # subgraphs - list of subgraphs in run order, each subgraph waits for
+    # subgraph max_parallel_instances positions before, so no more than
+    # max_parallel_instances subgraphs are run at same time
+    if not max_parallel_instances or max_parallel_instances <= 0:
+        return
+    for position in range(max_parallel_instances, len(subgraphs)):
+        graph.add_dependency(subgraphs[position],
+                             subgraphs[position - max_parallel_instances])
+
+
+def _sort_by_relationships(node_instances, install):
+    # sort instances in run order: on install relationship target is
+    # installed before source, on uninstall source is removed before target
+    instances = dict((instance.id, instance) for instance in node_instances)
+    dependencies = {}
+    dependents = dict((instance_id, []) for instance_id in instances)
+    for instance_id, instance in instances.items():
+        targets = set(rel.target_id for rel in instance.relationships
+                      if rel.target_id in instances and
+                      rel.target_id != instance_id)
+        for target_id in targets:
+            if install:
+                dependencies.setdefault(instance_id, set()).add(target_id)
+                dependents[target_id].append(instance_id)
+            else:
+                dependencies.setdefault(target_id, set()).add(instance_id)
+                dependents[instance_id].append(target_id)
+
+    ordered = []
+    ready = sorted(instance_id for instance_id in instances
+                   if not dependencies.get(instance_id))
+    while ready:
+        instance_id = ready.pop(0)
+        ordered.append(instances[instance_id])
+        for dependent_id in dependents[instance_id]:
+            dependencies[dependent_id].discard(instance_id)
+            if not dependencies[dependent_id]:
+                ready.append(dependent_id)
+    if len(ordered) != len(instances):
+        raise ValueError("Node instances have cyclic relationships.")
+    return ordered
+
+
+class _LimitedLifecycleProcessor(lifecycle.LifecycleProcessor):
+    # lifecycle processor with limit for instances processed in parallel
+
+    def __init__(self, max_parallel_instances, **kwargs):
+        super(_LimitedLifecycleProcessor, self).__init__(**kwargs)
+        self.max_parallel_instances = max_parallel_instances
+
+    def _finish_subgraphs(self, subgraphs, intact_op, install):
+        super(_LimitedLifecycleProcessor, self)._finish_subgraphs(
+            subgraphs=subgraphs, intact_op=intact_op, install=install)
+        # lanes follow relationships order, so we never have cycles
+        _limit_parallel_subgraphs(
+            self.graph,
+            [subgraphs[instance.id] for instance in
+             _sort_by_relationships(self.node_instances, install)],
+            self.max_parallel_instances)
+
+
+def _install_node_instances(graph, node_instances, related_nodes,
+                            max_parallel_instances=None):
+    # lifecycle builds and executes graph in one call
+    with _phase('lifecycle'):
+        _install_lifecycle(graph, node_instances, related_nodes,
+                           max_parallel_instances)
+
+
+def _install_lifecycle(graph, node_instances, related_nodes,
+                       max_parallel_instances):
+    if not max_parallel_instances:
+        lifecycle.install_node_instances(
+            graph=graph,
+            node_instances=node_instances,
+            related_nodes=related_nodes)
+        return
+    _LimitedLifecycleProcessor(
+        max_parallel_instances,
+        graph=graph,
+        node_instances=node_instances,
+        related_nodes=related_nodes).install()
+
+
+def _uninstall_node_instances(graph, node_instances, related_nodes,
+                              ignore_failure, max_parallel_instances=None):
+    with _phase('lifecycle'):
+        _uninstall_lifecycle(graph, node_instances, related_nodes,
+                             ignore_failure, max_parallel_instances)
+
+
+def _uninstall_lifecycle(graph, node_instances, related_nodes,
+                         ignore_failure, max_parallel_instances):
+    if not max_parallel_instances:
+        lifecycle.uninstall_node_instances(
+            graph=graph,
+            node_instances=node_instances,
+            related_nodes=related_nodes,
+            ignore_failure=ignore_failure)
+        return
+    _LimitedLifecycleProcessor(
+        max_parallel_instances,
+        graph=graph,
+        node_instances=node_instances,
+        related_nodes=related_nodes,
+        ignore_failure=ignore_failure).uninstall()
+
+
 def _process_node_instances(ctx, graph, node_instances, ignore_failure,
-                            node_instance_subgraph_func, node_sequence):
+                            node_instance_subgraph_func, node_sequence,
+                            max_parallel_instances=None):
+    with _phase('graph_build'):
+        _build_node_instances_graph(
+            ctx, graph, node_instances, ignore_failure,
+            node_instance_subgraph_func, node_sequence,
+            max_parallel_instances)
+    with _phase('graph_execute'):
+        graph.execute()
+
+
+def _build_node_instances_graph(ctx, graph, node_instances, ignore_failure,
+                                node_instance_subgraph_func, node_sequence,
+                                max_parallel_instances=None):
     ctx.logger.info("Scale sequence: {}".format(repr(node_sequence)))
     subgraphs = {}
     node_graphs = {}
@@ -279,25 +892,50 @@ def _process_node_instances(ctx, graph, node_instances, ignore_failure,
 
     ctx.logger.info("Scale levels: {}".format(repr(node_graphs)))
     previous_level = []
+    levels = []
     for node_id in node_sequence:
         # use get for skip instances with unknow type
         if not node_graphs.get(node_id, []):
             continue
         current_level_instances = node_graphs[node_id]
-        for target_instance in current_level_instances:
+        levels.append(current_level_instances)
+        if previous_level:
+            ctx.logger.info("Scale dependency: {}->{}"
+                            .format(repr([instance.id
+                                          for instance in previous_level]),
+                                    repr([instance.id for instance in
+                                          current_level_instances])))
+        if len(previous_level) > 1 and len(current_level_instances) > 1:
+            # connect levels by stub subgraph, so we have N + M dependencies
+            # instead of N * M
+            barrier = graph.subgraph('scale_barrier_{}'.format(node_id))
             for source_instance in previous_level:
-                ctx.logger.info("Scale dependency: {}->{}"
-                                .format(source_instance.id,
-                                        target_instance.id))
-                graph.add_dependency(subgraphs[source_instance.id],
-                                     subgraphs[target_instance.id])
+                graph.add_dependency(subgraphs[source_instance.id], barrier)
+            for target_instance in current_level_instances:
+                graph.add_dependency(barrier, subgraphs[target_instance.id])
+        else:
+            for target_instance in current_level_instances:
+                for source_instance in previous_level:
+                    graph.add_dependency(subgraphs[source_instance.id],
+                                         subgraphs[target_instance.id])
         # replace previous with current instances
         previous_level = current_level_instances
-    graph.execute()
+
+    if max_parallel_instances:
+        # levels are run from last to first, instances with unknown type
+        # are run without order
+        run_order = [instance for level in levels[::-1]
+                     for instance in level]
+        run_order += [instance for node_id in sorted(node_graphs)
+                      if node_id not in node_sequence
+                      for instance in node_graphs[node_id]]
+        _limit_parallel_subgraphs(
+            graph, [subgraphs[instance.id] for instance in run_order],
+            max_parallel_instances)
 
 
 def _uninstall_instances(ctx, graph, removed, related, ignore_failure,
-                         node_sequence):
+                         node_sequence, max_parallel_instances=None):
 
     # cleanup tasks
     for task in graph.tasks_iter():
@@ -312,18 +950,58 @@ def _uninstall_instances(ctx, graph, removed, related, ignore_failure,
                 node_instances=removed,
                 ignore_failure=ignore_failure,
                 node_instance_subgraph_func=subgraph_func,
-                node_sequence=node_sequence[::-1])
+                node_sequence=node_sequence[::-1],
+                max_parallel_instances=max_parallel_instances)
         else:
-            lifecycle.uninstall_node_instances(
+            _uninstall_node_instances(
                 graph=graph,
                 node_instances=removed,
                 related_nodes=related,
-                ignore_failure=ignore_failure)
+                ignore_failure=ignore_failure,
+                max_parallel_instances=max_parallel_instances)
 
         # clean up properties
         instance_ids = [node_instance._node_instance.id
                         for node_instance in removed]
-        _cleanup_instances(ctx, instance_ids)
+        with _phase('cleanup'):
+            _cleanup_instances(ctx, instance_ids)
+
+
+def _wait_for_sent_tasks(ctx, graph, deadline):
+    # wait until tasks already sent to agents are finished, each task
+    # notifies about own termination, so we block on notification instead of
+    # rescan of all graph tasks
+    started = time.time()
+    if deadline <= started:
+        return
+    if graph._is_execution_cancelled():
+        raise api.ExecutionCancelled()
+    for task in graph._terminated_tasks():
+        graph._handle_terminated_task(task)
+    in_flight = [task for task in graph.tasks_iter()
+                 if task.get_state() == tasks.TASK_SENT]
+    ctx.logger.info('Waiting for {} running tasks.'.format(len(in_flight)))
+    while in_flight:
+        if graph._is_execution_cancelled():
+            raise api.ExecutionCancelled()
+        wait_time = deadline - time.time()
+        if wait_time <= 0:
+            break
+        try:
+            in_flight[-1].wait_for_terminated(
+                timeout=min(wait_time, DRAIN_CHECK_INTERVAL))
+        except Queue.Empty:
+            # recheck cancel and deadline
+            continue
+        graph._handle_terminated_task(in_flight.pop())
+    ctx.logger.info('Waited for running tasks {:.3f}s, still running: {}.'
+                    .format(time.time() - started, len(in_flight)))
+
+
+def _save_properties_bulk(ctx, properties_bulk):
+    with _phase('runtime_properties'):
+        _update_instances_index(
+            ctx, _update_runtime_properties_bulk(ctx, properties_bulk))
 
 
 def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
@@ -332,9 +1010,16 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
                         ignore_failure=False,
                         ignore_rollback_failure=True,
                         instances_remove_ids=None,
-                        node_sequence=None):
-    modification = ctx.deployment.start_modification(scale_settings)
+                        node_sequence=None,
+                        max_parallel_instances=None,
+                        uninstalled_ids=None):
+    with _phase('modification'):
+        modification = ctx.deployment.start_modification(scale_settings)
     graph = ctx.graph_mode()
+    # changes for transactions manifest
+    added_transaction_id = None
+    added_ids = []
+    removed_ids = []
     try:
         ctx.logger.info('Deployment modification started. '
                         '[modification_id={0}]'.format(modification.id))
@@ -349,6 +1034,7 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
                         if i.modification == 'added')
             related = added_and_related - added
             try:
+                properties_bulk = []
                 for node_instance in added:
                     properties_updates = scalable_entity_properties.get(
                         node_instance._node_instance.node_id, {})
@@ -360,15 +1046,12 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
                     # save transaction list
                     if scale_transaction_field:
                         # save original set of instances in scale up.
-                        if scale_transaction_value:
-                            properties.update({
-                                scale_transaction_field:
-                                    scale_transaction_value
-                            })
-                        else:
-                            properties.update({
-                                scale_transaction_field: modification.id
-                            })
+                        added_transaction_id = (scale_transaction_value or
+                                                modification.id)
+                        added_ids.append(node_instance._node_instance.id)
+                        properties.update({
+                            scale_transaction_field: added_transaction_id
+                        })
                     # check properties to update
                     if properties:
                         ctx.logger.debug(
@@ -376,8 +1059,14 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
                                 node_instance._node_instance.node_id,
                                 node_instance._node_instance.id,
                                 repr(properties)))
-                        _update_runtime_properties(
-                            ctx, node_instance._node_instance.id, properties)
+                        properties_bulk.append(
+                            (node_instance._node_instance.id, properties))
+                    # write by chunks, properties from file are never all
+                    # in memory
+                    if len(properties_bulk) >= RUNTIME_UPDATE_CHUNK:
+                        _save_properties_bulk(ctx, properties_bulk)
+                        properties_bulk = []
+                _save_properties_bulk(ctx, properties_bulk)
                 if node_sequence:
                     subgraph_func = lifecycle.install_node_instance_subgraph
                     _process_node_instances(
@@ -386,12 +1075,14 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
                         node_instances=added,
                         ignore_failure=ignore_failure,
                         node_instance_subgraph_func=subgraph_func,
-                        node_sequence=node_sequence)
+                        node_sequence=node_sequence,
+                        max_parallel_instances=max_parallel_instances)
                 else:
-                    lifecycle.install_node_instances(
+                    _install_node_instances(
                         graph=graph,
                         node_instances=added,
-                        related_nodes=related)
+                        related_nodes=related,
+                        max_parallel_instances=max_parallel_instances)
             except Exception as ex:
                 ctx.logger.error('Scale out failed, scaling back in. {}'
                                  .format(repr(ex)))
@@ -400,7 +1091,9 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
                                      removed=added,
                                      related=related,
                                      ignore_failure=ignore_rollback_failure,
-                                     node_sequence=node_sequence)
+                                     node_sequence=node_sequence,
+                                     max_parallel_instances=(
+                                         max_parallel_instances))
                 raise ex
 
         if len(set(modification.removed.node_instances)):
@@ -424,12 +1117,20 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
                             )
                         )
             related = removed_and_related - removed
+            removed_ids = [i._node_instance.id for i in removed]
+            if uninstalled_ids:
+                # already uninstalled by previous run, only remove from
+                # deployment
+                uninstalled_ids = set(uninstalled_ids)
+                removed = set(i for i in removed
+                              if i._node_instance.id not in uninstalled_ids)
             _uninstall_instances(ctx=ctx,
                                  graph=graph,
                                  removed=removed,
                                  ignore_failure=ignore_failure,
                                  related=related,
-                                 node_sequence=node_sequence)
+                                 node_sequence=node_sequence,
+                                 max_parallel_instances=max_parallel_instances)
     except Exception as ex:
         ctx.logger.warn('Rolling back deployment modification. '
                         '[modification_id={0}]: {1}'
@@ -438,24 +1139,247 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
             deadline = time.time() + ctx.wait_after_fail
         except AttributeError:
             deadline = time.time() + 1800
-        while deadline > time.time():
-            if graph._is_execution_cancelled():
-                raise api.ExecutionCancelled()
-            for task in graph._terminated_tasks():
-                graph._handle_terminated_task(task)
-            if not any(task.get_state() == tasks.TASK_SENT
-                       for task in graph.tasks_iter()):
-                break
-            else:
-                time.sleep(0.1)
-        modification.rollback()
+        with _phase('rollback'):
+            _wait_for_sent_tasks(ctx, graph, deadline)
+            modification.rollback()
         raise ex
     else:
-        modification.finish()
+        with _phase('modification'):
+            modification.finish()
+        _update_transactions_manifest(
+            ctx, added_transaction_id, added_ids, removed_ids)
+
+
+def _update_transactions_manifest(ctx, transaction_id, added_ids,
+                                  removed_ids):
+    # manifest is created by first scale up with transaction
+    _check_storage(ctx)
+    if not added_ids and not (
+        removed_ids and storage.TransactionsManifest.exists(ctx.deployment.id)
+    ):
+        return
+    manifest = storage.TransactionsManifest.load(ctx.deployment.id)
+    manifest.discard(removed_ids)
+    if added_ids:
+        manifest.add(transaction_id, added_ids)
+    manifest.save()
+
+
+def _get_scale_target(ctx, scaling_groups, scalable_entity_name,
+                      scale_compute):
+    # returns scale id and current count of instances for entity from
+    # scale list
+    scaling_group = scaling_groups.get(scalable_entity_name)
+    if scaling_group:
+        return (scalable_entity_name,
+                scaling_group['properties']['current_instances'])
+
+    node = ctx.get_node(scalable_entity_name)
+    if not node:
+        raise ValueError("No scalable entity named {0} was found"
+                         .format(scalable_entity_name))
+    host_node = node.host_node
+    scaled_node = host_node if (scale_compute and host_node) else node
+    return scaled_node.id, scaled_node.number_of_instances
+
+
+def _split_scale_settings(ctx, scale_settings, batch_size):
+    # split scale settings to waves, each wave changes count of instances
+    # (or scaling group instances) at most by batch_size in sum for all
+    # scalable entities. Targets are calculated from counts before first
+    # wave.
+    if not batch_size or batch_size <= 0:
+        return [scale_settings]
+
+    scaling_groups = ctx.deployment.scaling_groups
+    current_instances = {}
+    for scale_id in scale_settings:
+        scaling_group = scaling_groups.get(scale_id)
+        if scaling_group:
+            current_instances[scale_id] = (
+                scaling_group['properties']['current_instances']
+            )
+        else:
+            current_instances[scale_id] = (
+                ctx.get_node(scale_id).number_of_instances
+            )
+
+    waves = []
+    while True:
+        wave = {}
+        budget = batch_size
+        for scale_id in sorted(scale_settings):
+            delta = (scale_settings[scale_id]['instances'] -
+                     current_instances[scale_id])
+            if not delta or not budget:
+                continue
+            step = min(abs(delta), budget)
+            budget -= step
+            current_instances[scale_id] += step if delta > 0 else -step
+            wave[scale_id] = dict(scale_settings[scale_id],
+                                  instances=current_instances[scale_id])
+        if not wave:
+            break
+        waves.append(wave)
+
+    return waves or [scale_settings]
+
+
+@contextmanager
+def _measure_phase(phases, name):
+    # save time spent in block to phases dictionary
+    started = time.time()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0) + time.time() - started
+
+
+def _phase(name):
+    # measure time of block as phase of running workflow
+    metrics = _current_metrics()
+    return _measure_phase(metrics.phases if metrics is not None else {},
+                          name)
+
+
+def _estimate_scale_instances(ctx, scale_settings):
+    # returns approximate count of node instances per node changed by scale
+    # settings, contained nodes are changed with their host
+    scaling_groups = ctx.deployment.scaling_groups
+    nodes_instances = {}
+    for scale_id, settings in scale_settings.items():
+        scaling_group = scaling_groups.get(scale_id)
+        if scaling_group:
+            members = set(scaling_group['members'])
+            curr_num_instances = (
+                scaling_group['properties']['current_instances']
+            )
+        else:
+            members = set([scale_id])
+            curr_num_instances = ctx.get_node(scale_id).number_of_instances
+        delta = abs(settings['instances'] - curr_num_instances)
+        for node in ctx.nodes:
+            host_node = node
+            while host_node and host_node.id not in members:
+                host_node = host_node.host_node
+            if not host_node:
+                continue
+            # instances of node per one instance of scaled entity
+            per_instance = max(
+                node.number_of_instances // max(curr_num_instances, 1), 1)
+            nodes_instances[node.id] = (
+                nodes_instances.get(node.id, 0) + delta * per_instance
+            )
+    return nodes_instances
+
+
+def _estimate_scale_graph(ctx, nodes_instances, install, node_sequence=None,
+                          max_parallel_instances=None):
+    # returns approximate count of tasks and dependencies in graph for
+    # install/uninstall nodes_instances (node_id -> count of instances)
+    tasks_count = 0
+    dependencies_count = 0
+    for node_id, instances_count in nodes_instances.items():
+        node = ctx.get_node(node_id)
+        relationships = len(list(node.relationships)) if node else 0
+        instance_tasks = (INSTANCE_TASKS[install] +
+                          RELATIONSHIP_TASKS[install] * relationships)
+        tasks_count += instances_count * instance_tasks
+        # tasks in sequence, and relationships dependencies between
+        # subgraphs
+        dependencies_count += instances_count * (instance_tasks +
+                                                 relationships)
+    if node_sequence:
+        previous_level = 0
+        for node_id in node_sequence:
+            current_level = nodes_instances.get(node_id, 0)
+            if not current_level:
+                continue
+            if previous_level > 1 and current_level > 1:
+                dependencies_count += previous_level + current_level
+            else:
+                dependencies_count += previous_level * current_level
+            previous_level = current_level
+    if max_parallel_instances:
+        dependencies_count += max(
+            sum(nodes_instances.values()) - max_parallel_instances, 0)
+    return tasks_count, dependencies_count
+
+
+def _report_dry_run(ctx, scale_settings, nodes_instances, install, phases,
+                    node_sequence=None, batch_size=0,
+                    max_parallel_instances=None, removed_ids=None):
+    with _measure_phase(phases, 'estimate'):
+        waves = _split_scale_settings(ctx, scale_settings, batch_size)
+        tasks_count, dependencies_count = _estimate_scale_graph(
+            ctx, nodes_instances, install, node_sequence=node_sequence,
+            max_parallel_instances=max_parallel_instances)
+    plan = {
+        'scale_settings': scale_settings,
+        'waves': len(waves),
+        'instances': nodes_instances,
+        'tasks': tasks_count,
+        'dependencies': dependencies_count,
+        'phases': phases
+    }
+    if removed_ids is not None:
+        plan['removed_ids'] = removed_ids
+    ctx.logger.info("Dry run: {}".format(repr(plan)))
+    return plan
+
+
+def _load_scaledown_checkpoint(ctx, params, page_size=PAGE_SIZE):
+    # returns node instances, instance ids and already uninstalled ids saved
+    # by previous failed run with same parameters, only for instances which
+    # still exist in deployment
+    _check_storage(ctx)
+    checkpoint = storage.load(ctx.deployment.id, storage.CHECKPOINT_NAME)
+    if not checkpoint or checkpoint.get('params') != params:
+        return None
+    saved_at = checkpoint.get('saved_at') or 0
+    if time.time() - saved_at > CHECKPOINT_TTL:
+        ctx.logger.warn("Checkpoint of failed run is expired, search "
+                        "instances again.")
+        storage.remove(ctx.deployment.id, storage.CHECKPOINT_NAME)
+        return None
+    ctx.logger.warn("Resume scale down from checkpoint of failed run saved "
+                    "at {}, instances are not searched again."
+                    .format(time.strftime('%Y-%m-%d %H:%M:%S',
+                                          time.gmtime(saved_at))))
+
+    node_instances = {}
+    existed_ids = set()
+    for instance_id, node_id, _ in _iter_node_instances_fields(
+        ctx, [], page_size=page_size,
+        instance_ids=checkpoint['instance_ids']
+    ):
+        existed_ids.add(instance_id)
+        node_instances.setdefault(node_id, []).append(instance_id)
+    instance_ids = [instance_id for instance_id in checkpoint['instance_ids']
+                    if instance_id in existed_ids]
+    uninstalled_ids = [instance_id for instance_id in
+                       checkpoint['uninstalled_ids']
+                       if instance_id in existed_ids]
+    ctx.logger.info("Resume scale down: already removed {}, remaining {}, "
+                    "already uninstalled {}."
+                    .format(len(checkpoint['instance_ids']) -
+                            len(instance_ids), len(instance_ids),
+                            len(uninstalled_ids)))
+    return node_instances, instance_ids, uninstalled_ids
+
+
+def _save_scaledown_checkpoint(ctx, params, instance_ids, uninstalled_ids):
+    storage.save(ctx.deployment.id, storage.CHECKPOINT_NAME, {
+        'saved_at': time.time(),
+        'params': params,
+        'instance_ids': instance_ids,
+        'uninstalled_ids': uninstalled_ids
+    })
 
 
 def _scaledown_group_to_settings(ctx, list_scale_groups, scale_compute):
     scale_settings = {}
+    scaling_groups = ctx.deployment.scaling_groups
     for scalable_entity_name in list_scale_groups:
         delta = list_scale_groups[scalable_entity_name]['count']
         instances_remove = list_scale_groups[scalable_entity_name]['values']
@@ -467,23 +1391,9 @@ def _scaledown_group_to_settings(ctx, list_scale_groups, scale_compute):
                             'take place.')
             continue
 
-        scaling_group = ctx.deployment.scaling_groups.get(scalable_entity_name)
-        if scaling_group:
-            curr_num_instances = (
-                scaling_group['properties']['current_instances']
-            )
-            planned_num_instances = curr_num_instances - delta
-            scale_id = scalable_entity_name
-        else:
-            node = ctx.get_node(scalable_entity_name)
-            if not node:
-                raise ValueError("No scalable entity named {0} was found"
-                                 .format(scalable_entity_name))
-            host_node = node.host_node
-            scaled_node = host_node if (scale_compute and host_node) else node
-            curr_num_instances = scaled_node.number_of_instances
-            planned_num_instances = curr_num_instances - delta
-            scale_id = scaled_node.id
+        scale_id, curr_num_instances = _get_scale_target(
+            ctx, scaling_groups, scalable_entity_name, scale_compute)
+        planned_num_instances = curr_num_instances - delta
 
         scale_settings[scale_id] = {
             'instances': planned_num_instances,
@@ -496,6 +1406,7 @@ def _scaledown_group_to_settings(ctx, list_scale_groups, scale_compute):
 
 
 @workflow
+@_collect_metrics('scaledownlist')
 def scaledownlist(ctx, scale_compute=False,
                   ignore_failure=False,
                   force_db_cleanup=False,
@@ -505,6 +1416,14 @@ def scaledownlist(ctx, scale_compute=False,
                   scale_node_field_value="",
                   all_results=False,
                   node_sequence=None,
+                  page_size=PAGE_SIZE,
+                  use_index=False,
+                  rebuild_index=False,
+                  batch_size=0,
+                  max_parallel_instances=0,
+                  dry_run=False,
+                  metrics_file="",
+                  resume=False,
                   **kwargs):
     if (
         not scale_node_field
@@ -512,6 +1431,10 @@ def scaledownlist(ctx, scale_compute=False,
         raise ValueError('You should provide `scale_node_field` for correct'
                          'downscale.')
 
+    # drop data of previous deployment with same id before any use of
+    # storage
+    _check_storage(ctx)
+
     if isinstance(scale_node_field_value, basestring):
         scale_node_field_value = [scale_node_field_value]
 
@@ -528,50 +1451,141 @@ def scaledownlist(ctx, scale_compute=False,
     if isinstance(scale_node_field, basestring):
         scale_node_field = [scale_node_field]
 
-    instances, instance_ids = _get_transaction_instances(
-        ctx=ctx,
-        scale_transaction_field=scale_transaction_field,
-        scale_node_names=scale_node_name,
-        scale_node_field_path=scale_node_field,
-        scale_node_field_values=scale_node_field_value,
-        all_results=all_results)
+    phases = _current_metrics().phases
+    # checkpoint is used only by run with same search parameters
+    checkpoint_params = {
+        'scale_transaction_field': scale_transaction_field,
+        'scale_node_name': scale_node_name,
+        'scale_node_field': scale_node_field,
+        'scale_node_field_value': scale_node_field_value,
+        'all_results': all_results
+    }
+    checkpoint = None
+    if resume:
+        with _measure_phase(phases, 'transactions'):
+            checkpoint = _load_scaledown_checkpoint(ctx, checkpoint_params,
+                                                    page_size=page_size)
+
+    if checkpoint:
+        instances, instance_ids, uninstalled_ids = checkpoint
+    else:
+        manifest = None
+        if (
+            scale_transaction_field and
+            storage.TransactionsManifest.exists(ctx.deployment.id)
+        ):
+            manifest = storage.TransactionsManifest.load(ctx.deployment.id)
+        index = None
+        if use_index:
+            index_paths = [scale_node_field]
+            if scale_transaction_field:
+                index_paths.append([scale_transaction_field])
+            with _measure_phase(phases, 'index'):
+                index = _get_instances_index(ctx, index_paths,
+                                             rebuild=rebuild_index,
+                                             page_size=page_size)
+
+        with _measure_phase(phases, 'transactions'):
+            instances, instance_ids = _get_transaction_instances(
+                ctx=ctx,
+                scale_transaction_field=scale_transaction_field,
+                scale_node_names=scale_node_name,
+                scale_node_field_path=scale_node_field,
+                scale_node_field_values=scale_node_field_value,
+                all_results=all_results,
+                page_size=page_size,
+                index=index,
+                manifest=manifest)
+        uninstalled_ids = []
 
     if not instance_ids:
         ctx.logger.info("Empty list for instances for remove.")
+        if checkpoint and not dry_run:
+            storage.remove(ctx.deployment.id, storage.CHECKPOINT_NAME)
         return
 
     # we have list of instances_id(string) as part of scale dictionary
-    scale_settings = _scaledown_group_to_settings(
-        ctx, _get_scale_list(ctx, instances, basestring), scale_compute)
-
+    with _measure_phase(phases, 'scale_list'):
+        scale_list = _get_scale_list(ctx, instances, basestring)
+    with _measure_phase(phases, 'scale_settings'):
+        scale_settings = _scaledown_group_to_settings(ctx, scale_list,
+                                                      scale_compute)
+
+    if dry_run:
+        return _report_dry_run(
+            ctx, scale_settings,
+            dict((node_id, len(node_instance_ids))
+                 for node_id, node_instance_ids in instances.items()),
+            False, phases, node_sequence=node_sequence,
+            batch_size=batch_size,
+            max_parallel_instances=max_parallel_instances,
+            removed_ids=instance_ids)
+
+    if not checkpoint:
+        # save selected instances before any changes, so next run will
+        # continue with same instances even if we have lost properties
+        _save_scaledown_checkpoint(ctx, checkpoint_params, instance_ids,
+                                   uninstalled_ids)
+
+    waves = _split_scale_settings(ctx, scale_settings, batch_size)
+    finished_waves = 0
     try:
-        _run_scale_settings(ctx, scale_settings, {},
-                            instances_remove_ids=instance_ids,
-                            ignore_failure=ignore_failure,
-                            node_sequence=node_sequence)
+        for wave_settings in waves:
+            if len(waves) > 1:
+                ctx.logger.info('Scale down wave {}/{}: {}'
+                                .format(finished_waves + 1, len(waves),
+                                        repr(wave_settings)))
+            _run_scale_settings(ctx, wave_settings, {},
+                                instances_remove_ids=instance_ids,
+                                ignore_failure=ignore_failure,
+                                node_sequence=node_sequence,
+                                max_parallel_instances=max_parallel_instances,
+                                uninstalled_ids=uninstalled_ids)
+            finished_waves += 1
+            if len(waves) > 1:
+                ctx.logger.info('Scale down wave {}/{} finished.'
+                                .format(finished_waves, len(waves)))
     except Exception as e:
         ctx.logger.info('Scale down based on transaction failed: {}'
                         .format(repr(e)))
+        if finished_waves:
+            # instances from finished waves are already removed
+            with _phase('transactions'):
+                existed_ids = set(
+                    instance_id for instance_id, _, _ in
+                    _iter_node_instances_fields(ctx, [], page_size=page_size,
+                                                instance_ids=instance_ids))
+            instance_ids = [instance_id for instance_id in instance_ids
+                            if instance_id in existed_ids]
         # check list for forced remove
+        remove_ids = set(instance_ids) - set(uninstalled_ids)
         removed = []
         for node in ctx.nodes:
             for instance in node.instances:
-                if instance.id in instance_ids:
+                if instance.id in remove_ids:
                     removed.append(instance)
         _uninstall_instances(ctx=ctx,
                              graph=ctx.graph_mode(),
                              removed=removed,
                              related=[],
                              ignore_failure=ignore_failure,
-                             node_sequence=node_sequence)
+                             node_sequence=node_sequence,
+                             max_parallel_instances=max_parallel_instances)
+        # next run will only remove such instances from deployment
+        _save_scaledown_checkpoint(
+            ctx, checkpoint_params, instance_ids,
+            uninstalled_ids + [instance.id for instance in removed])
 
         # remove from DB
         if force_db_cleanup:
             ctx.logger.warn('Ignoring force_db_cleanup. Deprecated feature.')
+    else:
+        storage.remove(ctx.deployment.id, storage.CHECKPOINT_NAME)
 
 
 def _scaleup_group_to_settings(ctx, scalable_entity_dict, scale_compute):
     scale_settings = {}
+    scaling_groups = ctx.deployment.scaling_groups
     for scalable_entity_name in scalable_entity_dict:
         delta = scalable_entity_dict[scalable_entity_name]['count']
         ctx.logger.info('Scale up {} by delta: {}'
@@ -582,23 +1596,9 @@ def _scaleup_group_to_settings(ctx, scalable_entity_dict, scale_compute):
                             'take place.')
             continue
 
-        scaling_group = ctx.deployment.scaling_groups.get(scalable_entity_name)
-        if scaling_group:
-            curr_num_instances = (
-                scaling_group['properties']['current_instances']
-            )
-            planned_num_instances = curr_num_instances + delta
-            scale_id = scalable_entity_name
-        else:
-            node = ctx.get_node(scalable_entity_name)
-            if not node:
-                raise ValueError("No scalable entity named {0} was found"
-                                 .format(scalable_entity_name))
-            host_node = node.host_node
-            scaled_node = host_node if (scale_compute and host_node) else node
-            curr_num_instances = scaled_node.number_of_instances
-            planned_num_instances = curr_num_instances + delta
-            scale_id = scaled_node.id
+        scale_id, curr_num_instances = _get_scale_target(
+            ctx, scaling_groups, scalable_entity_name, scale_compute)
+        planned_num_instances = curr_num_instances + delta
 
         scale_settings[scale_id] = {
             'instances': planned_num_instances,
@@ -609,43 +1609,209 @@ def _scaleup_group_to_settings(ctx, scalable_entity_dict, scale_compute):
 
 
 @workflow
-def scaleuplist(ctx, scalable_entity_properties,
+@_collect_metrics('scaleuplist')
+def scaleuplist(ctx, scalable_entity_properties=None,
                 scale_compute=False,
                 ignore_failure=False,
                 ignore_rollback_failure=True,
                 scale_transaction_field="",
                 scale_transaction_value="",
                 node_sequence=None,
+                batch_size=0,
+                max_parallel_instances=0,
+                dry_run=False,
+                metrics_file="",
+                scalable_entity_properties_file="",
                 **kwargs):
 
-    if not scalable_entity_properties:
+    if scalable_entity_properties_file and scalable_entity_properties:
+        raise ValueError('Use only one of scalable_entity_properties and '
+                         'scalable_entity_properties_file')
+
+    if not scalable_entity_properties_file and not scalable_entity_properties:
         raise ValueError('Empty list of scale nodes')
 
+    # drop data of previous deployment with same id before any use of
+    # storage
+    _check_storage(ctx)
+
+    if scalable_entity_properties_file:
+        with _entity_properties_file(
+            ctx, scalable_entity_properties_file
+        ) as entity_file:
+            with _phase('scale_list'):
+                scale_list = _get_file_scale_list(ctx, entity_file)
+            if not scale_list:
+                raise ValueError('Empty list of scale nodes')
+            return _scaleup_scale_list(
+                ctx, scale_list, entity_file, scale_compute, ignore_failure,
+                ignore_rollback_failure, scale_transaction_field,
+                scale_transaction_value, node_sequence, batch_size,
+                max_parallel_instances, dry_run)
+
     # we have list of dictionaries with runtime properties for new instances as
     # part of scale dictionary
-    scale_settings = _scaleup_group_to_settings(
-        ctx, _get_scale_list(ctx, scalable_entity_properties, dict),
-        scale_compute)
+    with _phase('scale_list'):
+        scale_list = _get_scale_list(ctx, scalable_entity_properties, dict)
+    return _scaleup_scale_list(
+        ctx, scale_list, scalable_entity_properties, scale_compute,
+        ignore_failure, ignore_rollback_failure, scale_transaction_field,
+        scale_transaction_value, node_sequence, batch_size,
+        max_parallel_instances, dry_run)
+
+
+def _scaleup_scale_list(ctx, scale_list, scalable_entity_properties,
+                        scale_compute, ignore_failure,
+                        ignore_rollback_failure, scale_transaction_field,
+                        scale_transaction_value, node_sequence, batch_size,
+                        max_parallel_instances, dry_run):
+    phases = _current_metrics().phases
+    with _measure_phase(phases, 'scale_settings'):
+        scale_settings = _scaleup_group_to_settings(ctx, scale_list,
+                                                    scale_compute)
+
+    if dry_run:
+        nodes_instances = _estimate_scale_instances(ctx, scale_settings)
+        return _report_dry_run(
+            ctx, scale_settings, nodes_instances, True, phases,
+            node_sequence=node_sequence, batch_size=batch_size,
+            max_parallel_instances=max_parallel_instances)
+
+    waves = _split_scale_settings(ctx, scale_settings, batch_size)
+    if (
+        len(waves) > 1 and scale_transaction_field and
+        not scale_transaction_value
+    ):
+        # all waves are part of one transaction
+        scale_transaction_value = ctx.execution_id
+
+    for wave, wave_settings in enumerate(waves, 1):
+        if len(waves) > 1:
+            ctx.logger.info('Scale up wave {}/{}: {}'
+                            .format(wave, len(waves), repr(wave_settings)))
+        _run_scale_settings(ctx, wave_settings, scalable_entity_properties,
+                            scale_transaction_field, scale_transaction_value,
+                            ignore_failure, ignore_rollback_failure,
+                            node_sequence=node_sequence,
+                            max_parallel_instances=max_parallel_instances)
+        if len(waves) > 1:
+            ctx.logger.info('Scale up wave {}/{} finished.'
+                            .format(wave, len(waves)))
+
+
+@workflow
+def updatelist(ctx, instances_properties=None, node_ids=None,
+               node_field="", node_field_value="", node_properties=None,
+               page_size=PAGE_SIZE, **kwargs):
+    # instance id -> runtime properties to update
+    updates = {}
+
+    if node_field:
+        if not isinstance(node_properties, dict) or not node_properties:
+            raise ValueError(
+                "You use wrong value for 'node_properties': {}"
+                .format(repr(node_properties)))
+
+        if isinstance(node_field, basestring):
+            node_field = [node_field]
+
+        if isinstance(node_field_value, basestring):
+            node_field_value = [node_field_value]
 
-    _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
-                        scale_transaction_field, scale_transaction_value,
-                        ignore_failure, ignore_rollback_failure,
-                        node_sequence=node_sequence)
+        if isinstance(node_ids, basestring):
+            node_ids = [node_ids]
+        node_ids = set(node_ids or [])
+
+        match_value = _compile_values_matcher(node_field_value)
+        for instance_id, node_id, values in _iter_node_instances_fields(
+            ctx, [_compile_field_path(node_field)], page_size=page_size
+        ):
+            if node_ids and node_id not in node_ids:
+                continue
+            if match_value(values[0]):
+                updates[instance_id] = dict(node_properties)
+
+    if not isinstance(instances_properties, (dict, type(None))):
+        raise ValueError(
+            "You use wrong value for 'instances_properties': {}"
+            .format(repr(instances_properties)))
+    for instance_id, properties in (instances_properties or {}).items():
+        if not isinstance(properties, dict):
+            raise ValueError(
+                "You use wrong value for runtime properties item: {}"
+                .format(repr(properties)))
+        updates.setdefault(instance_id, {}).update(properties)
+
+    if instances_properties:
+        # writer can update any instance available for token, check that
+        # instances are in current deployment
+        known_ids = set(
+            instance_id for instance_id, _, _ in _iter_node_instances_fields(
+                ctx, [], page_size=page_size,
+                instance_ids=instances_properties.keys()))
+        unknown_ids = sorted(set(instances_properties) - known_ids)
+        if unknown_ids:
+            raise ValueError(
+                "Instances {} are not in deployment {}."
+                .format(repr(unknown_ids), ctx.deployment.id))
+
+    if not updates:
+        ctx.logger.info("Empty list for instances for update.")
+        return
+
+    ctx.logger.info("Update instances: {}".format(repr(sorted(updates))))
+    _update_instances_index(
+        ctx, _update_runtime_properties_bulk(ctx, sorted(updates.items())))
+
+
+def _get_type_nodes(nodes):
+    # type name -> nodes with such type in type hierarchy
+    type_nodes = {}
+    for node in nodes:
+        for type_name in node.type_hierarchy:
+            type_nodes.setdefault(type_name, []).append(node)
+    return type_nodes
 
 
 def _filter_node_instances(ctx, node_ids, node_instance_ids, type_names,
-                           operation, node_field_path, node_field_value):
-    filtered_node_instances = []
-    for node in ctx.nodes:
-        # no such action skip it
-        if operation not in node.operations:
-            continue
+                           operation, node_field_path, node_field_value,
+                           page_size=PAGE_SIZE):
+    # returns iterator over instances selected by all filters
+    node_ids = set(node_ids or [])
+    node_instance_ids = set(node_instance_ids or [])
+    # check that we have such values in properties
+    field_instance_ids = None
+    if node_field_path:
+        match_value = _compile_values_matcher(node_field_value)
+        field_instance_ids = set(
+            instance_id for instance_id, _, values in
+            _iter_node_instances_fields(
+                ctx, [_compile_field_path(node_field_path)],
+                page_size=page_size)
+            if match_value(values[0]))
+        # nothing to check
+        if not field_instance_ids:
+            return
+
+    if type_names:
+        # only nodes with such types
+        type_nodes = _get_type_nodes(ctx.nodes)
+        nodes = []
+        seen_node_ids = set()
+        for type_name in type_names:
+            for node in type_nodes.get(type_name, []):
+                if node.id not in seen_node_ids:
+                    seen_node_ids.add(node.id)
+                    nodes.append(node)
+    else:
+        nodes = ctx.nodes
+
+    for node in nodes:
         # no such node_id, skip it
         if node_ids and node.id not in node_ids:
             continue
-        # no such node type, skip it
-        if type_names and not next((type_name for type_name in type_names if
-                                    type_name in node.type_hierarchy), None):
+        # no such action skip it
+        if operation not in node.operations:
             continue
 
         # look more deeply, what about instance id's and properties
@@ -654,53 +1820,92 @@ def _filter_node_instances(ctx, node_ids, node_instance_ids, type_names,
             if node_instance_ids and instance.id not in node_instance_ids:
                 continue
             # look to field value
-            if node_field_path:
-                # check that we have such values in properties
-                runtime_properties = instance._node_instance.runtime_properties
-                value = _get_field_value_recursive(ctx,
-                                                   runtime_properties,
-                                                   node_field_path)
-                if value not in node_field_value:
-                    continue
+            if (
+                field_instance_ids is not None and
+                instance.id not in field_instance_ids
+            ):
+                continue
             # looks as good instance
-            filtered_node_instances.append(instance)
-    return filtered_node_instances
-
-
-@workflow
-def execute_operation(ctx, operation, operation_kwargs, allow_kwargs_override,
-                      run_by_dependency_order, type_names, node_ids,
-                      node_instance_ids, node_field, node_field_value,
-                      **kwargs):
-    """ A generic workflow for executing arbitrary operations on nodes """
-
-    if isinstance(node_field_value, basestring):
-        node_field_value = [node_field_value]
-
-    ctx.logger.debug("Filter by values list: {}."
-                     .format(repr(node_field_value)))
-
-    graph = ctx.graph_mode()
+            yield instance
+
+
+def _get_connecting_instances(node_instances, selected_ids):
+    # returns ids of not selected instances which are on some relationships
+    # path between selected instances: reachable by relationships from
+    # selected instance and have path to selected instance
+    targets = {}
+    sources = {}
+    for instance in node_instances:
+        for rel in instance.relationships:
+            targets.setdefault(instance.id, []).append(rel.target_id)
+            sources.setdefault(rel.target_id, []).append(instance.id)
+
+    def _reachable(edges):
+        visited = set()
+        stack = list(selected_ids)
+        while stack:
+            for next_id in edges.get(stack.pop(), []):
+                if next_id not in visited:
+                    visited.add(next_id)
+                    stack.append(next_id)
+        return visited
+
+    return (_reachable(targets) & _reachable(sources)) - set(selected_ids)
+
+
+def _split_operation_batches(node_instances, batch_size, batch_percentage,
+                             run_by_dependency_order,
+                             all_node_instances=None):
+    # split instances to batches by count or percentage of instances, with
+    # dependency order relationship targets are in same or previous batch
+    if run_by_dependency_order:
+        # sort with not selected instances between selected instances, so
+        # indirect dependencies keep order
+        selected_ids = set(instance.id for instance in node_instances)
+        all_node_instances = list(all_node_instances or [])
+        connecting_ids = _get_connecting_instances(all_node_instances,
+                                                   selected_ids)
+        node_instances = [
+            instance for instance in _sort_by_relationships(
+                list(node_instances) + [
+                    instance for instance in all_node_instances
+                    if instance.id in connecting_ids], True)
+            if instance.id in selected_ids]
+    else:
+        node_instances = list(node_instances)
+    if not batch_size and batch_percentage:
+        batch_size = int(math.ceil(
+            len(node_instances) * batch_percentage / 100.0))
+    if not batch_size or batch_size <= 0:
+        return [node_instances]
+    return [node_instances[offset:offset + batch_size]
+            for offset in range(0, len(node_instances), batch_size)]
+
+
+def _execute_operation_batch(ctx, graph, node_instances, operation,
+                             operation_kwargs, allow_kwargs_override,
+                             run_by_dependency_order, health_check_operation,
+                             on_failure=None):
+    with _phase('graph_build'):
+        _build_operation_graph(
+            ctx, graph, node_instances, operation, operation_kwargs,
+            allow_kwargs_override, run_by_dependency_order,
+            health_check_operation, on_failure)
+    with _phase('graph_execute'):
+        graph.execute()
+
+
+def _build_operation_graph(ctx, graph, node_instances, operation,
+                           operation_kwargs, allow_kwargs_override,
+                           run_by_dependency_order, health_check_operation,
+                           on_failure=None):
     subgraphs = {}
 
-    if isinstance(node_field, basestring):
-        node_field = [node_field]
-
-    # filtering node instances
-    filtered_node_instances = _filter_node_instances(
-        ctx=ctx,
-        node_ids=node_ids,
-        node_instance_ids=node_instance_ids,
-        type_names=type_names,
-        operation=operation,
-        node_field_path=node_field,
-        node_field_value=node_field_value)
-
     if run_by_dependency_order:
         # if run by dependency order is set, then create stub subgraphs for the
-        # rest of the instances. This is done to support indirect
-        # dependencies, i.e. when instance A is dependent on instance B
-        # which is dependent on instance C, where A and C are to be executed
+        # instances which connect selected instances. This is done to support
+        # indirect dependencies, i.e. when instance A is dependent on instance
+        # B which is dependent on instance C, where A and C are to be executed
         # with the operation on (i.e. they're in filtered_node_instances)
         # yet B isn't.
         # We add stub subgraphs rather than creating dependencies between A
@@ -710,11 +1915,14 @@ def execute_operation(ctx, operation, operation_kwargs, allow_kwargs_override,
         # the deployment (e.g. consider if A and C are one out of N instances
         # of their respective nodes yet there's a single instance of B -
         # using subgraphs we'll have 2N relationships instead of N^2).
+        # Instances which are not between selected instances can't change
+        # order, so graph size depends only on selected instances.
         filtered_node_instances_ids = set(inst.id for inst in
-                                          filtered_node_instances)
-        for instance in ctx.node_instances:
-            if instance.id not in filtered_node_instances_ids:
-                subgraphs[instance.id] = graph.subgraph(instance.id)
+                                          node_instances)
+        for instance_id in _get_connecting_instances(
+            ctx.node_instances, filtered_node_instances_ids
+        ):
+            subgraphs[instance_id] = graph.subgraph(instance_id)
 
     # preparing the parameters to the execute_operation call
     exec_op_params = {
@@ -725,24 +1933,124 @@ def execute_operation(ctx, operation, operation_kwargs, allow_kwargs_override,
         exec_op_params['allow_kwargs_override'] = allow_kwargs_override
 
     # registering actual tasks to sequences
-    for instance in filtered_node_instances:
+    for instance in node_instances:
         start_event_message = 'Starting operation {0}'.format(operation)
         if operation_kwargs:
             start_event_message += ' (Operation parameters: {0})'.format(
                 repr(operation_kwargs))
         subgraph = graph.subgraph(instance.id)
+        if on_failure:
+            subgraph.on_failure = on_failure
         sequence = subgraph.sequence()
         sequence.add(
             instance.send_event(start_event_message),
-            instance.execute_operation(**exec_op_params),
+            instance.execute_operation(**exec_op_params))
+        if health_check_operation:
+            sequence.add(
+                instance.execute_operation(health_check_operation))
+        sequence.add(
             instance.send_event('Finished operation {0}'.format(operation)))
         subgraphs[instance.id] = subgraph
 
     # adding tasks dependencies if required
     if run_by_dependency_order:
         for instance in ctx.node_instances:
+            if instance.id not in subgraphs:
+                continue
             for rel in instance.relationships:
-                graph.add_dependency(subgraphs[instance.id],
-                                     subgraphs[rel.target_id])
+                if rel.target_id in subgraphs:
+                    graph.add_dependency(subgraphs[instance.id],
+                                         subgraphs[rel.target_id])
+
+
+@workflow
+@_collect_metrics('execute_operation')
+def execute_operation(ctx, operation, operation_kwargs, allow_kwargs_override,
+                      run_by_dependency_order, type_names, node_ids,
+                      node_instance_ids, node_field, node_field_value,
+                      page_size=PAGE_SIZE, batch_size=0, batch_percentage=0,
+                      batch_pause=0, health_check_operation="",
+                      max_failures=0, metrics_file="", **kwargs):
+    """ A generic workflow for executing arbitrary operations on nodes """
+
+    if isinstance(node_field_value, basestring):
+        node_field_value = [node_field_value]
+
+    ctx.logger.debug("Filter by values list: {}."
+                     .format(repr(node_field_value)))
+
+    graph = ctx.graph_mode()
+
+    if isinstance(node_field, basestring):
+        node_field = [node_field]
+
+    # filtering node instances
+    with _phase('filter'):
+        filtered_node_instances = list(_filter_node_instances(
+            ctx=ctx,
+            node_ids=node_ids,
+            node_instance_ids=node_instance_ids,
+            type_names=type_names,
+            operation=operation,
+            node_field_path=node_field,
+            node_field_value=node_field_value,
+            page_size=page_size))
+
+    if health_check_operation:
+        # check before build graph, node without operation fails on task
+        # creation
+        missed_node_ids = set(
+            node.id for node in ctx.nodes
+            if health_check_operation not in node.operations)
+        missed_instance_ids = [
+            instance.id for instance in filtered_node_instances
+            if instance.node_id in missed_node_ids]
+        if missed_instance_ids:
+            raise ValueError(
+                "Health check operation {} is not defined for: {}"
+                .format(health_check_operation, repr(missed_instance_ids)))
+
+    if not batch_size and not batch_percentage:
+        _execute_operation_batch(
+            ctx, graph, filtered_node_instances, operation, operation_kwargs,
+            allow_kwargs_override, run_by_dependency_order,
+            health_check_operation)
+        return
 
-    graph.execute()
+    # rolling execution, failed instances are counted and execution is
+    # stopped after batch with too many failures
+    failed = []
+
+    def _on_failure(subgraph):
+        ctx.logger.error("Operation {} failed on {}."
+                         .format(operation, subgraph.name))
+        failed.append(subgraph.name)
+        # tasks after failed one are still pending, remove them or graph
+        # will wait for them forever
+        for task in subgraph.tasks.itervalues():
+            subgraph.remove_task(task)
+        return tasks.HandlerResult.ignore()
+
+    batches = _split_operation_batches(
+        filtered_node_instances, batch_size, batch_percentage,
+        run_by_dependency_order, ctx.node_instances)
+    for batch_number, batch in enumerate(batches, 1):
+        if batch_number > 1 and batch_pause:
+            with _phase('batch_pause'):
+                time.sleep(batch_pause)
+        if api.has_cancel_request():
+            raise api.ExecutionCancelled()
+        ctx.logger.info("Batch {}/{}: {}".format(
+            batch_number, len(batches),
+            repr([instance.id for instance in batch])))
+        _execute_operation_batch(
+            ctx, graph, batch, operation, operation_kwargs,
+            allow_kwargs_override, run_by_dependency_order,
+            health_check_operation, on_failure=_on_failure)
+        ctx.logger.info("Batch {}/{} finished, failed instances: {}."
+                        .format(batch_number, len(batches), len(failed)))
+        if len(failed) > max_failures:
+            raise RuntimeError(
+                "Operation {} failed on {} instances, stopped after batch "
+                "{}/{}: {}".format(operation, len(failed), batch_number,
+                                   len(batches), repr(failed)))